@@ -0,0 +1,517 @@
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Type
+
+from instrumentation import metrics
+from model_registry import registry
+from providers import ProviderPool
+from rendering import AsyncTokenStreamer, IncrementalDecoder
+from scheduler import scheduler
+from speculative import AcceptanceStats, assisted_kwargs, track_assisted
+from tiny_model import TINY_PREFIX
+
+
+@dataclass(frozen=True)
+class Capabilities:
+    streaming: bool = True        # yields text as it is produced
+    local: bool = False           # runs in this process (threads, model memory)
+    network: bool = False         # needs an API key and a connection
+    system_prompt: bool = True    # honours GenerationRequest.system
+    multi_turn: bool = False      # uses GenerationRequest.history
+    seeded: bool = False          # the same GenerationRequest.seed gives the same sampled reply
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    system: str = ""
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+    history: List[Dict] = field(default_factory=list)
+    draft_model: Optional[str] = None
+    seed: Optional[int] = None  # fixes sampling where the backend supports it
+    # Local models: name of a persistent multi-turn session (system + history
+    # through the chat template, KV cache kept between turns); None sends the
+    # prompt alone as raw text
+    session: Optional[str] = None
+
+
+class Backend:
+    # A backend turns a GenerationRequest into an async stream of text chunks.
+    # Subclasses register themselves for model-name prefixes with
+    # @register_backend and are created per model by create_backend().
+    capabilities = Capabilities()
+    default_max_tokens = 1024
+
+    def __init__(self, model: str, providers=None):
+        self.model = model
+        self.providers = providers
+        self._own_providers = None
+
+    @property
+    def pool(self) -> ProviderPool:
+        # The ProviderPool this backend was given, or else one of its own made
+        # on first use; aclose() closes only its own
+        if self.providers is not None:
+            return self.providers
+        if self._own_providers is None:
+            self._own_providers = ProviderPool()
+        return self._own_providers
+
+    @classmethod
+    def prewarm(cls, model: str):
+        pass
+
+    def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def aclose(self):
+        # Its clients belong to the event loop they were made on, so the next
+        # loop gets a new pool
+        if self._own_providers is not None:
+            await self._own_providers.aclose()
+            self._own_providers = None
+
+
+BACKENDS: Dict[str, Type[Backend]] = {}
+
+
+def register_backend(*prefixes: str):
+    def register(cls):
+        for prefix in prefixes:
+            BACKENDS[prefix] = cls
+        return cls
+    return register
+
+
+def backend_class(model: str) -> Type[Backend]:
+    # Longest matching prefix wins
+    matches = [prefix for prefix in BACKENDS if model.startswith(prefix)]
+    if not matches:
+        raise ValueError(f"Unknown model: {model}")
+    return BACKENDS[max(matches, key=len)]
+
+
+def create_backend(model: str, providers=None) -> Backend:
+    return backend_class(model)(model, providers=providers)
+
+
+def remote_model(model: str) -> bool:
+    # Models some non-local backend serves (API, fake); anything else is an
+    # HF model loaded through the registry
+    try:
+        return not backend_class(model).capabilities.local
+    except ValueError:
+        return False
+
+
+def parse_options(model: str) -> Dict[str, float]:
+    # "fake:ttft=0.5,tps=20" -> {"ttft": 0.5, "tps": 20.0}
+    if ":" not in model:
+        return {}
+    options = {}
+    for item in model.split(":", 1)[1].split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            options[key.strip()] = float(value)
+    return options
+
+
+@register_backend("meta-llama", TINY_PREFIX)
+class LlamaBackend(Backend):
+    # Local HF causal LM, weights shared through the model registry. Options
+    # after a colon (e.g. "tiny-random/llama:tps=30") add artificial latency.
+    # A request with draft_model set uses assisted (speculative) decoding: the
+    # draft proposes tokens and this model verifies them. With an inference
+    # server configured (LLAMA_SERVER, /server) other requests go through it.
+    # System prompt and history are used by requests with a session.
+    capabilities = Capabilities(local=True, multi_turn=True, seeded=True)
+    default_max_tokens = 300
+
+    def __init__(self, model: str, providers=None):
+        options = parse_options(model)
+        super().__init__(model.split(":", 1)[0], providers)
+        self.first_token_latency = options.get("ttft", 0.0)
+        self.token_latency = 1 / options["tps"] if options.get("tps") else 0.0
+        self.handle = None
+        self.draft_handles = {}
+        self.last_stats = None
+        self.draft_stats = AcceptanceStats()
+        self.client = None
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def prewarm(cls, model: str):
+        registry.prewarm(model.split(":", 1)[0])
+
+    def load(self):
+        with self._lock:
+            if self.handle is None:
+                self.handle = registry.acquire(self.model)
+            return self.handle
+
+    def load_draft(self, model: str):
+        with self._lock:
+            if model not in self.draft_handles:
+                self.draft_handles[model] = registry.acquire(model)
+            return self.draft_handles[model]
+
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        # Background jobs (/loop) pause at their next token while a reply runs
+        with scheduler.foreground():
+            async for text in self._stream(request):
+                yield text
+
+    async def _stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        from inference_server import server_target
+
+        if server_target() and not request.draft_model:
+            async for text in self.stream_served(request):
+                yield text
+            return
+
+        import torch
+
+        from generation import model_device
+
+        handle = await asyncio.to_thread(self.load)
+        draft = await asyncio.to_thread(self.load_draft, request.draft_model) if request.draft_model else None
+        tokenizer = handle.tokenizer
+        # One streamer per request so concurrent generations don't mix output;
+        # it skips the prompt and special tokens by id, before any decoding
+        streamer = AsyncTokenStreamer(asyncio.get_running_loop(), skip_ids=tokenizer.all_special_ids)
+        decoder = IncrementalDecoder(tokenizer)
+        max_new_tokens = request.max_tokens or self.default_max_tokens
+        device = model_device(handle.model)
+        labels = {"backend": "llama", "model": self.model}
+        session, trimmer, begun = None, None, False
+        try:
+            # Setup generation in a separate thread
+            generation_kwargs = {
+                "streamer": streamer,
+                "max_new_tokens": max_new_tokens,
+                "pad_token_id": tokenizer.pad_token_id or tokenizer.eos_token_id,
+            }
+            if request.session:
+                # Only the tokens after what the session has cached get prefilled
+                session = self.session(request.session, handle)
+                with metrics.span("tokenize", **labels):
+                    input_ids, past, _ = await self.begin_session(
+                        session, request.system, request.history, request.prompt, max_new_tokens
+                    )
+                begun = True
+                input_ids = input_ids[None].to(device)
+                generation_kwargs.update(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    past_key_values=past,
+                    return_dict_in_generate=True,
+                )
+                if session.stop_strings:
+                    from chat_session import StopTrimmer
+
+                    generation_kwargs.update(stop_strings=session.stop_strings, tokenizer=tokenizer)
+                    trimmer = StopTrimmer(session.stop_strings[0])
+            else:
+                # Prepare input with proper device placement
+                with metrics.span("tokenize", **labels):
+                    inputs = tokenizer(
+                        request.prompt,
+                        return_tensors="pt",
+                        padding=True,
+                        add_special_tokens=True
+                    )
+                # Move input tensors to the device the model actually ended up on
+                generation_kwargs.update({k: v.to(device) for k, v in inputs.items()})
+            # Temperature 0 means greedy; generate() rejects it as a sampling temperature
+            if request.temperature:
+                generation_kwargs.update(do_sample=True, temperature=request.temperature)
+            else:
+                generation_kwargs.update(do_sample=False, temperature=None, top_p=None)
+            if draft is not None:
+                generation_kwargs.update(assisted_kwargs(handle, draft))
+
+            timer = metrics.timer(**labels)
+            thread = threading.Thread(
+                target=self._generate,
+                args=(handle.model, streamer, generation_kwargs, draft, request.seed, session.end if session else None),
+            )
+            thread.start()
+        except BaseException:
+            # Until the thread runs, nothing else will end() the session
+            if begun:
+                session.end()
+            raise
+        await asyncio.sleep(self.first_token_latency)
+
+        async for ids in streamer:
+            if timer:
+                timer.mark(len(ids))
+            text = decoder.push(ids)
+            if trimmer is not None:
+                text = trimmer.push(text)
+            if text:
+                yield text
+                await asyncio.sleep(self.token_latency)
+        text = decoder.flush()
+        if trimmer is not None:
+            text = trimmer.push(text) + trimmer.flush()
+        if text:
+            yield text
+
+        await asyncio.to_thread(thread.join)
+        if timer:
+            timer.finish(tokens_in=generation_kwargs["input_ids"].shape[-1])
+
+    @staticmethod
+    async def begin_session(session, *args):
+        # session.begin() on a thread. If the turn is cancelled meanwhile, the
+        # session is ended as soon as begin() returns rather than left locked
+        future = asyncio.ensure_future(asyncio.to_thread(session.begin, *args))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda done: done.cancelled() or done.exception() or session.end())
+            raise
+
+    def session(self, name: str, handle):
+        # Sessions live as long as the handle they cache KV for
+        from chat_session import ChatSession
+
+        with self._lock:
+            session = self.sessions.get(name)
+            if session is None or session.handle is not handle:
+                session = self.sessions[name] = ChatSession(handle)
+            return session
+
+    def reset_sessions(self):
+        for session in list(self.sessions.values()):
+            session.reset()
+
+    def warm_session(self, name: str, system: str, history: List[Dict]) -> int:
+        # Prefill a loaded conversation ahead of the next message
+        from inference_server import server_target
+
+        if server_target():
+            return 0
+        with scheduler.foreground():
+            return self.session(name, self.load()).warm(system, history)
+
+    def connect(self):
+        # One client per server target, kept across requests
+        from inference_server import connect, server_target
+
+        with self._lock:
+            target = server_target()
+            if self.client is None or self.client[0] != target:
+                self.client = (target, connect(self.model, target))
+            return self.client[1]
+
+    async def stream_served(self, request: GenerationRequest) -> AsyncIterator[str]:
+        from inference_server import ServerRequest
+
+        client = await asyncio.to_thread(self.connect)
+        tokenizer = client.handle.tokenizer
+        decoder = IncrementalDecoder(tokenizer)
+        labels = {"backend": "llama-server", "model": self.model}
+        session, trimmer = None, None
+        with metrics.span("tokenize", **labels):
+            if request.session:
+                # The server's prefix cache takes care of reusing earlier turns
+                session = self.session(request.session, client.handle)
+                input_ids = session.prompt(
+                    request.system, request.history, request.prompt, request.max_tokens or self.default_max_tokens
+                )[0].tolist()
+            else:
+                input_ids = tokenizer(request.prompt, add_special_tokens=True)["input_ids"]
+        served = ServerRequest(
+            input_ids=input_ids,
+            max_new_tokens=request.max_tokens or self.default_max_tokens,
+            temperature=request.temperature,
+        )
+        if session is not None and session.stop_strings:
+            from chat_session import StopTrimmer
+
+            # Base model: stop when it starts the next "User:" turn itself
+            served.stop = {"stop_names": ["User"]}
+            trimmer = StopTrimmer(session.stop_strings[0])
+        # Here prefill also covers the wait for a slot in the server's batch
+        timer = metrics.timer(**labels)
+        first = True
+        async for ids in client.astream(served, skip_ids=tokenizer.all_special_ids):
+            if timer:
+                timer.mark(len(ids))
+            if first:
+                await asyncio.sleep(self.first_token_latency)
+                first = False
+            text = decoder.push(ids)
+            if trimmer is not None:
+                text = trimmer.push(text)
+            if text:
+                yield text
+                await asyncio.sleep(self.token_latency)
+        text = decoder.flush()
+        if trimmer is not None:
+            text = trimmer.push(text) + trimmer.flush()
+        if text:
+            yield text
+        if timer:
+            timer.finish(tokens_in=len(input_ids))
+
+    def _generate(self, model, streamer, generation_kwargs, draft=None, seed=None, on_done=None):
+        # on_done gets generate()'s output, or None if it failed
+        output = None
+        try:
+            if seed is not None:
+                import torch
+
+                torch.manual_seed(seed)
+            if draft is None:
+                output = model.generate(**generation_kwargs)
+                return
+            stats = AcceptanceStats()
+            with track_assisted(model, draft.model, stats) as finish:
+                output = model.generate(**generation_kwargs)
+                sequences = getattr(output, "sequences", output)
+                finish(sequences.shape[-1] - generation_kwargs["input_ids"].shape[-1])
+            self.last_stats = stats
+            self.draft_stats.add(stats)
+        except Exception as e:
+            output = None
+            # Don't leave the consumer waiting on a stream that will never end
+            streamer.fail(e)
+        finally:
+            if on_done is not None:
+                on_done(output)
+
+    def unload(self):
+        # Drop this backend's handles; the next load() acquires them again
+        # (e.g. under a new device policy)
+        with self._lock:
+            if self.handle is not None:
+                registry.release(self.handle)
+                self.handle = None
+            for draft in self.draft_handles.values():
+                registry.release(draft)
+            self.draft_handles = {}
+            self.sessions = {}
+
+    async def aclose(self):
+        self.unload()
+
+
+@register_backend("claude")
+class AnthropicBackend(Backend):
+    capabilities = Capabilities(network=True)
+
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        labels = {"backend": "anthropic", "model": self.model}
+        async with self.pool.limit:
+            # network: sending the request until the response stream opens;
+            # prefill: from there to the first text
+            with metrics.span("network", **labels):
+                response = await self.pool.anthropic.messages.create(
+                    model=self.model,
+                    messages=[{"role": "user", "content": request.prompt}],
+                    system=request.system,
+                    temperature=request.temperature,
+                    max_tokens=request.max_tokens or self.default_max_tokens,
+                    stream=True,
+                )
+            timer = metrics.timer(**labels)
+            usage = {}
+            async for chunk in response:
+                if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
+                    if timer:
+                        timer.mark()
+                    yield chunk.delta.text
+                elif timer:
+                    # Token counts come in the message_start and message_delta events
+                    if getattr(chunk, "type", None) == "message_start":
+                        usage["in"] = chunk.message.usage.input_tokens
+                    elif getattr(chunk, "type", None) == "message_delta":
+                        usage["out"] = chunk.usage.output_tokens
+            if timer:
+                timer.finish(tokens_in=usage.get("in"), tokens_out=usage.get("out"))
+
+
+@register_backend("gpt")
+class OpenAIBackend(Backend):
+    capabilities = Capabilities(network=True)
+
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        messages = [{"role": "user", "content": request.prompt}]
+        if request.system:
+            messages.insert(0, {"role": "system", "content": request.system})
+
+        extra = {"max_tokens": request.max_tokens} if request.max_tokens else {}
+        if request.seed is not None:
+            extra["seed"] = request.seed
+        labels = {"backend": "openai", "model": self.model}
+        timer = metrics.timer(**labels)
+        if timer:
+            # Adds a last chunk, with no choices, carrying the token counts
+            extra["stream_options"] = {"include_usage": True}
+        async with self.pool.limit:
+            with metrics.span("network", **labels):
+                response = await self.pool.openai.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=request.temperature,
+                    stream=True,
+                    **extra,
+                )
+            if timer:
+                timer.start = time.perf_counter()
+            usage = None
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if timer:
+                        timer.mark()
+                    yield chunk.choices[0].delta.content
+                elif getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+            if timer:
+                timer.finish(tokens_in=usage and usage.prompt_tokens, tokens_out=usage and usage.completion_tokens)
+
+
+@register_backend("fake")
+class FakeBackend(Backend):
+    # Offline stand-in that needs neither weights nor network. Emits word
+    # tokens after `ttft` seconds at `tps` tokens per second; "fake/echo"
+    # streams the prompt back, anything else streams seeded filler words.
+    capabilities = Capabilities(system_prompt=False, seeded=True)
+    default_max_tokens = 64
+    WORDS = ["the", "sandpit", "bot", "thinks", "about", "a", "new", "idea", "and", "answers", "quietly", "."]
+
+    def __init__(self, model: str, providers=None):
+        super().__init__(model, providers)
+        options = parse_options(model)
+        self.first_token_latency = options.get("ttft", 0.05)
+        self.token_latency = 1 / options["tps"] if options.get("tps") else 0.01
+        self.echo = model.split(":", 1)[0] == "fake/echo"
+
+    def tokens(self, request: GenerationRequest) -> List[str]:
+        if self.echo:
+            words = request.prompt.split()
+        else:
+            rng = random.Random(request.prompt if request.seed is None else f"{request.seed}:{request.prompt}")
+            words = [rng.choice(self.WORDS) for _ in range(request.max_tokens or self.default_max_tokens)]
+        return [word if i == 0 else f" {word}" for i, word in enumerate(words)]
+
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        timer = metrics.timer(backend="fake", model=self.model)
+        await asyncio.sleep(self.first_token_latency)
+        next_time = time.monotonic()
+        for token in self.tokens(request):
+            if timer:
+                timer.mark()
+            yield token
+            next_time += self.token_latency
+            await asyncio.sleep(max(next_time - time.monotonic(), 0))
+        if timer:
+            timer.finish(tokens_in=len(request.prompt.split()))
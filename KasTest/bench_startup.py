@@ -0,0 +1,53 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+# Time from interpreter start to a ready ChatInterface, built exactly as the
+# REPL builds it, measured in a fresh process each run so nothing is already
+# imported or cached in memory.
+
+HEAVY_MODULES = ["torch", "transformers", "anthropic", "openai"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {kastest!r})
+import main
+chat = main.ChatInterface()
+ready = time.perf_counter() - start
+print(json.dumps({{"ready": ready, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(runs: int):
+    probe = PROBE.format(kastest=str(Path(__file__).parent), heavy=HEAVY_MODULES)
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True)
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark REPL startup time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.0, help="fail if the median startup exceeds this many seconds")
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    times = [r["ready"] for r in results]
+    loaded = sorted({m for r in results for m in r["loaded"]})
+    median = statistics.median(times)
+    print(f"startup: median {median * 1000:.0f} ms, min {min(times) * 1000:.0f} ms, max {max(times) * 1000:.0f} ms over {args.runs} runs")
+    if loaded:
+        print(f"heavy modules imported at startup: {', '.join(loaded)}")
+
+    if median > args.budget or loaded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
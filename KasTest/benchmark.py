@@ -0,0 +1,354 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Benchmarks for the chat and sandpit generation paths. Defaults to the tiny
+# random local model so it runs on a CPU-only box with no network; pass
+# --model to measure real weights. Results go to a JSON file that a later run
+# can --compare against.
+#
+#   python benchmark.py --output baseline.json
+#   python benchmark.py --compare baseline.json
+
+DEFAULT_MODEL = "tiny-random/llama"
+
+# Metrics where bigger is better; everything else is a time or a size
+HIGHER_IS_BETTER = {"tokens_per_sec", "decode_tokens_per_sec"}
+# Reported but not compared: they depend on what else the process holds
+MEMORY_METRICS = {"peak_rss_mb", "rss_growth_mb"}
+
+PERSONA = "You are a careful, curious conversationalist who adds one new idea at a time."
+FILLER = "We keep talking about animals and which one would be the best friend to have around. "
+
+
+class TimingStreamer:
+    # Passed to generate() as its streamer: the first put() is the prompt, the
+    # following ones are newly generated tokens (one per row per step). TTFT
+    # runs from reset() (before the prompt is built) to the first token;
+    # prefill from generate() starting, i.e. the prompt put(), to the same token.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.generate_start = None
+        self.first_token = None
+        self.finished = None
+        self.prompt_seen = False
+        self.tokens = 0
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            self.generate_start = time.perf_counter()
+            return
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.tokens += value.numel()
+
+    def end(self):
+        self.finished = time.perf_counter()
+
+    def sample(self):
+        total = self.finished - self.start
+        first_token = self.first_token or self.finished
+        ttft = first_token - self.start
+        decode = total - ttft
+        return {
+            "ttft_s": ttft,
+            "prefill_s": first_token - (self.generate_start or self.start),
+            "decode_s": decode,
+            "tokens": self.tokens,
+            "tokens_per_sec": self.tokens / total if total else 0.0,
+            "decode_tokens_per_sec": (self.tokens - 1) / decode if decode > 0 and self.tokens > 1 else 0.0,
+        }
+
+
+class TimingFile(io.StringIO):
+    # Console output sink recording when the first chunk was rendered
+    def __init__(self):
+        super().__init__()
+        self.first_write = None
+
+    def write(self, text):
+        if self.first_write is None and text.strip():
+            self.first_write = time.perf_counter()
+        return super().write(text)
+
+
+def rss_mb() -> float:
+    # Resident memory right now. Without /proc (macOS) only the process-wide
+    # high-water mark is available, which never goes down between scenarios
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class RssSampler:
+    # Peak resident memory while one scenario runs, sampled on a thread
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.start = self.peak = 0.0
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start = self.peak = rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_mb())
+
+    def _run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+
+def summarise(samples):
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+
+def synthetic_transcript(tokenizer, tokens: int) -> str:
+    transcript = ""
+    speakers = ["BLEEP", "BLOOP", "PLONK"]
+    while len(tokenizer(transcript, add_special_tokens=False)["input_ids"]) < tokens:
+        transcript += f"{speakers[len(transcript) % 3]}: {FILLER}\n"
+    return transcript
+
+
+def bench_autobot(model, history_tokens, max_new_tokens, repeats):
+    from llama_test import Autobot
+
+    bot = Autobot("BENCH", PERSONA, "white", model=model)
+    timer = TimingStreamer()
+    bot.max_new_tokens = max_new_tokens
+    bot.generation_kwargs = {"streamer": timer, "min_new_tokens": max_new_tokens}
+    # Fixed-length replies so runs are comparable
+    bot.max_sentences, bot.stop_on_names, bot.repetition_ngram = None, False, None
+    transcript = synthetic_transcript(bot.handle.tokenizer, history_tokens)
+    friends = ["BLEEP", "BLOOP"]
+    cold, warm = [], []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Cold: nothing cached, the whole prompt is prefilled
+            for _ in range(repeats):
+                if bot.handle.prefix_cache is not None:
+                    bot.handle.prefix_cache.clear()
+                timer.reset()
+                bot.respond(transcript, friends, 10)
+                cold.append(timer.sample())
+            # Warm: a new message each turn, as in a running sandpit
+            for turn in range(repeats):
+                transcript += f"BLEEP: {FILLER}{turn}\n"
+                timer.reset()
+                bot.respond(transcript, friends, 10)
+                warm.append(timer.sample())
+    finally:
+        bot.close()
+    metrics = summarise(cold)
+    metrics.update({f"warm_{key}": value for key, value in summarise(warm).items()})
+    return metrics
+
+
+def bench_sandpit(model, bots, rounds, max_new_tokens, mode):
+    from llama_test import Autobot, Sandpit
+
+    sandpit = Sandpit()
+    timers = []
+    for i in range(bots):
+        bot = Autobot(f"BOT{i}", PERSONA, "white", model=model)
+        timer = TimingStreamer()
+        bot.max_new_tokens = max_new_tokens
+        bot.generation_kwargs = {"streamer": timer, "min_new_tokens": max_new_tokens}
+        bot.max_sentences, bot.stop_on_names, bot.repetition_ngram = None, False, None
+        timers.append(timer)
+        sandpit.add_autobot(bot)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            sandpit.start_conversation("What is your favourite animal?", rounds=rounds, mode=mode)
+            total = time.perf_counter() - start
+    finally:
+        sandpit.close()
+    tokens = sum(timer.tokens for timer in timers)
+    return {
+        "round_s": statistics.median(sandpit.round_times),
+        "round_max_s": max(sandpit.round_times),
+        "total_s": total,
+        "tokens": tokens,
+        "tokens_per_sec": tokens / total if total else 0.0,
+    }
+
+
+def bench_chat(model, max_new_tokens, repeats):
+    from rich.console import Console
+
+    from main import ChatInterface
+
+    chat = ChatInterface(prewarm=False)
+    chat.current_model = model
+    chat.max_tokens = max_new_tokens
+    output = TimingFile()
+    chat.console = Console(file=output, force_terminal=False)
+    handle = chat.ensure_llama()
+
+    async def run():
+        samples = []
+        for i in range(repeats):
+            output.first_write = None
+            start = time.perf_counter()
+            response = await chat.send_message_llama(f"Tell me about animal number {i}.")
+            total = time.perf_counter() - start
+            tokens = len(handle.tokenizer(response, add_special_tokens=False)["input_ids"])
+            ttft = (output.first_write or time.perf_counter()) - start
+            samples.append({
+                "ttft_s": ttft,
+                "total_s": total,
+                "tokens": tokens,
+                "tokens_per_sec": tokens / total if total else 0.0,
+            })
+        await chat.shutdown()
+        return samples
+
+    return summarise(asyncio.run(run()))
+
+
+def environment(model):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ""
+    import torch
+    import transformers
+
+    from device_policy import current_policy
+
+    policy = current_policy()
+    return {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "model": model,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "device": policy.device or "",
+        "precision": policy.precision,
+    }
+
+
+def run_suite(args):
+    results = []
+
+    def record(scenario, params, run):
+        with RssSampler() as rss:
+            metrics = run()
+        metrics["peak_rss_mb"] = rss.peak
+        metrics["rss_growth_mb"] = rss.peak - rss.start
+        results.append({"scenario": scenario, "params": params, "metrics": metrics})
+        shown = ", ".join(f"{k}={v:.4g}" for k, v in metrics.items() if isinstance(v, float))
+        print(f"{scenario} {params}: {shown}", flush=True)
+
+    for max_new_tokens in args.max_new_tokens:
+        if "chat" in args.scenarios:
+            params = {"max_new_tokens": max_new_tokens}
+            record("chat", params, lambda: bench_chat(args.model, max_new_tokens, args.repeats))
+        if "autobot" in args.scenarios:
+            for history in args.history:
+                params = {"history_tokens": history, "max_new_tokens": max_new_tokens}
+                record("autobot", params, lambda: bench_autobot(args.model, history, max_new_tokens, args.repeats))
+        if "sandpit" in args.scenarios:
+            for bots in args.bots:
+                for mode in args.modes:
+                    params = {"bots": bots, "rounds": args.rounds, "mode": mode, "max_new_tokens": max_new_tokens}
+                    record("sandpit", params, lambda: bench_sandpit(args.model, bots, args.rounds, max_new_tokens, mode))
+    return {"environment": environment(args.model), "results": results}
+
+
+def compare(report, baseline, tolerance):
+    # Print the change per metric and return the regressions beyond tolerance
+    previous = {json.dumps([r["scenario"], r["params"]], sort_keys=True): r["metrics"] for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(json.dumps([result["scenario"], result["params"]], sort_keys=True))
+        if old is None:
+            continue
+        for key, value in result["metrics"].items():
+            if key not in old or not old[key] or key in MEMORY_METRICS:
+                continue
+            change = value / old[key] - 1
+            worse = -change if key.split("warm_")[-1] in HIGHER_IS_BETTER else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            print(f"{result['scenario']} {result['params']} {key}: {old[key]:.4g} -> {value:.4g} ({change:+.0%}){flag}")
+            if flag:
+                regressions.append((result["scenario"], result["params"], key))
+    return regressions
+
+
+def int_list(text):
+    return [int(item) for item in text.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat and sandpit generation")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--scenarios", default="chat,autobot,sandpit", type=lambda s: s.split(","))
+    parser.add_argument("--bots", default="1,3,5", type=int_list)
+    parser.add_argument("--history", default="0,512,2048", type=int_list, help="history lengths in tokens")
+    parser.add_argument("--max-new-tokens", default="16,64", type=int_list)
+    parser.add_argument("--modes", default="sequential,simultaneous", type=lambda s: s.split(","))
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--precision", help="local model precision: auto, fp32, bf16, fp16 or int8")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument("--server", help="route local generation through an inference server: local or a socket path")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before failing")
+    args = parser.parse_args()
+
+    from device_policy import set_policy
+
+    if args.precision:
+        set_policy(precision=args.precision)
+    if args.threads:
+        set_policy(threads=args.threads)
+    if args.server:
+        from inference_server import set_server_target
+
+        set_server_target(args.server)
+    report = run_suite(args)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"wrote {args.output}")
+    if args.compare:
+        regressions = compare(report, json.loads(Path(args.compare).read_text()), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from generation import model_device
+from instrumentation import metrics
+from kv_cache import cache_layers, common_prefix_length, crop_layers, layers_length, make_cache
+
+# A multi-turn conversation with a local model that keeps its KV cache between
+# turns. Each turn the conversation is rendered with the tokenizer's chat
+# template; when the new text extends what the cache already holds (the usual
+# case: last prompt + the reply + a new user message) only the extension is
+# tokenized and only the tokens after the longest cached prefix are
+# prefilled. Anything else (new system prompt, /load, edited history) simply
+# matches a shorter prefix.
+#
+# Past the token budget the oldest turns are dropped, down to trim_to of the
+# budget, so the full re-prefill that trimming costs happens once every few
+# turns rather than on every one.
+#
+# Base models without a chat template (e.g. Meta-Llama-3-8B) get a plain
+# "User: / Assistant:" transcript, and generation stops when they start
+# writing the next user turn themselves.
+
+DEFAULT_SESSION_TOKENS = 4096
+ROLE_NAMES = {"system": "System", "user": "User", "assistant": "Assistant"}
+PLAIN_STOP = "\nUser:"
+
+
+def session_budget(handle, max_tokens: int = DEFAULT_SESSION_TOKENS) -> int:
+    config = getattr(handle, "config", None) or handle.model.config
+    context = getattr(config, "max_position_embeddings", None) or max_tokens
+    return min(max_tokens, context)
+
+
+def plain_template(messages: List[Dict], bos: str = "", add_generation_prompt: bool = True) -> str:
+    text = bos + "\n\n".join(f"{ROLE_NAMES[m['role']]}: {m['content'].strip()}" for m in messages)
+    return text + "\n\nAssistant:" if add_generation_prompt else text
+
+
+class ChatSession:
+    def __init__(self, handle, max_tokens: Optional[int] = None, trim_to: float = 0.6):
+        self.handle = handle
+        self.tokenizer = handle.tokenizer
+        self.max_tokens = max_tokens or session_budget(handle)
+        self.trim_to = trim_to
+        self.chat_template = bool(getattr(self.tokenizer, "chat_template", None))
+        # Leading turns left out to stay under the budget
+        self.dropped = 0
+        # What the cache was built from: token ids, the text they render, and
+        # per-layer KV for (usually all but the last of) those ids
+        self.ids = torch.zeros(0, dtype=torch.long)
+        self.text = ""
+        self.layers = None
+        # Set between begin() and end()
+        self.prompt_ids = None
+        self.prompt_text = ""
+        self.lock = threading.Lock()
+        # Set by reset(); the cache is dropped next time the lock is taken
+        self.stale = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def stop_strings(self) -> List[str]:
+        return [] if self.chat_template else [PLAIN_STOP]
+
+    def reset(self):
+        # /clear, /system, /load: the next turn prefills afresh. Only flags
+        # the cache, so the event loop never waits on a turn or warm() that
+        # holds the lock.
+        self.stale = True
+
+    def _drop_stale(self):
+        # From prompt(); begin() and warm() hold the lock around it
+        if self.stale:
+            self.stale = False
+            self.dropped = 0
+            self.ids = torch.zeros(0, dtype=torch.long)
+            self.text = ""
+            self.layers = None
+
+    def turns(self, history: List[Dict], prompt: Optional[str]) -> List[Dict]:
+        # history may already end with the prompt (the REPL adds the user
+        # message before sending it). Alternative replies (the other models'
+        # answers to a fan-out) stay out of the transcript.
+        turns = [
+            {"role": m["role"], "content": m["content"]}
+            for m in history if m.get("role") in ("user", "assistant") and not m.get("alternative")
+        ]
+        if prompt is not None and (not turns or turns[-1] != {"role": "user", "content": prompt}):
+            turns.append({"role": "user", "content": prompt})
+        if self.dropped > len(turns):
+            self.dropped = 0
+        return turns
+
+    def render(self, system: str, turns: List[Dict], add_generation_prompt: bool = True) -> str:
+        messages = ([{"role": "system", "content": system}] if system else []) + turns
+        if self.chat_template:
+            return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+        return plain_template(messages, self.tokenizer.bos_token or "", add_generation_prompt)
+
+    def encode(self, text: str) -> torch.Tensor:
+        # The rendered text carries its own special tokens (BOS included)
+        if self.text and text.startswith(self.text):
+            suffix = self.tokenizer(text[len(self.text):], add_special_tokens=False)["input_ids"]
+            return torch.cat((self.ids, torch.tensor(suffix, dtype=torch.long)))
+        return torch.tensor(self.tokenizer(text, add_special_tokens=False)["input_ids"], dtype=torch.long)
+
+    def prompt(self, system: str, history: List[Dict], prompt: Optional[str], max_new_tokens: int,
+               add_generation_prompt: bool = True) -> Tuple[torch.Tensor, str]:
+        # Token ids and text for the next turn, trimmed to the budget
+        self._drop_stale()
+        turns = self.turns(history, prompt)
+        text = self.render(system, turns[self.dropped:], add_generation_prompt)
+        ids = self.encode(text)
+        if len(ids) + max_new_tokens > self.max_tokens:
+            target = self.trim_to * self.max_tokens - max_new_tokens
+            # Drop whole exchanges, but always keep the newest message
+            while len(ids) > target and self.dropped < len(turns) - 1:
+                self.dropped += 2 if turns[self.dropped]["role"] == "user" and self.dropped < len(turns) - 2 else 1
+                text = self.render(system, turns[self.dropped:], add_generation_prompt)
+                ids = self.encode(text)
+        return ids, text
+
+    def begin(self, system: str, history: List[Dict], prompt: str, max_new_tokens: int):
+        # Returns (input ids, cache to pass to generate(), cached length). Holds
+        # the session until end(); generate() needs at least one uncached token.
+        self.lock.acquire()
+        try:
+            ids, text = self.prompt(system, history, prompt, max_new_tokens)
+            cached = self._reusable(ids, len(ids) - 1)
+            self.prompt_ids, self.prompt_text = ids, text
+            past = make_cache(crop_layers(self.layers, cached)) if cached else None
+            metrics.count("session_reused_tokens", cached)
+            metrics.count("session_prefill_tokens", len(ids) - cached)
+            return ids, past, cached
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def end(self, output=None):
+        # output: generate()'s return_dict_in_generate result, or None when it
+        # failed (the session then keeps its previous cache)
+        try:
+            if output is not None:
+                sequence = output.sequences[0].cpu()
+                new_ids = sequence[len(self.prompt_ids):]
+                self.ids = sequence
+                self.text = self.prompt_text + self.tokenizer.decode(new_ids, skip_special_tokens=False)
+                self.layers = cache_layers(output.past_key_values)
+        finally:
+            self.prompt_ids, self.prompt_text = None, ""
+            self.lock.release()
+
+    def warm(self, system: str, history: List[Dict]) -> int:
+        # Prefill a conversation (e.g. one just loaded) before the next user
+        # message arrives, so that turn only prefills the message itself.
+        # Returns the number of tokens computed.
+        with self.lock:
+            ids, text = self.prompt(system, history, None, 0, add_generation_prompt=False)
+            cached = self._reusable(ids, len(ids))
+            if cached >= len(ids):
+                return 0
+            model = self.handle.model
+            device = model_device(model)
+            positions = torch.arange(cached, len(ids), device=device)
+            with torch.no_grad(), metrics.span("warm", backend="session", model=self.handle.model_id):
+                output = model.base_model(
+                    input_ids=ids[None, cached:].to(device),
+                    past_key_values=make_cache(crop_layers(self.layers, cached)) if cached else None,
+                    position_ids=positions[None],
+                    cache_position=positions,
+                    use_cache=True,
+                )
+            self.ids, self.text = ids, text
+            self.layers = cache_layers(output.past_key_values)
+            return len(ids) - cached
+
+    def _reusable(self, ids: torch.Tensor, limit: int) -> int:
+        if self.layers is None:
+            return 0
+        return max(min(common_prefix_length(self.ids, ids), layers_length(self.layers), limit), 0)
+
+
+class StopTrimmer:
+    # Streams text while holding back anything that could be the start of the
+    # stop string, and cuts the reply where the stop string appears
+    def __init__(self, stop: str):
+        self.stop = stop
+        self.held = ""
+        self.stopped = False
+
+    def push(self, text: str) -> str:
+        if self.stopped:
+            return ""
+        text = self.held + text
+        index = text.find(self.stop)
+        if index >= 0:
+            self.stopped = True
+            self.held = ""
+            return text[:index]
+        keep = next((n for n in range(min(len(self.stop) - 1, len(text)), 0, -1) if self.stop.startswith(text[-n:])), 0)
+        self.held = text[len(text) - keep:]
+        return text[:len(text) - keep]
+
+    def flush(self) -> str:
+        text, self.held = self.held, ""
+        return "" if self.stopped else text
@@ -0,0 +1,174 @@
+import json
+import mmap
+import os
+from array import array
+from typing import Dict, Iterator, List, Optional
+
+# Chat history on disk, one JSON message per line, written as each message
+# arrives (O(1) per message). A side file "<path>.idx" holds the byte offset of
+# every line as uint64s, so message i or the last n messages are read straight
+# out of a memory map without parsing the rest of the file. The index is
+# rebuilt from the log if it is missing or stale; a torn last line left by a
+# crash is cut off on open.
+#
+# {"type": "clear"} lines mark where a conversation was cleared. Reads start
+# after the last marker; compact() drops everything before it for good.
+
+CLEAR = {"type": "clear"}
+
+
+class ConversationStore:
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.index_path = f"{path}.idx"
+        # fsync per message survives a power cut as well as a crash; messages
+        # arrive at typing speed, so the cost doesn't matter
+        self.fsync = fsync
+        self._file = open(path, "ab+")
+        self._index_file = None
+        self._map = None
+        self._map_size = 0
+        self.offsets = array("Q")
+        self.start = 0  # first message after the last clear
+        self._load_index()
+
+    def __len__(self):
+        return len(self.offsets) - self.start
+
+    def __getitem__(self, i: int) -> Dict:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self._line(self.start + i))
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, message: Dict) -> int:
+        line = json.dumps(message).encode() + b"\n"
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        self._file.write(line)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.offsets.append(offset)
+        self._index_file.write(array("Q", [offset]).tobytes())
+        self._index_file.flush()
+        if message == CLEAR:
+            self.start = len(self.offsets)
+        return len(self) - 1
+
+    def extend(self, messages: List[Dict]):
+        for message in messages:
+            self.append(message)
+
+    def clear(self):
+        self.append(CLEAR)
+
+    def tail(self, n: Optional[int] = None) -> List[Dict]:
+        start = 0 if n is None else max(len(self) - n, 0)
+        return [self[i] for i in range(start, len(self))]
+
+    def compact(self, keep_last: Optional[int] = None):
+        # Rewrite the log with only the current conversation (or its last
+        # keep_last messages). Written to a temporary file and swapped in, so
+        # a crash halfway leaves the old log intact.
+        messages = self.tail(keep_last)
+        tmp_path = f"{self.path}.tmp"
+        offsets = array("Q")
+        with open(tmp_path, "wb") as f:
+            for message in messages:
+                offsets.append(f.tell())
+                f.write(json.dumps(message).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._close_files()
+        os.replace(tmp_path, self.path)
+        with open(self.index_path, "wb") as f:
+            f.write(offsets.tobytes())
+        self._file = open(self.path, "ab+")
+        self._load_index()
+
+    def close(self):
+        self._close_files()
+
+    def _line(self, position: int) -> bytes:
+        size = os.fstat(self._file.fileno()).st_size
+        if self._map is None or self._map_size != size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_size = size
+        start = self.offsets[position]
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else size
+        return self._map[start:end]
+
+    def _load_index(self):
+        size = os.fstat(self._file.fileno()).st_size
+        offsets = array("Q")
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+        if not self._index_matches(offsets, size):
+            offsets = self._scan()
+            with open(self.index_path, "wb") as f:
+                f.write(offsets.tobytes())
+        self.offsets = offsets
+        self.start = 0
+        for position in range(len(offsets) - 1, -1, -1):
+            if self._is_clear(position):
+                self.start = position + 1
+                break
+        self._index_file = open(self.index_path, "ab")
+
+    def _index_matches(self, offsets: array, size: int) -> bool:
+        # The last indexed line must end exactly at the end of the file
+        if not offsets:
+            return size == 0
+        if offsets[-1] >= size:
+            return False
+        self._file.seek(offsets[-1])
+        last = self._file.readline()
+        return offsets[-1] + len(last) == size and last.endswith(b"\n")
+
+    def _scan(self) -> array:
+        offsets = array("Q")
+        self._file.seek(0)
+        offset = 0
+        for line in self._file:
+            if not line.endswith(b"\n"):
+                # Torn write from a crash: drop it
+                self._file.truncate(offset)
+                break
+            offsets.append(offset)
+            offset += len(line)
+        return offsets
+
+    def _is_clear(self, position: int) -> bool:
+        line = self._line(position)
+        return b'"clear"' in line and json.loads(line) == CLEAR
+
+    def _close_files(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+        self._file.close()
+
+
+def is_json_array(path: str) -> bool:
+    # Old /save files are one JSON array; anything else is a message log
+    with open(path, "rb") as f:
+        return f.read(64).lstrip()[:1] == b"["
+
+
+def import_json_history(path: str) -> List[Dict]:
+    # Histories saved by the old /save: one JSON array of messages
+    with open(path) as f:
+        return json.load(f)
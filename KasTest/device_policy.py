@@ -0,0 +1,144 @@
+import os
+import threading
+from dataclasses import dataclass, replace
+from typing import Optional
+
+# Where local weights live and in what precision. On a GPU / Apple machine the
+# old fp16 defaults are kept; on a CPU-only box fp16 matmuls are slow (or
+# missing), so weights load in bf16 when the CPU has native bf16 support and
+# fp32 otherwise, with int8 dynamic quantization of the Linear layers as an
+# opt-in. The policy can be set from the environment:
+#
+#   LLAMA_DEVICE=cpu LLAMA_PRECISION=int8 LLAMA_THREADS=8 python main.py
+#
+# or at runtime with set_policy() (/precision in the chat REPL).
+
+PRECISIONS = ("auto", "float32", "bfloat16", "float16", "int8")
+ALIASES = {"fp32": "float32", "bf16": "bfloat16", "fp16": "float16", "qint8": "int8"}
+
+
+@dataclass(frozen=True)
+class DevicePolicy:
+    device: Optional[str] = None      # "cpu", "mps", "auto" (accelerate device map), None to detect
+    precision: str = "auto"           # one of PRECISIONS
+    threads: Optional[int] = None     # intra-op threads, None for every core we may run on
+    interop_threads: int = 1          # one generate() at a time per model, so keep this small
+
+
+def normalise_precision(precision: str) -> str:
+    precision = ALIASES.get(precision.lower(), precision.lower())
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {', '.join(PRECISIONS)}")
+    return precision
+
+
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def cpu_supports_bf16() -> bool:
+    # Native bf16 dot products (AVX512-BF16 or AMX); emulated bf16 is slower than fp32
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def detect_device() -> str:
+    import torch
+
+    if torch.cuda.is_available():
+        return "auto"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def policy_from_env() -> DevicePolicy:
+    threads = os.environ.get("LLAMA_THREADS")
+    return DevicePolicy(
+        device=os.environ.get("LLAMA_DEVICE") or None,
+        precision=normalise_precision(os.environ.get("LLAMA_PRECISION", "auto")),
+        threads=int(threads) if threads else None,
+    )
+
+
+_policy = policy_from_env()
+_threads_configured = False
+_lock = threading.Lock()
+
+
+def current_policy() -> DevicePolicy:
+    return _policy
+
+
+def set_policy(**changes) -> DevicePolicy:
+    # Changes apply to models loaded from now on; loaded ones keep their key
+    global _policy, _threads_configured
+    if "precision" in changes:
+        changes["precision"] = normalise_precision(changes["precision"])
+    with _lock:
+        _policy = replace(_policy, **changes)
+        if "threads" in changes:
+            _threads_configured = False
+    return _policy
+
+
+def resolve(model_id: str, dtype=None, device: Optional[str] = None, policy: Optional[DevicePolicy] = None):
+    # (dtype, device) for a load. dtype is a torch dtype name, or "int8" for
+    # fp32 weights with dynamically quantized Linear layers.
+    from tiny_model import is_tiny_model
+
+    policy = policy or _policy
+    device = device or policy.device or detect_device()
+    if dtype is not None:
+        return str(dtype).replace("torch.", ""), device
+    precision = policy.precision
+    if precision == "int8" and device != "cpu":
+        # Dynamic quantization only has CPU kernels
+        precision = "auto"
+    if precision != "auto":
+        return precision, device
+    if device != "cpu":
+        return "float16", device
+    if is_tiny_model(model_id):
+        return "float32", device
+    return ("bfloat16" if cpu_supports_bf16() else "float32"), device
+
+
+def configure_threads(policy: Optional[DevicePolicy] = None):
+    # torch only accepts the interop setting before its first parallel region,
+    # so this runs once per process, right before the first model load
+    global _threads_configured
+    import torch
+
+    policy = policy or _policy
+    with _lock:
+        if _threads_configured:
+            return
+        _threads_configured = True
+        torch.set_num_threads(policy.threads or available_cores())
+        try:
+            torch.set_num_interop_threads(policy.interop_threads)
+        except RuntimeError:
+            pass
+
+
+def quantize_int8(model):
+    # Weights of every nn.Linear stored as int8, activations quantized on the
+    # fly; roughly a quarter of the fp32 memory for the big matmuls
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def describe(policy: Optional[DevicePolicy] = None) -> str:
+    import torch
+
+    policy = policy or _policy
+    return (f"device={policy.device or detect_device()} precision={policy.precision} "
+            f"threads={torch.get_num_threads()} interop={torch.get_num_interop_threads()}")
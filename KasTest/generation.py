@@ -0,0 +1,139 @@
+from typing import List, Optional
+
+import torch
+
+from instrumentation import metrics
+from kv_cache import cache_layers, crop_layers, make_cache, prefix_cache_for
+
+
+def model_device(model) -> torch.device:
+    # Where input ids have to go: the embedding's device, which with an
+    # accelerate device map is not necessarily where the first parameter is
+    embeddings = model.get_input_embeddings() if hasattr(model, "get_input_embeddings") else None
+    if embeddings is not None and getattr(embeddings, "weight", None) is not None:
+        return embeddings.weight.device
+    return next(model.parameters()).device
+
+
+def encode_chat(tokenizer, messages, add_generation_prompt: bool = True) -> torch.Tensor:
+    ids = tokenizer.apply_chat_template(messages, add_generation_prompt=add_generation_prompt, tokenize=True)
+    if hasattr(ids, "input_ids"):
+        ids = ids["input_ids"]
+    return torch.tensor(ids, dtype=torch.long)
+
+
+def generate(handle, input_ids: torch.Tensor, max_new_tokens: int = 256, use_prefix_cache: bool = True,
+             pin_prefix: Optional[int] = None, **generation_kwargs) -> torch.Tensor:
+    # Generate from a 1-D prompt and return only the new token ids. With the
+    # prefix cache on, the longest previously seen prefix of the prompt is
+    # reused and only the remaining tokens are prefilled. pin_prefix marks the
+    # first N tokens (e.g. a bot's persona block) as worth keeping around.
+    model, tokenizer = handle.model, handle.tokenizer
+    device = model_device(model)
+    input_ids = input_ids.cpu()
+    prompt_length = len(input_ids)
+
+    prefix_cache = prefix_cache_for(handle) if use_prefix_cache else None
+    past_key_values = None
+    if prefix_cache is not None:
+        cached_length, layers = prefix_cache.lookup(input_ids)
+        # generate() needs at least one uncached token to produce logits from
+        cached_length = min(cached_length, prompt_length - 1)
+        if cached_length > 0:
+            past_key_values = make_cache(crop_layers(layers, cached_length))
+
+    # With metrics on, a streamer that only notes when the first token lands
+    # splits the call into prefill and decode
+    timer = metrics.timer(backend="local", model=handle.model_id) if "streamer" not in generation_kwargs else None
+    if timer:
+        generation_kwargs["streamer"] = timer
+    with torch.no_grad():
+        output = model.generate(
+            input_ids=input_ids[None].to(device),
+            attention_mask=torch.ones(1, prompt_length, dtype=torch.long, device=device),
+            past_key_values=past_key_values,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+            return_dict_in_generate=True,
+            **generation_kwargs,
+        )
+
+    if prefix_cache is not None and output.past_key_values is not None:
+        layers = cache_layers(output.past_key_values)
+        if pin_prefix:
+            prefix_cache.store(input_ids[:pin_prefix], layers, pinned=True)
+        prefix_cache.store(input_ids, layers)
+
+    if timer:
+        timer.finish(tokens_in=prompt_length, tokens_out=output.sequences.shape[-1] - prompt_length)
+    return output.sequences[0, prompt_length:]
+
+
+def prefill(handle, input_ids: torch.Tensor, pin_prefix: Optional[int] = None,
+            replace: Optional[torch.Tensor] = None) -> int:
+    # Run the prompt through the model only to fill the prefix cache, so a
+    # later generate() on it (or on a longer prompt) starts warm. Returns the
+    # number of tokens that actually had to be computed. replace: an earlier
+    # prefill this one supersedes, whose cache entry is dropped.
+    model = handle.model
+    device = model_device(model)
+    input_ids = input_ids.cpu()
+    prefix_cache = prefix_cache_for(handle)
+    cached_length, layers = prefix_cache.lookup(input_ids)
+    if cached_length >= len(input_ids):
+        return 0
+    past_key_values = make_cache(crop_layers(layers, cached_length)) if cached_length else None
+    positions = torch.arange(cached_length, len(input_ids), device=device)
+    # The base model skips the LM head: no logits are needed, only the cache
+    with torch.no_grad(), metrics.span("warm", backend="local", model=handle.model_id):
+        output = model.base_model(
+            input_ids=input_ids[None, cached_length:].to(device),
+            past_key_values=past_key_values,
+            position_ids=positions[None],
+            cache_position=positions,
+            use_cache=True,
+        )
+    layers = cache_layers(output.past_key_values)
+    if pin_prefix:
+        prefix_cache.store(input_ids[:pin_prefix], layers, pinned=True)
+    # The layers are new tensors holding exactly the prompt, so no copy
+    prefix_cache.store(input_ids, layers, copy=False, replace=replace)
+    return len(input_ids) - cached_length
+
+
+def generate_batch(handle, prompts: List[torch.Tensor], max_new_tokens: int = 256, **generation_kwargs) -> List[torch.Tensor]:
+    # Left-pad several 1-D prompts into one batch and run a single generate()
+    # call. Returns each row's new tokens, cut at the first end-of-sequence.
+    model, tokenizer = handle.model, handle.tokenizer
+    device = model_device(model)
+    pad_token_id = tokenizer.pad_token_id or tokenizer.eos_token_id
+    width = max(len(ids) for ids in prompts)
+
+    input_ids = torch.full((len(prompts), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(prompts), width), dtype=torch.long)
+    for row, ids in enumerate(prompts):
+        input_ids[row, width - len(ids):] = ids
+        attention_mask[row, width - len(ids):] = 1
+
+    with torch.no_grad(), metrics.span("generate_batch", backend="local", model=handle.model_id, rows=len(prompts)):
+        sequences = model.generate(
+            input_ids=input_ids.to(device),
+            attention_mask=attention_mask.to(device),
+            max_new_tokens=max_new_tokens,
+            pad_token_id=pad_token_id,
+            **generation_kwargs,
+        )
+
+    stop_ids = set(eos_ids(model, tokenizer)) | {pad_token_id}
+    outputs = []
+    for row in sequences[:, width:].cpu():
+        ends = [i for i, token in enumerate(row.tolist()) if token in stop_ids]
+        outputs.append(row[:ends[0]] if ends else row)
+    return outputs
+
+
+def eos_ids(model, tokenizer) -> List[int]:
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        eos = tokenizer.eos_token_id
+    return list(eos) if isinstance(eos, (list, tuple)) else [eos]
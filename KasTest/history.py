@@ -0,0 +1,100 @@
+from collections import deque
+from typing import Callable, Dict, Iterator, List, Optional
+
+DEFAULT_HISTORY_TOKENS = 2048
+
+
+def default_history_tokens(handle) -> int:
+    # Leave most of the model's context for the persona block and the reply
+    config = getattr(handle, "config", None) or handle.model.config
+    context = getattr(config, "max_position_embeddings", None) or 4 * DEFAULT_HISTORY_TOKENS
+    return min(DEFAULT_HISTORY_TOKENS, context // 4)
+
+
+class WordTokenizer:
+    # Stand-in for sandpits where no bot runs a local model (all API or fake
+    # backends): one token per whitespace-separated word, which is close
+    # enough for trimming the history to a budget
+    def __call__(self, text: str, add_special_tokens: bool = False) -> Dict[str, List[str]]:
+        return {"input_ids": text.split()}
+
+    def decode(self, ids: List[str]) -> str:
+        return " ".join(ids)
+
+
+class ChatHistory:
+    # Ring buffer of chat messages trimmed by a token budget (and optionally a
+    # message count). Token counts are computed once per message and the
+    # "person: content" transcript is kept pre-rendered, so appending a message
+    # only renders and counts that message. on_evict(entry, line) is called for
+    # every message trimmed off the front (e.g. to move it into long-term memory).
+
+    def __init__(self, tokenizer, max_tokens: int = DEFAULT_HISTORY_TOKENS, max_messages: Optional[int] = None,
+                 on_evict: Optional[Callable[[Dict, str], None]] = None):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.on_evict = on_evict
+        self.tokens = 0
+        self.transcript = ""
+        self._entries = deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[Dict]:
+        return (entry for entry, _, _ in self._entries)
+
+    def __getitem__(self, index) -> Dict:
+        return self._entries[index][0]
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def append(self, person: str, content: str):
+        line = f"{person}: {content}\n"
+        tokens = self.count_tokens(line)
+        if tokens > self.max_tokens:
+            line, tokens = self._truncate(person, content)
+        self._entries.append(({"person": person, "content": content}, line, tokens))
+        self.tokens += tokens
+        self.transcript += line
+        self._trim()
+
+    def preview(self, person: str, content: str) -> str:
+        # The transcript append() would leave, without changing anything (e.g.
+        # for prefilling the next prompt while a reply is still coming in)
+        line = f"{person}: {content}\n"
+        tokens = self.count_tokens(line)
+        if tokens > self.max_tokens:
+            line, tokens = self._truncate(person, content)
+        tokens, count, start = self.tokens + tokens, len(self._entries) + 1, 0
+        for _, old_line, old_tokens in self._entries:
+            if count == 1 or not (tokens > self.max_tokens or (self.max_messages is not None and count > self.max_messages)):
+                break
+            tokens, count, start = tokens - old_tokens, count - 1, start + len(old_line)
+        return self.transcript[start:] + line
+
+    def clear(self):
+        self._entries.clear()
+        self.tokens = 0
+        self.transcript = ""
+
+    def _trim(self):
+        while len(self._entries) > 1 and (
+            self.tokens > self.max_tokens
+            or (self.max_messages is not None and len(self._entries) > self.max_messages)
+        ):
+            entry, line, tokens = self._entries.popleft()
+            self.tokens -= tokens
+            self.transcript = self.transcript[len(line):]
+            if self.on_evict is not None:
+                self.on_evict(entry, line)
+
+    def _truncate(self, person: str, content: str):
+        # A single message over budget (e.g. a long seed prompt) keeps only its
+        # most recent tokens so it can't blow up every later prompt
+        ids = self.tokenizer(content, add_special_tokens=False)["input_ids"]
+        keep = max(self.max_tokens - self.count_tokens(f"{person}: ...\n"), 1)
+        line = f"{person}: ...{self.tokenizer.decode(ids[-keep:])}\n"
+        return line, self.count_tokens(line)
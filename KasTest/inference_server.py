@@ -0,0 +1,571 @@
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from types import SimpleNamespace
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import torch
+
+from generation import eos_ids, model_device
+from instrumentation import metrics
+from kv_cache import cache_layers, crop_layers, make_cache, prefix_cache_for
+from model_registry import DEFAULT_MODEL, load_tokenizer, registry
+from rendering import AsyncTokenStreamer
+from sliding_window import sample_token
+from stopping import build_criteria
+
+# One loaded model serving many generations at once. Requests queue up, get
+# prefilled in chunks on their own KV cache (reusing the model's prefix cache),
+# then join a running batch; every decode step advances all active requests by
+# one token, and finished ones leave the batch without waiting for the rest
+# (continuous batching). Runs in process, or as a worker on a Unix socket:
+#
+#   python inference_server.py --model meta-llama/Llama-3.2-1B-Instruct --socket /tmp/llama.sock
+#
+# Clients come from connect(). LLAMA_SERVER=local shares one in-process server
+# per model between every chat session and bot; LLAMA_SERVER=/tmp/llama.sock
+# talks to the worker. Unset, callers run generate() themselves as before.
+
+DEFAULT_MAX_BATCH = 8
+DEFAULT_PREFILL_CHUNK = 512
+DEFAULT_MAX_QUEUE = 64
+
+
+@dataclass
+class ServerRequest:
+    input_ids: List[int]
+    max_new_tokens: int = 256
+    temperature: Optional[float] = None  # None for the model's generation config
+    top_p: Optional[float] = None
+    stop: Dict = field(default_factory=dict)  # build_criteria() keyword arguments
+    pin_prefix: Optional[int] = None  # prompt tokens worth pinning in the prefix cache
+
+
+class Ticket:
+    # A submitted request; cancel() drops it at the next step
+    def __init__(self, request: ServerRequest, sink):
+        self.request = request
+        self.sink = sink
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class QueueSink:
+    # Blocking iterator over one request's token ids
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def put(self, ids: List[int]):
+        self.queue.put(ids)
+
+    def end(self):
+        self.queue.put(None)
+
+    def fail(self, error: BaseException):
+        self.queue.put(error)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+class AsyncSink(AsyncTokenStreamer):
+    # Same hand-off to an event loop, for ids coming from the engine thread
+    def put(self, ids: List[int]):
+        ids = [token for token in ids if token not in self.skip_ids]
+        if ids:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, ids)
+
+
+class Sequence:
+    def __init__(self, ticket: Ticket, criteria, temperature: float, top_p: Optional[float]):
+        request = ticket.request
+        self.ticket = ticket
+        self.sink = ticket.sink
+        self.criteria = criteria
+        self.temperature = temperature
+        self.top_p = top_p
+        self.prompt_length = len(request.input_ids)
+        # Prompt and reply in one preallocated row, for the stopping criteria
+        self.ids = torch.empty(self.prompt_length + request.max_new_tokens, dtype=torch.long)
+        self.ids[:self.prompt_length] = torch.tensor(request.input_ids, dtype=torch.long)
+        self.length = self.prompt_length
+        self.cached = 0  # tokens whose keys/values are in the cache
+        self.layers = None  # own cache while prefilling
+        self.logits = None  # next-token logits
+
+    @property
+    def generated(self) -> int:
+        return self.length - self.prompt_length
+
+
+class BatchEngine:
+    # The scheduling loop. Owns the batched KV cache: per layer
+    # [rows, heads, width, head_dim], rows left-padded to a common width with
+    # the padding masked out, and each row's own positions for the rotary
+    # embedding so padding never shifts a sequence.
+
+    def __init__(self, handle, max_batch: int = DEFAULT_MAX_BATCH, prefill_chunk: int = DEFAULT_PREFILL_CHUNK,
+                 max_queue: int = DEFAULT_MAX_QUEUE):
+        self.handle = handle
+        self.model, self.tokenizer = handle.model, handle.tokenizer
+        self.device = model_device(self.model)
+        self.eos = set(eos_ids(self.model, self.tokenizer))
+        self.prefix_cache = prefix_cache_for(handle)
+        self.max_batch = max_batch
+        self.prefill_chunk = prefill_chunk
+        # Bounded, so a flood of requests blocks the submitters instead of memory
+        self.incoming: queue.Queue = queue.Queue(max_queue)
+        self.waiting: deque = deque()
+        self.rows: List[Sequence] = []
+        self.layers = None
+        self.mask = None
+        self.steps = 0
+        self.tokens = 0
+        self.labels = {"backend": "server", "model": handle.model_id}
+        self._wake = threading.Event()
+        self._stopped = False
+        # Only the last position's logits are needed; older transformers
+        # versions compute them for the whole chunk
+        parameters = inspect.signature(self.model.forward).parameters
+        self._keep_last = next(({name: 1} for name in ("logits_to_keep", "num_logits_to_keep") if name in parameters), {})
+
+    def submit(self, request: ServerRequest, sink, timeout: Optional[float] = None) -> Ticket:
+        ticket = Ticket(request, sink)
+        self.incoming.put(ticket, timeout=timeout)
+        self._wake.set()
+        return ticket
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def run(self):
+        while not self._stopped:
+            self._wake.clear()
+            self._admit()
+            if not self.rows and not self.waiting:
+                self._wake.wait()
+                continue
+            try:
+                if self.waiting:
+                    self._prefill(self.waiting[0])
+                if self.rows:
+                    self._decode()
+            except Exception as e:
+                self._fail_all(e)
+
+    def _admit(self):
+        while len(self.rows) + len(self.waiting) < self.max_batch:
+            try:
+                ticket = self.incoming.get_nowait()
+            except queue.Empty:
+                return
+            if ticket.cancelled:
+                ticket.sink.end()
+                continue
+            request = ticket.request
+            config = self.model.generation_config
+            sampling = bool(config.do_sample)
+            temperature = request.temperature if request.temperature is not None else (config.temperature if sampling else 0.0)
+            top_p = request.top_p if request.top_p is not None else (config.top_p if sampling else None)
+            try:
+                criteria = build_criteria(self.tokenizer, len(request.input_ids), **request.stop)
+            except Exception as e:
+                ticket.sink.fail(e)
+                continue
+            self.waiting.append(Sequence(ticket, criteria, temperature or 0.0, top_p))
+
+    def _forward(self, input_ids, layers, positions, attention_mask=None):
+        past = layers[0][0].shape[-2] if layers else 0
+        with torch.no_grad():
+            output = self.model(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask,
+                past_key_values=make_cache(layers) if layers else None,
+                position_ids=positions.to(self.device),
+                cache_position=torch.arange(past, past + input_ids.shape[1], device=self.device),
+                use_cache=True,
+                **self._keep_last,
+            )
+        return output.logits[:, -1], cache_layers(output.past_key_values)
+
+    def _prefill(self, seq: Sequence):
+        # One chunk per loop iteration, so a long prompt doesn't stall the
+        # decode steps of the running batch
+        if seq.ticket.cancelled:
+            self.waiting.popleft()
+            seq.sink.end()
+            return
+        if seq.cached == 0:
+            cached, layers = self.prefix_cache.lookup(seq.ids[:seq.prompt_length])
+            cached = min(cached, seq.prompt_length - 1)
+            if cached > 0:
+                seq.layers, seq.cached = crop_layers(layers, cached), cached
+        end = min(seq.cached + self.prefill_chunk, seq.prompt_length)
+        positions = torch.arange(seq.cached, end)[None]
+        with metrics.span("prefill_chunk", **self.labels):
+            logits, seq.layers = self._forward(seq.ids[None, seq.cached:end], seq.layers, positions)
+        metrics.count("prefill_tokens", end - seq.cached, **self.labels)
+        seq.cached = end
+        if end < seq.prompt_length:
+            return
+
+        prompt = seq.ids[:seq.prompt_length]
+        pin_prefix = seq.ticket.request.pin_prefix
+        if pin_prefix:
+            self.prefix_cache.store(prompt[:pin_prefix], seq.layers, pinned=True)
+        self.prefix_cache.store(prompt, seq.layers)
+        seq.logits = logits[0]
+        self.waiting.popleft()
+        self._join(seq)
+
+    def _join(self, seq: Sequence):
+        layers, seq.layers = seq.layers, None
+        mask = torch.ones(1, seq.cached, dtype=torch.long, device=self.device)
+        if not self.rows:
+            self.layers, self.mask = layers, mask
+        else:
+            width = max(self.mask.shape[1], seq.cached)
+            self.layers = [
+                (torch.cat((_left_pad(bk, width), _left_pad(k, width))), torch.cat((_left_pad(bv, width), _left_pad(v, width))))
+                for (bk, bv), (k, v) in zip(self.layers, layers)
+            ]
+            self.mask = torch.cat((_left_pad(self.mask, width, dim=1), _left_pad(mask, width, dim=1)))
+        self.rows.append(seq)
+
+    def _decode(self):
+        # Sample every row's next token, retire finished rows, then advance
+        # the rest with one batched forward pass
+        keep = []
+        for i, seq in enumerate(self.rows):
+            if seq.ticket.cancelled:
+                seq.sink.end()
+                continue
+            token = sample_token(seq.logits, seq.temperature, seq.top_p)
+            if token in self.eos:
+                seq.sink.end()
+                continue
+            seq.ids[seq.length] = token
+            seq.length += 1
+            self.tokens += 1
+            seq.sink.put([token])
+            if seq.generated >= seq.ticket.request.max_new_tokens or self._should_stop(seq):
+                seq.sink.end()
+                continue
+            keep.append(i)
+
+        if len(keep) < len(self.rows):
+            self._retain(keep)
+        if not self.rows:
+            return
+
+        input_ids = torch.tensor([[int(seq.ids[seq.length - 1])] for seq in self.rows])
+        positions = torch.tensor([[seq.cached] for seq in self.rows])
+        self.mask = torch.cat((self.mask, torch.ones(len(self.rows), 1, dtype=torch.long, device=self.device)), dim=1)
+        with metrics.span("decode_step", **self.labels):
+            logits, self.layers = self._forward(input_ids, self.layers, positions, self.mask)
+        metrics.count("tokens_out", len(self.rows), **self.labels)
+        metrics.gauge("batch_rows", len(self.rows), **self.labels)
+        metrics.gauge("queued", len(self.waiting) + self.incoming.qsize(), **self.labels)
+        for seq, row_logits in zip(self.rows, logits):
+            seq.logits = row_logits
+            seq.cached += 1
+        self.steps += 1
+
+    def _should_stop(self, seq: Sequence) -> bool:
+        if seq.criteria is None:
+            return False
+        return bool(seq.criteria(seq.ids[None, :seq.length], seq.logits[None]).reshape(-1)[0])
+
+    def _retain(self, keep: List[int]):
+        self.rows = [self.rows[i] for i in keep]
+        if not keep:
+            self.layers, self.mask = None, None
+            return
+        index = torch.tensor(keep, device=self.device)
+        mask = self.mask.index_select(0, index)
+        # Drop padding columns no remaining row needs
+        first = int(mask.sum(0).nonzero()[0])
+        self.mask = mask[:, first:]
+        self.layers = [
+            (k.index_select(0, index)[..., first:, :], v.index_select(0, index)[..., first:, :])
+            for k, v in self.layers
+        ]
+
+    def _fail_all(self, error: Exception):
+        for seq in list(self.rows) + list(self.waiting):
+            seq.sink.fail(error)
+        self.rows, self.layers, self.mask = [], None, None
+        self.waiting.clear()
+
+
+def _left_pad(tensor: torch.Tensor, width: int, dim: int = -2) -> torch.Tensor:
+    missing = width - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat((tensor.new_zeros(shape), tensor), dim=dim)
+
+
+class InferenceServer:
+    # A registry handle plus the engine thread driving it
+
+    def __init__(self, model: str = DEFAULT_MODEL, max_batch: int = DEFAULT_MAX_BATCH,
+                 prefill_chunk: int = DEFAULT_PREFILL_CHUNK, max_queue: int = DEFAULT_MAX_QUEUE):
+        self.handle = registry.acquire(model)
+        self.engine = BatchEngine(self.handle, max_batch, prefill_chunk, max_queue)
+        self.thread = threading.Thread(target=self.engine.run, name=f"inference {model}", daemon=True)
+        self.thread.start()
+        self._socket_server = None
+
+    def submit(self, request: ServerRequest, sink) -> Ticket:
+        return self.engine.submit(request, sink)
+
+    def info(self) -> Dict:
+        config = self.handle.model.config
+        return {
+            "model": self.handle.model_id,
+            "max_position_embeddings": getattr(config, "max_position_embeddings", None),
+            "active": len(self.engine.rows),
+            "waiting": len(self.engine.waiting) + self.engine.incoming.qsize(),
+            "steps": self.engine.steps,
+            "tokens": self.engine.tokens,
+        }
+
+    def serve(self, path: str):
+        if os.path.exists(path):
+            os.unlink(path)
+        self._socket_server = socketserver.ThreadingUnixStreamServer(path, _RequestHandler)
+        self._socket_server.daemon_threads = True
+        self._socket_server.inference = self
+        print(f'serving {self.handle.model_id} on {path}')
+        try:
+            self._socket_server.serve_forever()
+        finally:
+            self._socket_server.server_close()
+            os.unlink(path)
+
+    def close(self):
+        if self._socket_server is not None:
+            self._socket_server.shutdown()
+        self.engine.stop()
+        self.thread.join()
+        registry.release(self.handle)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # Newline-delimited JSON: {"op": "info"} or {"request": {...}}, answered
+    # with {"ids": [...]} lines and a final {"done": true} or {"error": "..."}
+
+    def handle(self):
+        server = self.server.inference
+        for line in self.rfile:
+            message = json.loads(line)
+            if message.get("op") == "info":
+                self.send(server.info())
+                continue
+            sink = QueueSink()
+            ticket = server.submit(ServerRequest(**message["request"]), sink)
+            try:
+                try:
+                    for ids in sink:
+                        self.send({"ids": ids})
+                except (BrokenPipeError, ConnectionResetError):
+                    raise
+                except Exception as e:
+                    self.send({"error": str(e)})
+                    continue
+                self.send({"done": True})
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away; stop spending decode steps on it
+                ticket.cancel()
+                return
+
+    def send(self, message: Dict):
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+        self.wfile.flush()
+
+
+@dataclass
+class RemoteHandle:
+    # Stands in for a ModelHandle when the weights live in another process
+    key: tuple
+    tokenizer: object
+    config: object
+    model: object = None
+    prefix_cache: object = None
+
+    @property
+    def model_id(self) -> str:
+        return self.key[0]
+
+
+class LocalClient:
+    def __init__(self, server: InferenceServer):
+        self.server = server
+        self.handle = server.handle
+
+    def stream(self, request: ServerRequest) -> Iterator[List[int]]:
+        # Submits right away; token ids arrive while iterating
+        sink = QueueSink()
+        return self._iterate(sink, self.server.submit(request, sink))
+
+    async def astream(self, request: ServerRequest, skip_ids=()) -> AsyncIterator[List[int]]:
+        sink = AsyncSink(asyncio.get_running_loop(), skip_ids)
+        # A full queue blocks submit(); wait for room off the event loop
+        ticket = await asyncio.to_thread(self.server.submit, request, sink)
+        try:
+            async for ids in sink:
+                yield ids
+        finally:
+            ticket.cancel()
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _iterate(sink: QueueSink, ticket: Ticket) -> Iterator[List[int]]:
+        try:
+            yield from sink
+        finally:
+            ticket.cancel()
+
+
+class SocketClient:
+    def __init__(self, path: str, model: Optional[str] = None):
+        self.path = path
+        info = self.info()
+        if model and model.split(":", 1)[0] != info["model"]:
+            raise ValueError(f"Server at {path} serves {info['model']}, not {model}")
+        self.handle = RemoteHandle(
+            key=(info["model"], "remote", path),
+            tokenizer=load_tokenizer(info["model"]),
+            config=SimpleNamespace(max_position_embeddings=info["max_position_embeddings"]),
+        )
+
+    def info(self) -> Dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            sock.sendall(json.dumps({"op": "info"}).encode() + b"\n")
+            return json.loads(sock.makefile("rb").readline())
+
+    def stream(self, request: ServerRequest) -> Iterator[List[int]]:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(json.dumps({"request": asdict(request)}).encode() + b"\n")
+        return self._iterate(sock)
+
+    async def astream(self, request: ServerRequest, skip_ids=()) -> AsyncIterator[List[int]]:
+        skip_ids = set(skip_ids)
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        try:
+            writer.write(json.dumps({"request": asdict(request)}).encode() + b"\n")
+            await writer.drain()
+            while True:
+                ids = self._parse(await reader.readline())
+                if ids is None:
+                    return
+                ids = [token for token in ids if token not in skip_ids]
+                if ids:
+                    yield ids
+        finally:
+            writer.close()
+
+    def close(self):
+        pass
+
+    def _iterate(self, sock: socket.socket) -> Iterator[List[int]]:
+        try:
+            for line in sock.makefile("rb"):
+                ids = self._parse(line)
+                if ids is None:
+                    return
+                yield ids
+        finally:
+            sock.close()
+
+    def _parse(self, line: bytes) -> Optional[List[int]]:
+        if not line:
+            raise ConnectionError(f"Inference server at {self.path} closed the connection")
+        message = json.loads(line)
+        if "error" in message:
+            raise RuntimeError(message["error"])
+        return message.get("ids")
+
+
+_target = os.environ.get("LLAMA_SERVER") or None
+_local_servers: Dict[str, InferenceServer] = {}
+_local_lock = threading.Lock()
+
+
+def server_target() -> Optional[str]:
+    return _target
+
+
+def set_server_target(target: Optional[str]):
+    # "local", a socket path, or None to generate without a server
+    global _target
+    _target = None if target in (None, "", "off") else target
+
+
+def local_server(model: str = DEFAULT_MODEL) -> InferenceServer:
+    with _local_lock:
+        if model not in _local_servers:
+            _local_servers[model] = InferenceServer(model)
+        return _local_servers[model]
+
+
+def shutdown_local_servers():
+    with _local_lock:
+        for server in _local_servers.values():
+            server.close()
+        _local_servers.clear()
+
+
+def connect(model: str = DEFAULT_MODEL, target: Optional[str] = None):
+    # A client for the configured server, or None when there isn't one
+    target = target or _target
+    if not target:
+        return None
+    if target == "local":
+        return LocalClient(local_server(model))
+    return SocketClient(target, model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local model to chat sessions and sandpits")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--socket", default="/tmp/llama.sock")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH)
+    parser.add_argument("--prefill-chunk", type=int, default=DEFAULT_PREFILL_CHUNK)
+    parser.add_argument("--max-queue", type=int, default=DEFAULT_MAX_QUEUE)
+    args = parser.parse_args()
+
+    server = InferenceServer(args.model, args.max_batch, args.prefill_chunk, args.max_queue)
+    try:
+        server.serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+# Timing spans, counters and gauges for the generation hot paths:
+#   spans    tokenize, prefill, first_token, decode, render, network, ...
+#   counters tokens_in, tokens_out, cache_hits, cache_misses, ...
+#   gauges   memory (refreshed whenever a snapshot is taken)
+# each labelled by backend/model/bot. scope(bot=...) adds labels to everything
+# recorded inside it, across asyncio tasks and to_thread workers.
+#
+# Off unless LLAMA_METRICS=1 or /stats on. While off, span() and scope() hand
+# back one shared no-op context manager and count()/observe() return after a
+# single attribute check, and timer() returns None, so a streaming loop pays
+# one `if timer` per chunk. Spans sit around whole requests, prefill chunks
+# and decode steps, not individual tokens.
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_scope: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("metric_labels", default={})
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class SpanStats:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name: str, labels: Labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._observe(self.name, time.perf_counter() - self.start, self.labels)
+        return False
+
+
+class _Scope:
+    __slots__ = ("labels", "token")
+
+    def __init__(self, labels: Dict[str, str]):
+        self.labels = labels
+
+    def __enter__(self):
+        self.token = _scope.set({**_scope.get(), **self.labels})
+        return self
+
+    def __exit__(self, *exc):
+        _scope.reset(self.token)
+        return False
+
+
+def _labels(labels: Dict) -> Labels:
+    merged = {**_scope.get(), **labels}
+    return tuple(sorted((k, str(v)) for k, v in merged.items() if v is not None))
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.spans: Dict[Tuple[str, Labels], SpanStats] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        # Called before every snapshot to refresh gauges (memory, cache sizes)
+        self.collectors: List[Callable[["Metrics"], None]] = [memory_gauges]
+        self.started = time.time()
+        self.profile = None
+        self._lock = threading.Lock()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def scope(self, **labels):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Scope({k: str(v) for k, v in labels.items() if v is not None})
+
+    def span(self, name: str, **labels):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name, _labels(labels))
+
+    def timer(self, first_span: str = "prefill", **labels) -> Optional["StreamTimer"]:
+        # None while off; callers guard their per-chunk mark() with `if timer`
+        if not self.enabled:
+            return None
+        return StreamTimer(self, first_span, labels)
+
+    def observe(self, name: str, seconds: float, **labels):
+        # For intervals measured by hand (e.g. prompt to first token)
+        if self.enabled:
+            self._observe(name, seconds, _labels(labels))
+
+    def count(self, name: str, value: float = 1, **labels):
+        if self.enabled:
+            key = (name, _labels(labels))
+            with self._lock:
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        if self.enabled:
+            with self._lock:
+                self.gauges[(name, _labels(labels))] = value
+
+    def _observe(self, name: str, seconds: float, labels: Labels):
+        with self._lock:
+            stats = self.spans.get((name, labels))
+            if stats is None:
+                stats = self.spans[(name, labels)] = SpanStats()
+            stats.add(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.counters.clear()
+            self.gauges.clear()
+            self.started = time.time()
+
+    def snapshot(self) -> Dict:
+        for collect in self.collectors:
+            collect(self)
+        with self._lock:
+            return {
+                "time": time.time(),
+                "since": self.started,
+                "spans": [
+                    {"name": name, "labels": dict(labels), "count": s.count, "total": s.total,
+                     "mean": s.total / s.count, "max": s.max}
+                    for (name, labels), s in sorted(self.spans.items())
+                ],
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.counters.items())],
+                "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.gauges.items())],
+            }
+
+    def report(self) -> str:
+        # The /stats table: one line per span and counter
+        snapshot = self.snapshot()
+        elapsed = snapshot["time"] - snapshot["since"]
+        lines = [f"metrics {'on' if self.enabled else 'off'}, {elapsed:.0f}s"]
+        for span in snapshot["spans"]:
+            lines.append(f"  {span['name']:<12} {_format_labels(span['labels']):<48} n={span['count']:<5} "
+                         f"mean={span['mean'] * 1000:8.1f}ms max={span['max'] * 1000:8.1f}ms total={span['total']:.2f}s")
+        for kind in ("counters", "gauges"):
+            for item in snapshot[kind]:
+                lines.append(f"  {item['name']:<12} {_format_labels(item['labels']):<48} {item['value']:,.15g}")
+        tokens_out = sum(c["value"] for c in snapshot["counters"] if c["name"] == "tokens_out")
+        decode = sum(s["total"] for s in snapshot["spans"] if s["name"] == "decode")
+        if tokens_out and decode:
+            lines.append(f"  decode throughput {tokens_out / decode:.1f} tok/s")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        # Text exposition format, e.g. for node_exporter's textfile collector
+        snapshot = self.snapshot()
+        lines = []
+        for span in snapshot["spans"]:
+            labels = _prometheus_labels(span["labels"])
+            lines.append(f"llama_{span['name']}_seconds_count{labels} {span['count']}")
+            lines.append(f"llama_{span['name']}_seconds_sum{labels} {span['total']:.6f}")
+            lines.append(f"llama_{span['name']}_seconds_max{labels} {span['max']:.6f}")
+        for counter in snapshot["counters"]:
+            lines.append(f"llama_{counter['name']}_total{_prometheus_labels(counter['labels'])} {counter['value']:.15g}")
+        for gauge in snapshot["gauges"]:
+            lines.append(f"llama_{gauge['name']}{_prometheus_labels(gauge['labels'])} {gauge['value']:.15g}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        # .prom files are replaced whole; anything else gets a JSONL line
+        if path.endswith(".prom"):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.prometheus())
+            os.replace(tmp_path, path)
+        else:
+            with open(path, "a") as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+    def start_profile(self, turns: int, path: str = "profile_trace.json"):
+        if self.profile is not None:
+            # Only one torch profiler can run at a time
+            self.profile.profiler.stop()
+        self.profile = ProfileCapture(turns, path)
+        self.profile.start()
+
+    def end_turn(self) -> Optional[str]:
+        # Called once per reply; returns the profile summary when a capture ends
+        if self.profile is None:
+            return None
+        summary = self.profile.step()
+        if summary is not None:
+            self.profile = None
+        return summary
+
+    def stop_profile(self) -> Optional[str]:
+        # Ends a capture before its turns are up (e.g. the run finished
+        # first), still writing the trace of what it saw
+        profile, self.profile = self.profile, None
+        return profile.finish() if profile is not None else None
+
+
+class StreamTimer:
+    # Times one reply: start to first token goes to first_span ("prefill"),
+    # first to last token to "decode", plus tokens_in / tokens_out. Also works
+    # as a generate() streamer, skipping the prompt like the real ones do.
+    def __init__(self, metrics: Metrics, first_span: str, labels: Dict):
+        self.metrics = metrics
+        self.first_span = first_span
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.first: Optional[float] = None
+        self.tokens = 0
+        self._prompt_seen = False
+
+    def mark(self, tokens: int = 1):
+        if self.first is None:
+            self.first = time.perf_counter()
+        self.tokens += tokens
+
+    def put(self, value):
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        self.mark(value.numel())
+
+    def end(self):
+        pass
+
+    def finish(self, tokens_in: Optional[int] = None, tokens_out: Optional[int] = None):
+        metrics, labels = self.metrics, self.labels
+        if self.first is not None:
+            metrics.observe(self.first_span, self.first - self.start, **labels)
+            metrics.observe("decode", time.perf_counter() - self.first, **labels)
+        if tokens_in is not None:
+            metrics.count("tokens_in", tokens_in, **labels)
+        metrics.count("tokens_out", self.tokens if tokens_out is None else tokens_out, **labels)
+
+
+async def timed_stream(chunks: AsyncIterator[str], **labels) -> AsyncIterator[str]:
+    # What the user sees: request to first chunk ("first_token") and the
+    # whole reply, whatever the backend does inside
+    start = time.perf_counter()
+    first = True
+    async for chunk in chunks:
+        if first:
+            metrics.observe("first_token", time.perf_counter() - start, **labels)
+            first = False
+        yield chunk
+    metrics.observe("reply", time.perf_counter() - start, **labels)
+    metrics.count("replies", **labels)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    return " ".join(f"{k}={v}" for k, v in labels.items())
+
+
+def _prometheus_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="{v}"'.replace("\n", " ") for k, v in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def memory_gauges(metrics: Metrics):
+    try:
+        with open("/proc/self/statm") as f:
+            metrics.gauge("memory_rss_bytes", int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError):
+        pass
+    # Only ask torch if something already imported it
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        metrics.gauge("memory_cuda_bytes", torch.cuda.memory_allocated())
+        metrics.gauge("memory_cuda_peak_bytes", torch.cuda.max_memory_allocated())
+
+
+class MetricsDump:
+    # Writes metrics.write(path) every interval seconds from a daemon thread
+    def __init__(self, metrics: Metrics, path: str, interval: float = 10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-dump", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.metrics.write(self.path)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.metrics.write(self.path)
+
+
+class ProfileCapture:
+    # torch.profiler over the next `turns` replies; writes a Chrome trace
+    # (chrome://tracing, Perfetto) and returns the top ops by self CPU time
+    def __init__(self, turns: int, path: str = "profile_trace.json"):
+        self.turns = turns
+        self.path = path
+        self.profiler = None
+
+    def start(self):
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.profiler = profile(activities=activities)
+        self.profiler.start()
+
+    def step(self) -> Optional[str]:
+        self.turns -= 1
+        if self.turns > 0:
+            return None
+        return self.finish()
+
+    def finish(self) -> str:
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(self.path)
+        table = self.profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=15)
+        return f"profile written to {self.path}\n{table}"
+
+
+metrics = Metrics(enabled=os.environ.get("LLAMA_METRICS", "") not in ("", "0"))
+
+_dump: Optional[MetricsDump] = None
+
+
+def start_dump(path: str, interval: float = 10.0):
+    global _dump
+    stop_dump()
+    _dump = MetricsDump(metrics, path, interval)
+
+
+def stop_dump():
+    global _dump
+    if _dump is not None:
+        _dump.stop()
+        _dump = None
+
+
+if os.environ.get("LLAMA_METRICS_DUMP"):
+    metrics.enable()
+    start_dump(os.environ["LLAMA_METRICS_DUMP"], float(os.environ.get("LLAMA_METRICS_INTERVAL", 10)))
@@ -0,0 +1,143 @@
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import torch
+
+from instrumentation import metrics
+
+# Per-layer (key, value) tensors shaped [batch, heads, seq, head_dim]
+Layers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+DEFAULT_PREFIX_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def cache_layers(cache) -> Layers:
+    # transformers has moved the cache internals around a few times
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers if getattr(layer, "keys", None) is not None]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v in cache]
+
+
+def make_cache(layers: Layers):
+    from transformers import DynamicCache
+
+    cache = DynamicCache()
+    for idx, (k, v) in enumerate(layers):
+        cache.update(k, v, idx)
+    return cache
+
+
+def layers_length(layers: Layers) -> int:
+    return layers[0][0].shape[-2] if layers else 0
+
+
+def layers_nbytes(layers: Layers) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+def crop_layers(layers: Layers, length: int, copy: bool = False) -> Layers:
+    cropped = [(k[..., :length, :], v[..., :length, :]) for k, v in layers]
+    if copy:
+        cropped = [(k.clone(), v.clone()) for k, v in cropped]
+    return cropped
+
+
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+class PrefixCache:
+    # LRU store of prompt KV caches for one model. A lookup returns the cached
+    # layers for the longest stored prefix of the prompt, so a turn only has to
+    # prefill the tokens after it. Pinned entries (static persona blocks) are
+    # evicted only once every unpinned entry is gone.
+
+    def __init__(self, max_bytes: int = DEFAULT_PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, input_ids: torch.Tensor) -> Tuple[int, Optional[Layers]]:
+        input_ids = input_ids.cpu()
+        with self._lock:
+            best_key, best_len = None, 0
+            for key, entry in self._entries.items():
+                length = common_prefix_length(entry["ids"], input_ids)
+                if length > best_len:
+                    best_key, best_len = key, length
+            if best_key is None:
+                self.misses += 1
+                metrics.count("cache_misses", cache="prefix")
+                return 0, None
+            self.hits += 1
+            metrics.count("cache_hits", cache="prefix")
+            metrics.count("cached_tokens", best_len, cache="prefix")
+            self._entries.move_to_end(best_key)
+            return best_len, crop_layers(self._entries[best_key]["layers"], best_len)
+
+    def store(self, input_ids: torch.Tensor, layers: Layers, pinned: bool = False, copy: bool = True,
+              replace: Optional[torch.Tensor] = None):
+        # copy=False stores the tensors themselves, for layers that hold
+        # exactly these tokens and nothing else holds on to. replace names an
+        # unpinned entry this one supersedes (e.g. the previous prefill of a
+        # reply still streaming), which is dropped.
+        input_ids = input_ids.cpu()
+        key = tuple(input_ids.tolist())
+        with self._lock:
+            if replace is not None:
+                self._drop(tuple(replace.cpu().tolist()), keep=key)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._entries[key]["pinned"] |= pinned
+                return
+        layers = crop_layers(layers, len(input_ids), copy=copy)
+        nbytes = layers_nbytes(layers)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                # Another thread stored the same prefix while these were cropped
+                self._entries.move_to_end(key)
+                self._entries[key]["pinned"] |= pinned
+                return
+            self._entries[key] = {"ids": input_ids, "layers": layers, "nbytes": nbytes, "pinned": pinned}
+            self.nbytes += nbytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _drop(self, key: tuple, keep: tuple):
+        entry = self._entries.get(key)
+        if key != keep and entry is not None and not entry["pinned"]:
+            del self._entries[key]
+            self.nbytes -= entry["nbytes"]
+
+    def _evict(self):
+        for pinned in (False, True):
+            for key in [k for k, e in self._entries.items() if e["pinned"] == pinned]:
+                if self.nbytes <= self.max_bytes:
+                    return
+                self.nbytes -= self._entries.pop(key)["nbytes"]
+
+
+def prefix_cache_for(handle, max_bytes: int = DEFAULT_PREFIX_CACHE_BYTES) -> PrefixCache:
+    # One cache per loaded model, shared by every bot holding the handle
+    if handle.prefix_cache is None:
+        handle.prefix_cache = PrefixCache(max_bytes)
+    return handle.prefix_cache
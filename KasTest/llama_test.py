@@ -1,27 +1,89 @@
+import asyncio
 import torch
-from transformers import pipeline
 from termcolor import colored
+import sys
 import time
 import textwrap
+from pathlib import Path
+
+from model_registry import registry, DEFAULT_MODEL
+from kv_cache import common_prefix_length
+from backends import GenerationRequest, LlamaBackend, create_backend, remote_model
+from generation import encode_chat, generate, generate_batch, prefill
+from inference_server import ServerRequest, connect, shutdown_local_servers
+from history import DEFAULT_HISTORY_TOKENS, ChatHistory, WordTokenizer, default_history_tokens
+from instrumentation import metrics
+from memory import PersonaMemory, get_embedder
+from rendering import AsyncTokenStreamer, IncrementalDecoder, StreamerGroup
+from sandpit_log import SandpitLog, read_log
+from response_cache import cache_key
+from stopping import AllCriteria, PerRowCriteria, build_criteria, trim_reply
+from transformers import StoppingCriteriaList
 
 class Autobot:
-    def __init__(self, name, persona, color):
+    def __init__(self, name, persona, color, model=DEFAULT_MODEL, instructions=None, server=None, backend=None):
         self.name = name
         self.persona = persona
         self.color = color
+        self.instructions = instructions or []
+        self.max_new_tokens = 256
+        # Stop decoding early instead of generating text that gets thrown away:
+        # after max_sentences sentences, when another participant's "NAME:"
+        # shows up, or when the reply starts repeating an n-gram
+        self.max_sentences = 2
+        self.stop_on_names = True
+        self.repetition_ngram = 6
+        # Extra keyword arguments for model.generate (sampling, streamers, ...)
+        self.generation_kwargs = {}
+        # Replies that can't change (greedy, or sampled with a fixed seed) are
+        # served from this ResponseCache when set; seed reseeds every turn
+        self.response_cache = None
+        self.seed = None
+        # PersonaMemory of messages that fell out of the chat history; the
+        # Sandpit sets one up, shared by its bots, when it runs with memory_k > 0
+        self.memory = None
+        self.memory_query_lines = 2
         
-        # Setup the model
-        device_map = "mps" if torch.backends.mps.is_available() else "auto"
-        self.pipe = pipeline(
-            "text-generation",
-            model="meta-llama/Llama-3.2-1B-Instruct",
-            torch_dtype=torch.float16,
-            device_map=device_map,
-            # pad_token_id=2,
-        )
+        # Setup the model, shared with every other bot running the same weights.
+        # With an inference server ("local", a socket path, or LLAMA_SERVER)
+        # the bot sends it requests instead of running generate() itself.
+        # Any other Backend can speak for the bot instead: pass one, or name a
+        # model it serves ("claude-...", "gpt-...", "fake:tps=30"). Those bots
+        # have no handle and only stream text; a LlamaBackend lends its handle,
+        # so its bot works like any other local one.
+        if backend is None and remote_model(model):
+            backend = create_backend(model)
+        self.backend = backend
+        self.client = None
+        if isinstance(backend, LlamaBackend):
+            self.handle = backend.load()
+        elif backend is not None:
+            self.handle = None
+        else:
+            self.client = connect(model, server)
+            self.handle = self.client.handle if self.client is not None else registry.acquire(model)
+        self._static_ids = {}
+
+    @property
+    def local(self):
+        # Runs generate() in this process, so it can prefill ahead of its turn
+        return self.handle is not None and self.client is None
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        elif isinstance(self.backend, LlamaBackend):
+            self.backend.unload()
+        elif self.handle is not None:
+            registry.release(self.handle)
+        self.handle = None
     
-    def respond(self, chat_history, sandpit_friends, max_history):
-        system_prompt = f"""You are {self.name}.
+    def static_prompt(self, sandpit_friends):
+        # Everything before the chat history; identical every turn, so its KV
+        # cache is pinned and reused
+        extra_instructions = "".join(f"        - {line}\n" for line in self.instructions)
+        return f"""You are {self.name}.
         Your custom prompt: {self.persona}
         Your friends are: Kaspar, Raphael, and {', '.join(sandpit_friends)}
 
@@ -30,64 +92,604 @@ class Autobot:
         - Do NOT include your name in the response
         - Do NOT generate responses for other participants
         - Do NOT repeat previous messages
-        - Explain one thought concisely in 2 sentences or less
+{extra_instructions}        - Explain one thought concisely in 2 sentences or less
         - Do not summarise. Engage by adding a single clear new idea to the conversation
         - Your goal is to work together to arrive at a conclusion. There is a correct answer you are working towards.
 
-        Chat history (last {max_history} messages):
         """
-        for entry in chat_history:
-            person = entry["person"]
-            content = entry["content"]
-            system_prompt += f"{person}: {content}\n"
-        system_prompt += f"\nRESPOND as {self.name}:"
+
+    def static_length(self, static_prompt, input_ids):
+        if static_prompt not in self._static_ids:
+            self._static_ids[static_prompt] = encode_chat(
+                self.handle.tokenizer,
+                [{"role": "system", "content": static_prompt}],
+                add_generation_prompt=False,
+            )
+        return common_prefix_length(self._static_ids[static_prompt], input_ids)
+
+    def build_prompt(self, transcript, sandpit_friends, max_history, recall=None):
+        # transcript is the pre-rendered "person: content" chat history;
+        # memories are recalled from recall instead when it is given
+        static_prompt = self.static_prompt(sandpit_friends)
+        memories = self.memory_section(transcript if recall is None else recall)
+        system_prompt = static_prompt + memories + self.history_prompt(transcript, max_history)
 
         # Construct messages from chat history
         messages = [
             {"role": "system", "content": system_prompt}
         ]
-        response = self.pipe(messages, max_new_tokens=256)
-        
+        with metrics.span("tokenize"):
+            input_ids = encode_chat(self.handle.tokenizer, messages)
+        return input_ids, self.static_length(static_prompt, input_ids)
+
+    def history_prompt(self, transcript, max_history):
+        return f"Chat history (last {max_history} messages):\n        {transcript}\nRESPOND as {self.name}:"
+
+    def backend_request(self, transcript, sandpit_friends, max_history):
+        # The same prompt for a Backend: persona and memories as the system
+        # prompt (or in front, where the backend has none), history as the message
+        system = self.static_prompt(sandpit_friends) + self.memory_section(transcript)
+        prompt = self.history_prompt(transcript, max_history)
+        if not self.backend.capabilities.system_prompt:
+            system, prompt = "", system + prompt
+        options = {"seed": self.seed, "max_tokens": self.max_new_tokens}
+        if self.generation_kwargs.get("do_sample") is False:
+            options["temperature"] = 0.0
+        elif self.generation_kwargs.get("temperature") is not None:
+            options["temperature"] = self.generation_kwargs["temperature"]
+        return GenerationRequest(prompt=prompt, system=system, **options)
+
+    def memory_section(self, transcript):
+        # The few evicted messages closest to what's being discussed now;
+        # after the static part, so the pinned prefix doesn't change
+        if not self.memory:
+            return ""
+        query = "\n".join(transcript.splitlines()[-self.memory_query_lines:])
+        with metrics.span("memory_recall"):
+            recalled = self.memory.recall(query)
+        memories = "".join(f"        - {line}\n" for line in recalled)
+        return f"Your memories of earlier in the conversation:\n{memories}\n        " if memories else ""
+
+    def stop_names(self, sandpit_friends, speakers=()):
+        # Everyone else who could show up as "NAME:" in the conversation
+        if not self.stop_on_names:
+            return []
+        return sorted((set(sandpit_friends) | {"Kaspar", "Raphael"} | set(speakers)) - {self.name})
+
+    def stopping_criteria(self, prompt_length, stop_names):
+        return build_criteria(
+            self.handle.tokenizer,
+            prompt_length,
+            max_sentences=self.max_sentences,
+            stop_names=stop_names,
+            repetition_ngram=self.repetition_ngram,
+        )
+
+    def generate_kwargs(self, criteria):
+        kwargs = dict(self.generation_kwargs)
+        if criteria is not None:
+            kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
+        return kwargs
+
+    def server_request(self, input_ids, static_length, stop_names):
+        greedy = self.generation_kwargs.get("do_sample") is False
+        return ServerRequest(
+            input_ids=input_ids.tolist(),
+            max_new_tokens=self.max_new_tokens,
+            temperature=0.0 if greedy else self.generation_kwargs.get("temperature"),
+            top_p=self.generation_kwargs.get("top_p"),
+            stop={
+                "max_sentences": self.max_sentences,
+                "stop_names": stop_names,
+                "repetition_ngram": self.repetition_ngram,
+            },
+            pin_prefix=static_length,
+        )
+
+    def submit(self, transcript, sandpit_friends, max_history, speakers=()):
+        # Send the turn to the inference server; returns the token id stream
+        # (already running) and the stop names for finish()
+        input_ids, static_length = self.build_prompt(transcript, sandpit_friends, max_history)
+        stop_names = self.stop_names(sandpit_friends, speakers)
+        return self.client.stream(self.server_request(input_ids, static_length, stop_names)), stop_names
+
+    def response_key(self, input_ids, stop_names):
+        if self.response_cache is None:
+            return None
+        kwargs = {k: v for k, v in self.generation_kwargs.items() if k not in ("streamer", "stopping_criteria")}
+        greedy = kwargs.get("do_sample") is False or kwargs.get("temperature") == 0
+        # The server samples every request from one shared generator, so only
+        # greedy replies from it are repeatable
+        if not greedy and (self.seed is None or self.client is not None):
+            return None
+        return cache_key(
+            backend="autobot",
+            model=self.handle.model_id,
+            prompt=input_ids.tolist(),
+            generation=kwargs,
+            max_new_tokens=self.max_new_tokens,
+            stop=[self.max_sentences, stop_names, self.repetition_ngram],
+            seed=None if greedy else self.seed,
+        )
+
+    def warm(self, transcript, sandpit_friends, max_history, recall=None, replace=None):
+        # Fill the prefix cache for this transcript without generating.
+        # Returns the prompt ids, which a later warm() can replace
+        if not self.local:
+            return None
+        input_ids, static_length = self.build_prompt(transcript, sandpit_friends, max_history, recall)
+        prefill(self.handle, input_ids, pin_prefix=static_length, replace=replace)
+        return input_ids
+
+    def respond(self, transcript, sandpit_friends, max_history, speakers=()):
+        if self.handle is None:
+            # A backend streams on an event loop; run one for this turn
+            return asyncio.run(self._arespond_once(transcript, sandpit_friends, max_history, speakers))
+        # Everything timed during the turn is labelled with this bot
+        with metrics.scope(bot=self.name):
+            return self._respond(transcript, sandpit_friends, max_history, speakers)
+
+    def _respond(self, transcript, sandpit_friends, max_history, speakers=()):
+        input_ids, static_length = self.build_prompt(transcript, sandpit_friends, max_history)
+        stop_names = self.stop_names(sandpit_friends, speakers)
+        key = self.response_key(input_ids, stop_names)
+        cached = self.response_cache.get(key) if key else None
+        if cached is not None:
+            return self.finish(cached["ids"], stop_names)
+
+        if self.seed is not None:
+            torch.manual_seed(self.seed)
+        if self.client is not None:
+            timer = metrics.timer(backend="llama-server", model=self.handle.model_id)
+            output_ids = []
+            for ids in self.client.stream(self.server_request(input_ids, static_length, stop_names)):
+                if timer:
+                    timer.mark(len(ids))
+                output_ids.extend(ids)
+            if timer:
+                timer.finish(tokens_in=len(input_ids))
+        else:
+            output_ids = generate(
+                self.handle,
+                input_ids,
+                max_new_tokens=self.max_new_tokens,
+                pin_prefix=static_length,
+                **self.generate_kwargs(self.stopping_criteria(len(input_ids), stop_names)),
+            ).tolist()
+        if key:
+            self.response_cache.put(key, {"ids": output_ids})
+        return self.finish(output_ids, stop_names)
+
+    async def _arespond_once(self, transcript, sandpit_friends, max_history, speakers=()):
+        try:
+            return await self.arespond(transcript, sandpit_friends, max_history, speakers)
+        finally:
+            # API clients belong to the loop that is about to close
+            await self.backend.aclose()
+
+    async def arespond(self, transcript, sandpit_friends, max_history, speakers=(), on_text=None, recall=None):
+        # respond() for the event loop: the reply streams while other tasks
+        # (API bots, prefills) run, and on_text(reply so far) sees it grow
+        with metrics.scope(bot=self.name):
+            stop_names = self.stop_names(sandpit_friends, speakers)
+            if self.handle is None:
+                request = await asyncio.to_thread(self.backend_request, transcript, sandpit_friends, max_history)
+                text = ""
+                async for chunk in self.backend.stream(request):
+                    text += chunk
+                    if on_text is not None:
+                        on_text(text)
+                return self.finish_text(text, stop_names)
+
+            input_ids, static_length = await asyncio.to_thread(
+                self.build_prompt, transcript, sandpit_friends, max_history, recall
+            )
+            key = self.response_key(input_ids, stop_names)
+            cached = self.response_cache.get(key) if key else None
+            if cached is not None:
+                return self.finish(cached["ids"], stop_names)
+
+            output_ids, text = [], ""
+            decoder = IncrementalDecoder(self.handle.tokenizer)
+            async for ids in self.astream_ids(input_ids, static_length, stop_names):
+                output_ids.extend(ids)
+                if on_text is not None:
+                    text += decoder.push(ids)
+                    on_text(text)
+            if key:
+                self.response_cache.put(key, {"ids": output_ids})
+            return self.finish(output_ids, stop_names)
+
+    async def astream_ids(self, input_ids, static_length, stop_names):
+        # The reply's token ids as they are generated, special tokens left out
+        if self.client is not None:
+            timer = metrics.timer(backend="llama-server", model=self.handle.model_id)
+            async for ids in self.client.astream(self.server_request(input_ids, static_length, stop_names),
+                                                 skip_ids=self.handle.tokenizer.all_special_ids):
+                if timer:
+                    timer.mark(len(ids))
+                yield ids
+            if timer:
+                timer.finish(tokens_in=len(input_ids))
+            return
+
+        streamer = AsyncTokenStreamer(asyncio.get_running_loop(), skip_ids=self.handle.tokenizer.all_special_ids)
+        kwargs = self.generate_kwargs(self.stopping_criteria(len(input_ids), stop_names))
+        kwargs["streamer"] = StreamerGroup(kwargs["streamer"], streamer) if "streamer" in kwargs else streamer
+
+        def run():
+            try:
+                if self.seed is not None:
+                    torch.manual_seed(self.seed)
+                generate(self.handle, input_ids, max_new_tokens=self.max_new_tokens, pin_prefix=static_length, **kwargs)
+            except Exception as e:
+                streamer.fail(e)
+
+        # generate() leaves timing to the caller when it is given a streamer
+        timer = metrics.timer(backend="local", model=self.handle.model_id)
+        worker = asyncio.ensure_future(asyncio.to_thread(run))
+        async for ids in streamer:
+            if timer:
+                timer.mark(len(ids))
+            yield ids
+        await worker
+        if timer:
+            timer.finish(tokens_in=len(input_ids))
+
+    def finish(self, output_ids, stop_names=()):
         # Extract just the assistant's response content
         try:
-            response_text = response[0]["generated_text"][-1].get("content")
+            response_text = self.handle.tokenizer.decode(output_ids, skip_special_tokens=True)
+            return self.finish_text(response_text, stop_names)
+        except Exception as e:
+            return "Sorry, I had trouble forming a response."
+
+    def finish_text(self, response_text, stop_names=()):
+        try:
+            response_text = trim_reply(response_text, self.name, stop_names)
             wrapped_text = textwrap.fill(f"{self.name}: {response_text}", width=120)
-            print(colored(wrapped_text, self.color))
+            with metrics.span("render", bot=self.name):
+                print(colored(wrapped_text, self.color))
             return response_text
         except Exception as e:
             return "Sorry, I had trouble forming a response."
 
+class PipelinedPrefill:
+    # While a bot's reply streams in, the bot speaking next prefills its
+    # prompt up to the text so far: the history as it will be once the reply
+    # is recorded, cut off where the reply has got to. By the time the reply
+    # is done its prefix cache holds all but the last few tokens. One prefill
+    # runs at a time, after at least min_chars more of the reply; each starts
+    # from the entry the last one left and replaces it.
+    #
+    # Memories sit before the history in the prompt, so they are recalled
+    # from the history as it was before the reply (for the prefills and for
+    # the turn itself); recalling from the partial reply would change them,
+    # and with them everything prefilled after.
+    def __init__(self, sandpit, speaker, bots, min_chars):
+        self.sandpit = sandpit
+        self.speaker = speaker
+        self.bots = bots
+        self.min_chars = min_chars
+        self.stop_names = speaker.stop_names(sandpit.friends(speaker), sandpit.speakers)
+        self.recall = sandpit.chat_history.transcript
+        self.stored = {}
+        self.done = 0
+        self.task = None
+
+    def update(self, text):
+        if len(text) - self.done < self.min_chars or (self.task is not None and not self.task.done()):
+            return
+        self.done = len(text)
+        reply = trim_reply(text, self.speaker.name, self.stop_names)
+        transcript = self.sandpit.chat_history.preview(self.speaker.name, reply)
+        self.task = asyncio.ensure_future(asyncio.to_thread(self.prefill, transcript))
+
+    def prefill(self, transcript):
+        for bot in self.bots:
+            try:
+                self.stored[bot] = bot.warm(transcript, self.sandpit.friends(bot), self.sandpit.max_history,
+                                            recall=self.recall, replace=self.stored.get(bot))
+            except Exception as e:
+                # Only a head start: the bot's own turn prefills whatever is missing
+                print(f"Prefill ahead of {bot.name} failed ({type(e).__name__}: {e})")
+
+    async def close(self):
+        # The next turn starts once the last prefill has stored its cache
+        if self.task is not None:
+            await self.task
+
 class Sandpit:
-    def __init__(self):
+    # Round modes:
+    #   sequential   - each bot sees every reply before it (the original behaviour)
+    #   simultaneous - every bot answers the same history snapshot in one batch
+    #   mixed        - bots go in groups of batch_size; a group shares a snapshot
+    #                  and later groups see the earlier groups' replies
+    ROUND_MODES = ("sequential", "simultaneous", "mixed")
+
+    def __init__(self, history_tokens=None, memory_k=0, embedding_model=None):
         self.autobots = []
-        self.chat_history = []
+        self.chat_history = None
         self.max_history = 10
+        # Token budget for the chat history; defaults to what the smallest
+        # model context among the bots allows
+        self.history_tokens = history_tokens
+        # With memory_k > 0 the messages trimmed off the history go into a
+        # PersonaMemory, and every bot gets the memory_k most relevant to its
+        # turn back (embedding_model=None uses the default encoder, "hashing"
+        # the dependency-free fallback)
+        self.memory_k = memory_k
+        self.embedding_model = embedding_model
+        # A lone speaker's reply is streamed, and every prefill_every characters
+        # of it the next local bots prefill what has arrived; 0 turns this off
+        self.prefill_every = 64
+        # Where a prefilled bot's turn recalls its memories from (see
+        # PipelinedPrefill)
+        self.recall_from = {}
+        self.round_times = []
+        self.speakers = []
+        # Called as on_message(round_num, speaker, content) for every message,
+        # the opening one included (round 0)
+        self.on_message = None
+        self.log = None
     
     def add_autobot(self, autobot):
         self.autobots.append(autobot)
+
+    def close(self):
+        # Hand the bots' model handles back to the registry
+        for bot in self.autobots:
+            bot.close()
+
+    def friends(self, bot):
+        return [b.name for b in self.autobots if b != bot]
+
+    def tokenizer(self):
+        # Counts the history's tokens: the first local model's tokenizer, or
+        # word counts when every bot runs on an API or fake backend
+        return next((bot.handle.tokenizer for bot in self.autobots if bot.handle is not None), None) or WordTokenizer()
+
+    def round_groups(self, mode="sequential", batch_size=None):
+        if mode == "sequential":
+            size = 1
+        elif mode == "simultaneous":
+            size = len(self.autobots)
+        elif mode == "mixed":
+            size = batch_size or 2
+        else:
+            raise ValueError(f"Unknown round mode: {mode}")
+        size = max(size, 1)
+        return [self.autobots[i:i + size] for i in range(0, len(self.autobots), size)]
+
+    def respond_together(self, bots):
+        # Every bot in the group answers the current history snapshot
+        friends = {bot: self.friends(bot) for bot in bots}
+        if len(bots) > 1 and all(bot.client is not None for bot in bots):
+            # Submit every turn at once; the server batches them itself
+            pending = [bot.submit(self.chat_history.transcript, friends[bot], self.max_history, self.speakers) for bot in bots]
+            return [
+                bot.finish([token for ids in tokens for token in ids], stop_names)
+                for bot, (tokens, stop_names) in zip(bots, pending)
+            ]
+        if len(bots) == 1:
+            bot = bots[0]
+            return [bot.respond(self.chat_history.transcript, friends[bot], self.max_history, self.speakers)]
+        if any(bot.handle is None for bot in bots):
+            # Backend bots answer one at a time here (arespond_together()
+            # streams them concurrently); the local ones still batch
+            local = [bot for bot in bots if bot.handle is not None]
+            responses = dict(zip(local, self.respond_together(local) if local else []))
+            for bot in bots:
+                if bot.handle is None:
+                    responses[bot] = bot.respond(self.chat_history.transcript, friends[bot], self.max_history,
+                                                 self.speakers)
+            return [responses[bot] for bot in bots]
+        stop_names = {bot: bot.stop_names(friends[bot], self.speakers) for bot in bots}
+
+        # Only bots sharing the same weights can go through one generate call
+        batches = {}
+        for bot in bots:
+            batches.setdefault(bot.handle.key, []).append(bot)
+
+        outputs = {}
+        for batch in batches.values():
+            prompts = [bot.build_prompt(self.chat_history.transcript, friends[bot], self.max_history)[0] for bot in batch]
+            if len(batch) == 1:
+                bot = batch[0]
+                criteria = bot.stopping_criteria(len(prompts[0]), stop_names[bot])
+                outputs[bot] = generate(
+                    bot.handle, prompts[0], max_new_tokens=bot.max_new_tokens, **bot.generate_kwargs(criteria)
+                )
+                continue
+            max_new_tokens = max(bot.max_new_tokens for bot in batch)
+            # Each row keeps its own bot's stopping criteria; the rest of the
+            # generation settings come from the first bot in the batch
+            width = max(len(ids) for ids in prompts)
+            criteria = PerRowCriteria([
+                bot.stopping_criteria(width, stop_names[bot]) or AllCriteria([]) for bot in batch
+            ])
+            output_batch = generate_batch(
+                batch[0].handle, prompts, max_new_tokens=max_new_tokens, **batch[0].generate_kwargs(criteria)
+            )
+            for bot, output_ids in zip(batch, output_batch):
+                outputs[bot] = output_ids[:bot.max_new_tokens]
+        return [bot.finish(outputs[bot], stop_names[bot]) for bot in bots]
+
+    async def arespond_together(self, bots, upcoming=()):
+        # respond_together() on the event loop. Bots without a local model
+        # stream from their backends while the local ones decode (batched as
+        # before) on a thread. A lone speaker streams its reply and the local
+        # bots in the upcoming group prefill behind it.
+        transcript = self.chat_history.transcript
+        if len(bots) == 1:
+            bot = bots[0]
+            # Groups of several reply through generate_batch(), which doesn't
+            # read the prefix cache, so only a lone next speaker gets a head start
+            ahead = [b for b in upcoming if b.local] if len(upcoming) == 1 else []
+            pipeline = PipelinedPrefill(self, bot, ahead, self.prefill_every) if ahead and self.prefill_every else None
+            try:
+                response = await bot.arespond(transcript, self.friends(bot), self.max_history, self.speakers,
+                                              on_text=pipeline.update if pipeline else None,
+                                              recall=self.recall_from.pop(bot, None))
+            finally:
+                if pipeline is not None:
+                    await pipeline.close()
+                    self.recall_from.update(dict.fromkeys(ahead, pipeline.recall))
+            return [response]
+
+        local = [bot for bot in bots if bot.handle is not None]
+        tasks = [
+            asyncio.ensure_future(bot.arespond(transcript, self.friends(bot), self.max_history, self.speakers))
+            for bot in bots if bot.handle is None
+        ]
+        try:
+            responses = dict(zip(local, await asyncio.to_thread(self.respond_together, local) if local else []))
+            remote = [bot for bot in bots if bot.handle is None]
+            responses.update(zip(remote, await asyncio.gather(*tasks)))
+        finally:
+            for task in tasks:
+                task.cancel()
+        return [responses[bot] for bot in bots]
     
-    def start_conversation(self, initial_message, rounds=3):
+    def start_conversation(self, initial_message, rounds=3, initial_speaker="GOD", mode="sequential", batch_size=None,
+                           log_path=None):
+        # The sandpit runs on asyncio; these sync entry points start a loop for
+        # it (from async code, await the a* versions instead)
+        asyncio.run(self.astart_conversation(initial_message, rounds, initial_speaker, mode, batch_size, log_path))
+
+    def resume(self, log_path, rounds=None):
+        asyncio.run(self.aresume(log_path, rounds))
+
+    def run_rounds(self, rounds, mode="sequential", batch_size=None, done=0):
+        asyncio.run(self.arun_rounds(rounds, mode, batch_size, done))
+
+    async def astart_conversation(self, initial_message, rounds=3, initial_speaker="GOD", mode="sequential",
+                                  batch_size=None, log_path=None):
+        # With log_path every message goes to a durable log that resume() can
+        # pick up from after a crash or Ctrl-C
+        self.round_groups(mode, batch_size)  # fail on a bad mode before the log is created
+
         # Initialize chat history with the initial prompt
         print("\n=== Starting Conversation ===")
-        self.chat_history = [
-            {"person": "GOD", "content": initial_message}
-        ]
-        print(f"Kaspar: {initial_message}")
-        
-        for round_num in range(rounds):
-            print(f"\n--- Round {round_num + 1} ---")
+        self.reset_history(initial_speaker)
+        if log_path:
+            self.log = SandpitLog(log_path)
+            self.log.start({
+                "bots": [bot.name for bot in self.autobots],
+                "rounds": rounds,
+                "mode": mode,
+                "batch_size": batch_size,
+                "max_history": self.max_history,
+                "history_tokens": self.chat_history.max_tokens,
+            })
+        try:
+            self.record(0, initial_speaker, initial_message)
+            print(f"Kaspar: {initial_message}")
+            await self.arun_rounds(rounds, mode, batch_size)
+        finally:
+            self.close_log()
+
+    async def aresume(self, log_path, rounds=None):
+        # Continue a logged run after its last completed turn. The history is
+        # rebuilt from the log and each bot's prompt cache is refilled with
+        # one prefill, without regenerating anything.
+        header, messages, length = read_log(log_path)
+        if header is None or not messages:
+            raise ValueError(f"{log_path} has no sandpit run to resume")
+        names = [bot.name for bot in self.autobots]
+        if header["bots"] != names:
+            raise ValueError(f"{log_path} was run with bots {header['bots']}, not {names}")
+        self.max_history = header["max_history"]
+        self.history_tokens = self.history_tokens or header["history_tokens"]
+        self.reset_history(messages[0]["speaker"])
+        for message in messages:
+            self.chat_history.append(message["speaker"], message["content"])
+        done = len(messages) - 1
+        rounds = rounds or header["rounds"]
+        print(f"\n=== Resuming Conversation: {done} turns in {log_path} ===")
+        await asyncio.to_thread(self.warm_caches)
+
+        self.log = SandpitLog(log_path)
+        self.log.reopen(length)
+        try:
+            await self.arun_rounds(rounds, header["mode"], header["batch_size"], done=done)
+        finally:
+            self.close_log()
+
+    def reset_history(self, initial_speaker):
+        history_tokens = self.history_tokens or min(
+            (default_history_tokens(bot.handle) for bot in self.autobots if bot.handle is not None),
+            default=DEFAULT_HISTORY_TOKENS,
+        )
+        on_evict = None
+        if self.memory_k:
+            # Every bot heard every message, so they share one memory (one
+            # embedding and one index row per line); each bot queries it per turn
+            memory = PersonaMemory(get_embedder(self.embedding_model), k=self.memory_k)
+            for bot in self.autobots:
+                bot.memory = memory
+            on_evict = self.remember
+        self.chat_history = ChatHistory(self.tokenizer(), history_tokens, self.max_history, on_evict)
+        self.speakers = [initial_speaker]
+        self.round_times = []
+        self.recall_from = {}
+
+    async def arun_rounds(self, rounds, mode="sequential", batch_size=None, done=0):
+        # done turns were already taken (on resume); skip past them, part way
+        # into a round or a group if need be
+        groups = self.round_groups(mode, batch_size)
+        start_round, skip = divmod(done, len(self.autobots))
+        try:
+            for round_num in range(start_round, rounds):
+                print(f"\n--- Round {round_num + 1} ---")
+                round_start = time.perf_counter()
+                for index, group in enumerate(groups):
+                    if skip >= len(group):
+                        skip -= len(group)
+                        continue
+                    group, skip = group[skip:], 0
+                    # Whoever speaks next can prefill while this group replies
+                    if index + 1 < len(groups):
+                        upcoming = groups[index + 1]
+                    else:
+                        upcoming = groups[0] if round_num + 1 < rounds else []
+                    # Get responses from the group using the same chat history
+                    responses = await self.arespond_together(group, upcoming)
+                    for bot, response in zip(group, responses):
+                        self.record(round_num + 1, bot.name, response)
+                        profile = metrics.end_turn()
+                        if profile:
+                            print(profile)
+                self.round_times.append(time.perf_counter() - round_start)
+                metrics.observe("round", self.round_times[-1], mode=mode)
+        finally:
+            # API backends' clients belong to this run's event loop
             for bot in self.autobots:
-                # Get response from bot using full chat history
-                sandpit_friends = [b.name for b in self.autobots if b != bot]
-                response = bot.respond(self.chat_history, sandpit_friends, self.max_history)
-                self.chat_history.append({
-                    "person": bot.name,
-                    "content": response
-                })
-
-                # Trim history to keep only the most recent 10 messages
-                if len(self.chat_history) > self.max_history:
-                    self.chat_history = self.chat_history[-self.max_history:]
+                if bot.backend is not None and bot.backend.capabilities.network:
+                    await bot.backend.aclose()
+
+    def warm_caches(self):
+        # Prefill every bot's next prompt so its first turn after a resume
+        # costs what it would have in the original run
+        for bot in self.autobots:
+            bot.warm(self.chat_history.transcript, self.friends(bot), self.max_history)
+
+    def record(self, round_num, speaker, content):
+        # The history trims itself to the token budget and the most recent 10 messages
+        self.chat_history.append(speaker, content)
+        if self.log is not None:
+            self.log.message(round_num, speaker, content)
+        if self.on_message is not None:
+            self.on_message(round_num, speaker, content)
+
+    def remember(self, entry, line):
+        # Embedded and indexed once, into the memory the bots share
+        self.autobots[0].memory.remember(line)
+
+    def close_log(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
 
 # Usage example:
 if __name__ == "__main__":
@@ -131,7 +733,15 @@ if __name__ == "__main__":
     # sandpit.add_autobot(bo4)
     # sandpit.add_autobot(bo5)
     
-    # Start the conversation
-    sandpit.start_conversation("""
+    # Start the conversation, or continue an interrupted one with --resume
+    log_path = Path(__file__).parent / "sandpit_log.jsonl"
+    try:
+        if "--resume" in sys.argv and log_path.exists():
+            sandpit.resume(log_path)
+        else:
+            sandpit.start_conversation("""
 What is your favourite animal?
-""", rounds=1000)
\ No newline at end of file
+""", rounds=1000, log_path=log_path)
+    finally:
+        sandpit.close()
+        shutdown_local_servers()
@@ -2,32 +2,36 @@ import os
 from prompt_toolkit import PromptSession
 from prompt_toolkit.styles import Style as PromptStyle
 from prompt_toolkit.formatted_text import HTML
-import json
 from datetime import datetime
-from typing import Optional, Dict, List, Union
+from typing import AsyncIterator, Optional, Dict, List
 from rich.theme import Theme
 from rich.console import Console
-from rich.markdown import Markdown
 import asyncio
 import traceback
 from pathlib import Path
 from dotenv import load_dotenv
 import time
 import random
-import threading
 
-from transformers import pipeline
-import torch
-
-import anthropic
-import openai
+# torch, transformers and the provider SDKs are imported on first use so the
+# REPL is ready before any backend has loaded
+from backends import Backend, GenerationRequest, backend_class, create_backend
+from conversation_store import ConversationStore, import_json_history, is_json_array
+from instrumentation import metrics, start_dump, stop_dump, timed_stream
+from providers import ProviderPool
+from response_cache import ResponseCache, cache_key, cached_stream, is_deterministic
+from rendering import StreamRenderer
+from scheduler import Job, scheduler
 
 # Load and immediately verify all env contents
 env_path = Path(__file__).parent.parent / ".env"
 load_dotenv(env_path, override=True)
 
+# Local models keep this conversation's KV cache between turns
+CHAT_SESSION = "chat"
+
 class ChatInterface:
-    def __init__(self):
+    def __init__(self, prewarm: Optional[bool] = None):
         self.console = Console(theme=Theme({
             "user": "green bold",
             "assistant": "cyan bold",
@@ -43,170 +47,292 @@ class ChatInterface:
         
         self.session = PromptSession()
         self.conversation_history: List[Dict] = []
+        # Every message is appended to this log as it arrives (see add_message)
+        self.history_path = "chat_history.jsonl"
+        self.history_load_limit = 200  # /load reads at most this many recent messages
+        self._store: Optional[ConversationStore] = None
+        # Whether this session's messages continue the log's current
+        # conversation (after /load or /clear); until then the first message
+        # starts a new one
+        self._store_joined = False
         self.current_model = "meta-llama/Meta-Llama-3-8B"#"meta-llama/Llama-3.2-1B-Instruct"#"claude-3-5-sonnet-20241022"#"claude-3-opus-20240229"
         self.system_prompt = ""
         self.temperature = 0.7
-        self.loop_running = False
+        self.max_tokens: Optional[int] = None  # None uses each backend's default
+        self.loop_rate: Optional[float] = None  # /loop tokens per second, None for unthrottled
+        self.scheduler = scheduler  # runs /loop jobs; replies preempt them
+        self.backends: Dict[str, Backend] = {}
+        self.fanout_models: List[str] = []
+        self.draft_model: Optional[str] = None  # /draft: small model drafting for the local llama
+        self.seed: Optional[int] = None  # /seed: fixed sampling seed, makes replies cacheable
+        self.response_cache: Optional[ResponseCache] = None  # /cache on
+        self.providers = ProviderPool()
+        self.warm_task: Optional[asyncio.Task] = None  # prefilling a /load-ed conversation
+        # Loading local weights while the user types is opt-in (LLAMA_PREWARM=1),
+        # so sessions that only use API models never load a local model
+        self.prewarm_models = prewarm if prewarm is not None else os.environ.get("LLAMA_PREWARM", "") not in ("", "0")
+        self.prewarm()
 
-    async def send_message_llama(self, message: str, end="\n") -> str:
-        # Setup the model if not already created
-        if not hasattr(self, 'llama_model'):
-            from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
-            
-            device_map = "mps" if torch.backends.mps.is_available() else "auto"
-            print(f'llama device_map: {device_map}')
-            self.llama_tokenizer = AutoTokenizer.from_pretrained(self.current_model)
-            self.llama_tokenizer.pad_token = self.llama_tokenizer.eos_token
-            self.llama_model = AutoModelForCausalLM.from_pretrained(
-                self.current_model,
-                torch_dtype=torch.float16,
-                device_map=device_map
-            )
-            self.streamer = TextIteratorStreamer(self.llama_tokenizer)
-            self.device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
-
-        # Prepare input with proper device placement
-        inputs = self.llama_tokenizer(
-            message,
-            return_tensors="pt",
-            padding=True,
-            add_special_tokens=True
-        )
+    def prewarm(self, model: Optional[str] = None):
+        # Load local weights in the background while the user types
+        model = model or self.current_model
+        if self.prewarm_models and model not in self.backends:
+            try:
+                backend_class(model).prewarm(model)
+            except ValueError:
+                pass
 
-        # Move input tensors to the same device as the model
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        
-        # Setup generation in a separate thread
-        generation_kwargs = {
-            "input_ids": inputs["input_ids"],
-            "attention_mask": inputs["attention_mask"],
-            "streamer": self.streamer,
-            "max_new_tokens": 300,
-            "temperature": self.temperature,
-            "do_sample": True,
-            "pad_token_id": self.llama_tokenizer.pad_token_id or self.llama_tokenizer.eos_token_id,
-        }
-        
-        thread = threading.Thread(target=self.llama_model.generate, kwargs=generation_kwargs)
-        thread.start()
-
-        # Collect and display the streamed output
-        tokens_to_remove = ['<|begin_of_text|>', '<|eot_id|>', '<|end_of_text|>', '|<|eom_id|>', '<|start_header_id|>', ]
-        collected_content = []
-        message_length = len(message)
-        accumulated_text = ""
-
-        for text in self.streamer:
-            # Clean the text before displaying
-            cleaned_text = text
-            for token in tokens_to_remove:
-                cleaned_text = cleaned_text.replace(token, '')
-                
-            if cleaned_text.strip():  # Only process if there's content after cleaning
-                collected_content.append(cleaned_text)
-                accumulated_text += cleaned_text
-                
-                # Only start printing after we've accumulated more than the original message
-                if len(accumulated_text) > message_length:
-                    if not hasattr(self, 'started_printing'):
-                        self.started_printing = True
-                        # Print only the part after the message
-                        self.console.print(accumulated_text[message_length:], end="", style="assistant")
-                    else:
-                        self.console.print(cleaned_text, end="", style="assistant")
-                
-        thread.join()
-        full_response = "".join(collected_content)
-        if full_response.startswith(message):
-            full_response = full_response[len(message):].lstrip()
-
-        self.console.print(end, end="")
-        delattr(self, 'started_printing') if hasattr(self, 'started_printing') else None
-        return full_response
+    def backend(self, model: Optional[str] = None) -> Backend:
+        model = model or self.current_model
+        if model not in self.backends:
+            self.backends[model] = create_backend(model, providers=self.providers)
+        return self.backends[model]
 
-    async def send_message_anthropic(self, message: str) -> str:
-        if not hasattr(self, 'anthropic_client'):
-            self.anthropic_client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
-        response = self.anthropic_client.messages.create(
-            model=self.current_model,
-            messages=[{"role": "user", "content": message}],
+    def ensure_llama(self, model: Optional[str] = None):
+        # Get the local model handle (shared through the registry)
+        backend = self.backend(model)
+        if not backend.capabilities.local:
+            raise ValueError(f"{backend.model} is not a local model")
+        return backend.load()
+
+    def make_request(self, message: str) -> GenerationRequest:
+        return GenerationRequest(
+            prompt=message,
             system=self.system_prompt,
             temperature=self.temperature,
-            max_tokens=1024,
-            stream=True,
+            max_tokens=self.max_tokens,
+            history=self.conversation_history,
+            draft_model=self.draft_model,
+            seed=self.seed,
+            session=CHAT_SESSION,
         )
-        print(f'')
-        # return response.content[0].text
-        collected_content = []
-        for chunk in response:
-            if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
-                chunk_text = chunk.delta.text
-                collected_content.append(chunk_text)
-                self.console.print(chunk_text, end="", style="assistant")
-                # chunk_text = chunk.delta.text
-                # collected_content.append(chunk_text)
-                # self.console.print(chunk_text, end="", style="assistant")
-        
-        full_response = "".join(collected_content)
-        self.console.print()  # New line after streaming completes
-        return full_response
 
-    async def send_message_openai(self, message: str) -> str:
-        if not hasattr(self, 'openai_client'):
-            self.openai_client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        messages = [{"role": "user", "content": message}]
-        if self.system_prompt:
-            messages.insert(0, {"role": "system", "content": self.system_prompt})
-            
-        response = await self.openai_client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=self.temperature,
-            stream=True,
+    def request_key(self, backend: Backend, request: GenerationRequest) -> Optional[str]:
+        # Only requests with a fixed reply are cached, keyed by everything the
+        # backend actually sees
+        capabilities = backend.capabilities
+        if self.response_cache is None or not is_deterministic(request.temperature, request.seed, capabilities.seeded):
+            return None
+        return cache_key(
+            backend=type(backend).__name__,
+            model=backend.model,
+            prompt=request.prompt,
+            system=request.system if capabilities.system_prompt else "",
+            history=request.history if capabilities.multi_turn else [],
+            temperature=request.temperature,
+            max_tokens=request.max_tokens or backend.default_max_tokens,
+            draft_model=request.draft_model if capabilities.local else None,
+            seed=request.seed,
         )
-        # return response.choices[0].message.content
-        collected_content = []
-        async for chunk in response:
-            if chunk.choices:
-                chunk_text = chunk.choices[0].message.content
-                collected_content.append(chunk_text)
-                self.console.print(chunk_text, end="", style="assistant")
-
-        full_response = "".join(collected_content)
-        self.console.print()  # New line after streaming completes
-        return full_response
 
-    async def continuous_generation(self, initial_prompt: str, context_window: int = 200):
-        self.loop_running = True
+    def stream_message(self, message: str, model: Optional[str] = None) -> AsyncIterator[str]:
+        backend = self.backend(model)
+        request = self.make_request(message)
+        key = self.request_key(backend, request)
+        chunks = backend.stream(request)
+        if key is not None:
+            # Hits replay through the same renderer as live replies
+            chunks = cached_stream(self.response_cache, key, chunks)
+        if metrics.enabled:
+            chunks = timed_stream(chunks, model=backend.model)
+        return chunks
+
+    async def print_stream(self, chunks: AsyncIterator[str], end="\n") -> str:
+        # Chunks are written at most once per frame; the reply is joined once
+        renderer = StreamRenderer(self.console, style="assistant")
+        async for chunk_text in chunks:
+            renderer.write(chunk_text)
+        return renderer.close(end)
+
+    async def send_message(self, message: str, model: Optional[str] = None, end="\n") -> str:
+        backend = self.backend(model)
+        if backend.capabilities.network:
+            print(f'')
+        full_response = await self.print_stream(self.stream_message(message, model), end=end)
+        if self.draft_model and getattr(backend, "last_stats", None):
+            self.console.print(str(backend.last_stats), style="system")
+        self.end_turn()
+        return full_response.strip()
+
+    def end_turn(self):
+        profile = metrics.end_turn()
+        if profile:
+            self.console.print(profile, style="system", markup=False)
+
+    async def send_message_llama(self, message: str, end="\n") -> str:
+        return await self.send_message(message, end=end)
+
+    async def send_message_anthropic(self, message: str) -> str:
+        return await self.send_message(message)
+
+    async def send_message_openai(self, message: str) -> str:
+        return await self.send_message(message)
+
+    async def send_message_fanout(self, message: str, models: List[str]) -> Dict[str, str]:
+        # Send one message to several models at once, each streaming into its
+        # own panel. Local llama runs in worker threads and API calls run as
+        # tasks, so the wall time is the slowest model rather than the sum.
+        from rich.columns import Columns
+        from rich.live import Live
+        from rich.panel import Panel
+        from rich.text import Text
+
+        collected = {model: Text() for model in models}
+        status = {model: "..." for model in models}
+
+        def render():
+            return Columns(
+                [Panel(collected[m], title=m, subtitle=status[m], border_style="assistant") for m in models],
+                equal=True,
+                expand=True,
+            )
+
+        async def pump(model):
+            start = time.monotonic()
+            try:
+                async for chunk_text in self.stream_message(message, model):
+                    collected[model].append(chunk_text)
+                status[model] = f"{time.monotonic() - start:.1f}s"
+            except Exception as e:
+                status[model] = f"error: {e}"
+
+        with Live(render(), console=self.console, refresh_per_second=10) as live:
+            tasks = [asyncio.create_task(pump(model)) for model in models]
+            while not all(task.done() for task in tasks):
+                live.update(render())
+                await asyncio.sleep(0.1)
+            live.update(render())
+        self.end_turn()
+
+        return {model: collected[model].plain.strip() for model in models}
+
+    def start_loop(self, initial_prompt: str, context_window: int = 200) -> Job:
+        # A background job on the scheduler. context_window is in tokens: one
+        # model session stays open and the KV cache slides over the last
+        # context_window tokens. The model loads on the scheduler thread.
+        backend, draft_model, temperature = self.backend(), self.draft_model, self.temperature
+
+        def start(job: Job):
+            from model_registry import registry
+            from sliding_window import SlidingWindowStream
+
+            # The job holds its own registry references, so /model can hand
+            # the chat's back (and evict) without pulling the weights out
+            # from under a running loop
+            handles = []
+            try:
+                handles.append(registry.acquire(backend.model))
+                draft = None
+                if draft_model:
+                    draft = registry.acquire(draft_model)
+                    handles.append(draft)
+                stream = SlidingWindowStream(handles[0], window=context_window, temperature=temperature,
+                                             draft_handle=draft)
+                stream.reset(initial_prompt)
+            except BaseException:
+                for handle in handles:
+                    registry.release(handle)
+                raise
+            if draft is not None:
+                job.stats = stream.stats
+
+            def text():
+                try:
+                    yield from stream.text()
+                finally:
+                    for handle in handles:
+                        registry.release(handle)
+
+            return text()
+
+        return self.scheduler.submit(f"loop {initial_prompt!r} on {backend.model}", start, rate=self.loop_rate)
+
+    async def print_job(self, job: Job):
+        print(f'...{job.name}.')
         try:
-            tokens_to_remove = ['<|begin_of_text|>', '<|eot_id|>', '<|end_of_text|>', '<|eom_id|>', '<|start_header_id|>', ]
-            context = initial_prompt
-            print(f'...{initial_prompt}.')
-            while self.loop_running:
-                # print(f'\nsending response:\n\n{context}\n\n')
-                response = await self.send_message_llama(context, end="")
-                # print(f'\nresponse:\n\n{response}\n\n')
-                # remove tokens
-                for token in tokens_to_remove:
-                    response = response.replace(token, '')
-                # print the response
-                context = (context + response)
-                if len(context) > context_window:
-                    context = context[-context_window:]
-                await asyncio.sleep(1)
+            async for text in job.stream():
+                self.console.print(text, end="", style="assistant")
         except Exception as e:
             print(f"\nError in continuous generation: {e}")
         finally:
-            self.loop_running = False
+            if job.stats is not None:
+                self.console.print(f"\n{job.stats}", style="system")
+
+    async def continuous_generation(self, initial_prompt: str, context_window: int = 200):
+        # Runs a loop job in the foreground until it is stopped
+        await self.print_job(self.start_loop(initial_prompt, context_window))
+
+    @property
+    def store(self) -> ConversationStore:
+        # Opened on first use so starting the REPL doesn't touch the disk
+        if self._store is None:
+            self._store = ConversationStore(self.history_path)
+        return self._store
 
-    def save_history(self, filename: str = "chat_history.json"):
-        with open(filename, 'w') as f:
-            json.dump(self.conversation_history, f)
+    def add_message(self, message: Dict):
+        if not self._store_joined:
+            # A new REPL doesn't add to whatever conversation the log held last
+            # time; /load picks that one up instead
+            if len(self.store):
+                self.store.clear()
+            self._store_joined = True
+        self.conversation_history.append(message)
+        self.store.append(message)
 
-    def load_history(self, filename: str = "chat_history.json"):
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                self.conversation_history = json.load(f)
+    def save_history(self, filename: Optional[str] = None):
+        # Messages are already on disk; /save compacts the log down to the
+        # current conversation, /save <file> exports it to another log
+        if filename is None or filename == self.history_path:
+            self.store.compact()
+            return
+        export = ConversationStore(filename)
+        export.clear()
+        export.extend(self.store.tail())
+        export.close()
+
+    def load_history(self, filename: Optional[str] = None):
+        filename = filename or self.history_path
+        if filename == self.history_path:
+            self.conversation_history = self.store.tail(self.history_load_limit)
+        elif os.path.exists(filename):
+            # Another file (a /save export, or the old JSON-array format
+            # whatever its extension) moves into the log as a new conversation
+            if is_json_array(filename):
+                messages = import_json_history(filename)
+            else:
+                store = ConversationStore(filename)
+                messages = store.tail()
+                store.close()
+            self.store.clear()
+            self.store.extend(messages)
+            self.conversation_history = messages[-self.history_load_limit:]
+        else:
+            return
+        self._store_joined = True
+
+    def reset_sessions(self):
+        # The conversation changed under the local models' cached sessions
+        for backend in self.backends.values():
+            if hasattr(backend, "reset_sessions"):
+                backend.reset_sessions()
+
+    async def warm_session(self):
+        # Prefill a loaded conversation while the user types the next message
+        backend = self.backend()
+        if not hasattr(backend, "warm_session"):
+            return
+        try:
+            await asyncio.to_thread(backend.warm_session, CHAT_SESSION, self.system_prompt, self.conversation_history)
+        except Exception as e:
+            self.console.print(f"Could not prefill the loaded conversation: {e}", style="system")
+
+    def cancel_warm(self):
+        # The prefill is for a conversation or model that is going away. Its
+        # thread runs on until the prefill is done; the session lock keeps the
+        # next turn behind it.
+        if self.warm_task is not None:
+            self.warm_task.cancel()
+            self.warm_task = None
 
     def handle_command(self, command: str) -> bool:
         cmd = command.lower().strip()
@@ -214,26 +340,157 @@ class ChatInterface:
             return False
         elif cmd == "/clear-terminal":
             os.system('cls' if os.name == 'nt' else 'clear')
+        elif cmd == "/clear":
+            # Start a new conversation; the log keeps the old one before a clear marker
+            self.cancel_warm()
+            self.conversation_history = []
+            self.store.clear()
+            self._store_joined = True
+            self.reset_sessions()
         elif cmd.startswith("/model "):
-            self.current_model = cmd.split(" ")[1]
+            self.cancel_warm()
+            previous, self.current_model = self.current_model, cmd.split(" ")[1]
+            backend = self.backends.get(previous)
+            if (previous != self.current_model and backend is not None and backend.capabilities.local
+                    and previous not in self.fanout_models):
+                # Hand the old weights back rather than keeping both models loaded
+                from model_registry import registry
+
+                backend.unload()
+                del self.backends[previous]
+                registry.evict_unused()
+            self.prewarm()
+        elif cmd.startswith("/models"):
+            # /models a,b,c fans every message out to several models; /models off stops it
+            models = command.strip().split(" ", 1)[1] if " " in command.strip() else ""
+            self.fanout_models = [m.strip() for m in models.split(",") if m.strip() and m.strip() != "off"]
+        elif cmd.startswith("/draft"):
+            # /draft <model> drafts for the local llama (speculative decoding),
+            # /draft off turns it off, /draft alone shows the acceptance rate
+            draft = command.strip().split(" ", 1)[1].strip() if " " in command.strip() else ""
+            if draft == "off":
+                self.draft_model = None
+            elif draft:
+                self.draft_model = draft
+                self.prewarm(draft)
+            else:
+                stats = getattr(self.backends.get(self.current_model), "draft_stats", None)
+                self.console.print(f"draft: {self.draft_model or 'off'}" + (f", {stats}" if stats else ""), style="system")
+        elif cmd.startswith("/precision"):
+            # /precision fp32|bf16|int8|auto for local models, /precision alone shows the policy
+            from device_policy import describe, set_policy
+            from model_registry import registry
+
+            if " " in cmd:
+                set_policy(precision=cmd.split(" ")[1])
+                for model, backend in list(self.backends.items()):
+                    if backend.capabilities.local:
+                        backend.unload()
+                        del self.backends[model]
+                # Free the old weights before the new precision loads
+                registry.evict_unused()
+                self.prewarm()
+            self.console.print(describe(), style="system")
+        elif cmd.startswith("/server"):
+            # /server local|<socket path>|off routes local llama requests
+            # through a shared continuous-batching inference server
+            from inference_server import server_target, set_server_target
+
+            if " " in command.strip():
+                set_server_target(command.strip().split(" ", 1)[1].strip())
+            self.console.print(f"server: {server_target() or 'off'}", style="system")
+        elif cmd.startswith("/threads "):
+            from device_policy import configure_threads, set_policy
+
+            configure_threads(set_policy(threads=int(cmd.split(" ")[1])))
+        elif cmd.startswith("/cache"):
+            # /cache on|off|clear|stats: on-disk cache of greedy or seeded replies
+            action = cmd.split(" ")[1] if " " in cmd else "stats"
+            if action == "on" and self.response_cache is None:
+                self.response_cache = ResponseCache()
+            elif action == "off":
+                self.response_cache = None
+            elif action == "clear" and self.response_cache is not None:
+                self.response_cache.clear()
+            self.console.print(self.response_cache.stats() if self.response_cache else "response cache off", style="system")
+        elif cmd.startswith("/seed"):
+            # /seed N fixes sampling (and makes replies cacheable), /seed off unfixes it
+            value = cmd.split(" ")[1] if " " in cmd else ""
+            if value:
+                self.seed = None if value == "off" else int(value)
+            self.console.print(f"seed: {self.seed if self.seed is not None else 'off'}", style="system")
+        elif cmd.startswith("/stats"):
+            self.stats_command(command.strip().split()[1:])
         elif cmd.startswith("/temp "):
             self.temperature = float(cmd.split(" ")[1])
+        elif cmd.startswith("/rate "):
+            rate = float(cmd.split(" ")[1])
+            self.loop_rate = rate if rate > 0 else None
+            self.scheduler.set_rate(self.loop_rate)
         elif cmd.startswith("/system "):
-            self.system_prompt = " ".join(cmd.split(" ")[1:])
-        elif cmd == "/save":
-            self.save_history()
-        elif cmd == "/load":
-            self.load_history()
-
-        elif cmd == "/loop":
-            # generate one random letter
-            random_letter = chr(random.randint(97, 122))
-            asyncio.create_task(self.continuous_generation(
-                initial_prompt=random_letter,
-            ))
+            self.system_prompt = command.strip().split(" ", 1)[1]
+            self.reset_sessions()
+        elif cmd.startswith("/save"):
+            self.save_history(command.strip().split(" ", 1)[1].strip() if " " in command.strip() else None)
+        elif cmd.startswith("/load"):
+            self.cancel_warm()
+            self.load_history(command.strip().split(" ", 1)[1].strip() if " " in command.strip() else None)
+            self.reset_sessions()
+            if self.conversation_history and self.backend().capabilities.local:
+                self.warm_task = asyncio.create_task(self.warm_session())
+
+        elif cmd.startswith("/loop"):
+            # /loop [prompt] starts a background job (from a random letter if
+            # no prompt); /jobs lists them, /stop <id>|all ends them
+            prompt = command.strip()[len("/loop"):].strip() or chr(random.randint(97, 122))
+            try:
+                job = self.start_loop(prompt)
+            except RuntimeError as e:
+                self.console.print(str(e), style="system")
+            else:
+                job.task = asyncio.create_task(self.print_job(job))
+        elif cmd == "/jobs":
+            jobs = self.scheduler.list_jobs()
+            self.console.print("\n".join(job.describe() for job in jobs) or "no jobs", style="system", markup=False)
+        elif cmd.startswith("/stop"):
+            target = cmd.split(" ")[1] if " " in cmd else "all"
+            if target == "all":
+                self.scheduler.stop_all()
+            elif not target.isdigit():
+                self.console.print("usage: /stop <id>|all", style="system")
+            elif not self.scheduler.stop(int(target)):
+                self.console.print(f"no running job {target}", style="system")
 
         return True
 
+    def stats_command(self, args: List[str]):
+        # /stats                        show timings and counters
+        # /stats on|off|reset           instrumentation is off until turned on
+        # /stats dump <file> [seconds]  write every N seconds (.prom: Prometheus text, else JSONL)
+        # /stats dump off
+        # /stats profile <turns> [file] torch.profiler trace of the next N replies
+        action = args[0].lower() if args else ""
+        if action in ("on", "off"):
+            metrics.enable(action == "on")
+        elif action == "reset":
+            metrics.reset()
+        elif action == "dump":
+            if len(args) < 2 or args[1].lower() == "off":
+                stop_dump()
+            else:
+                metrics.enable()
+                start_dump(args[1], float(args[2]) if len(args) > 2 else 10.0)
+                self.console.print(f"writing metrics to {args[1]}", style="system")
+                return
+        elif action == "profile":
+            metrics.enable()
+            metrics.start_profile(int(args[1]) if len(args) > 1 else 1, *args[2:3])
+            self.console.print(f"profiling the next {metrics.profile.turns} replies", style="system")
+            return
+        if self.response_cache is not None:
+            self.console.print(self.response_cache.stats(), style="system")
+        self.console.print(metrics.report(), style="system", markup=False)
+
     def format_message(self, role: str, content: str) -> str:
         timestamp = datetime.now().strftime("%H:%M:%S")
         return f"[{timestamp}] [{role}]{content}[/{role}]"
@@ -241,6 +498,25 @@ class ChatInterface:
     def run(self):
         asyncio.run(self.async_run())
 
+    async def shutdown(self):
+        stop_dump()
+        if self.warm_task is not None:
+            # Let the prefill finish before its model is unloaded
+            await asyncio.gather(self.warm_task, return_exceptions=True)
+            self.warm_task = None
+        await asyncio.to_thread(self.scheduler.shutdown)
+        for backend in self.backends.values():
+            await backend.aclose()
+        self.backends = {}
+        # An in-process server (/server local) holds its model until closed
+        from inference_server import shutdown_local_servers
+
+        await asyncio.to_thread(shutdown_local_servers)
+        await self.providers.aclose()
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
     async def async_run(self):
         while True:
             try:
@@ -256,23 +532,32 @@ class ChatInterface:
                         break
                     continue
 
-                self.conversation_history.append({"role": "user", "content": user_input})
+                self.add_message({"role": "user", "content": user_input})
                 self.console.print(self.format_message("user", user_input))
 
                 timestamp = datetime.now().strftime("%H:%M:%S")
                 self.console.print(f"[{timestamp}]", end=" ", style="assistant")
+
+                if self.fanout_models:
+                    self.console.print(f"[{', '.join(self.fanout_models)}]", style="assistant")
+                    responses = await self.send_message_fanout(user_input, self.fanout_models)
+                    # One reply carries the conversation on (the current
+                    # model's, if it was asked and answered); the rest are
+                    # logged as alternatives that later turns don't see
+                    preferred = sorted(responses, key=lambda model: model != self.current_model)
+                    chosen = next((model for model in preferred if responses[model]), preferred[0])
+                    for model, response in responses.items():
+                        message = {"role": "assistant", "content": response, "model": model}
+                        if model != chosen:
+                            message["alternative"] = True
+                        self.add_message(message)
+                    continue
+
                 self.console.print(f"[{self.current_model}]", end=" ", style="assistant")
 
-                if self.current_model.startswith("claude"):
-                    response = await self.send_message_anthropic(user_input)
-                elif self.current_model.startswith("meta-llama"):
-                    response = await self.send_message_llama(user_input)
-                elif self.current_model.startswith("gpt"):
-                    response = await self.send_message_openai(user_input)
-                else:
-                    raise ValueError(f"Unknown model: {self.current_model}")
+                response = await self.send_message(user_input)
 
-                self.conversation_history.append({"role": "assistant", "content": response})
+                self.add_message({"role": "assistant", "content": response})
 
 
             except KeyboardInterrupt:
@@ -281,6 +566,8 @@ class ChatInterface:
                 self.console.print("Error:", style="red bold")
                 self.console.print(traceback.format_exc(), style="red")
 
+        await self.shutdown()
+
 def main():
     chat = ChatInterface()
     chat.run()
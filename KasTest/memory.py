@@ -0,0 +1,147 @@
+import hashlib
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Long-term memory for the bots. Messages that fall out of the chat history
+# are embedded and kept in a growable NumPy matrix of unit vectors; each turn
+# the k messages most similar (cosine) to the recent conversation go back into
+# the prompt. The prompt stays the same size however long the run gets, so
+# prefill cost stays flat, but old points can still come back when relevant.
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+class HashingEmbedder:
+    # Dependency-free fallback: hashed bag of words and word pairs. Good enough
+    # to bring back messages sharing vocabulary with the current topic.
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                vectors[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+        return vectors
+
+
+class TransformerEmbedder:
+    # Mean-pooled hidden states of a small encoder (MiniLM by default), run on
+    # the CPU; a message embeds in a few milliseconds
+    def __init__(self, model_id: str = DEFAULT_EMBEDDING_MODEL, max_length: int = 256):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        self.name = model_id
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        self.model = AutoModel.from_pretrained(model_id).eval()
+        self.dim = self.model.config.hidden_size
+        self._torch = torch
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        torch = self._torch
+        batch = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt")
+        with torch.inference_mode():
+            hidden = self.model(**batch).last_hidden_state
+        mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1.0)
+        return pooled.float().numpy()
+
+
+_embedders: Dict[str, object] = {}
+
+
+def get_embedder(model_id: Optional[str] = DEFAULT_EMBEDDING_MODEL):
+    # One embedder per process, shared by every bot. Falls back to hashing
+    # when the model can't be loaded (offline, no weights cached)
+    model_id = model_id or DEFAULT_EMBEDDING_MODEL
+    if model_id not in _embedders:
+        if model_id == "hashing":
+            _embedders[model_id] = HashingEmbedder()
+        else:
+            try:
+                _embedders[model_id] = TransformerEmbedder(model_id)
+            except Exception as e:
+                print(f"Could not load embedding model {model_id} ({type(e).__name__}: {e}); using hashed word features")
+                _embedders[model_id] = _embedders.setdefault("hashing", HashingEmbedder())
+    return _embedders[model_id]
+
+
+class VectorIndex:
+    # Rows are L2-normalised, so cosine similarity is one matrix-vector product.
+    # Capacity doubles when full, so adding a message is amortised O(dim).
+    def __init__(self, dim: int, capacity: int = 64):
+        self.dim = dim
+        self.size = 0
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, vectors: np.ndarray) -> range:
+        vectors = normalise(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+        needed = self.size + len(vectors)
+        if needed > len(self.vectors):
+            grown = np.zeros((max(needed, 2 * len(self.vectors)), self.dim), dtype=np.float32)
+            grown[:self.size] = self.vectors[:self.size]
+            self.vectors = grown
+        self.vectors[self.size:needed] = vectors
+        added = range(self.size, needed)
+        self.size = needed
+        return added
+
+    def search(self, query: np.ndarray, k: int) -> List[tuple]:
+        # [(row, score)] best first
+        if not self.size or k <= 0:
+            return []
+        scores = self.vectors[:self.size] @ normalise(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        k = min(k, self.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top]
+
+    def clear(self):
+        self.size = 0
+
+
+def normalise(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-8)
+
+
+class PersonaMemory:
+    # What the bots remember: the "person: content" lines of messages evicted
+    # from their chat history, searchable by similarity to the conversation now
+    def __init__(self, embedder=None, k: int = 4, min_score: float = 0.1):
+        self.embedder = embedder or get_embedder()
+        self.k = k
+        self.min_score = min_score
+        self.lines: List[str] = []
+        self.index = VectorIndex(self.embedder.dim)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def remember(self, line: str):
+        line = line.strip()
+        if line:
+            self.lines.append(line)
+            self.index.add(self.embedder.embed([line]))
+
+    def recall(self, query: str, k: Optional[int] = None) -> List[str]:
+        # Best matches, listed in the order they were said
+        if not self.lines or not query.strip():
+            return []
+        hits = self.index.search(self.embedder.embed([query])[0], self.k if k is None else k)
+        return [self.lines[row] for row, score in sorted(hits) if score >= self.min_score]
+
+    def clear(self):
+        self.lines.clear()
+        self.index.clear()
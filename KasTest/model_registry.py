@@ -0,0 +1,153 @@
+import gc
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from device_policy import configure_threads, quantize_int8, resolve
+from tiny_model import build_tiny_model, build_tiny_tokenizer, is_tiny_model
+
+DEFAULT_MODEL = "meta-llama/Llama-3.2-1B-Instruct"
+
+
+def load_tokenizer(model_id: str):
+    # Just the tokenizer, for processes that talk to a model served elsewhere
+    from transformers import AutoTokenizer
+
+    if is_tiny_model(model_id):
+        return build_tiny_tokenizer()
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+@dataclass
+class ModelHandle:
+    key: Tuple[str, str, str]
+    model: object
+    tokenizer: object
+    refs: int = 0
+    prefix_cache: object = None
+
+    @property
+    def model_id(self) -> str:
+        return self.key[0]
+
+
+class ModelRegistry:
+    # Process-wide cache of loaded weights, keyed by (model id, dtype, device);
+    # dtype "int8" is fp32 weights with dynamically quantized Linear layers.
+    # Every bot / chat session acquires a handle and releases it when done, so
+    # N personas on the same model share one copy of the weights. Released
+    # models stay loaded until evicted explicitly.
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str, str], ModelHandle] = {}
+        self._lock = threading.Lock()
+        self._loading: Dict[Tuple[str, str, str], threading.Lock] = {}
+
+    def key_for(self, model_id: str, dtype=None, device: Optional[str] = None):
+        # Unset dtype / device come from the device policy
+        dtype, device = resolve(model_id, dtype, device)
+        return (model_id, dtype, device)
+
+    def acquire(self, model_id: str = DEFAULT_MODEL, dtype=None, device: Optional[str] = None) -> ModelHandle:
+        key = self.key_for(model_id, dtype, device)
+        with self._lock:
+            handle = self._entries.get(key)
+            if handle is not None:
+                handle.refs += 1
+                return handle
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        # Load outside the registry lock so other models stay available, but
+        # only once per key even if several bots ask at the same time
+        with load_lock:
+            with self._lock:
+                handle = self._entries.get(key)
+                if handle is not None:
+                    handle.refs += 1
+                    return handle
+            model, tokenizer = self._load(*key)
+            with self._lock:
+                handle = ModelHandle(key=key, model=model, tokenizer=tokenizer, refs=1)
+                self._entries[key] = handle
+                self._loading.pop(key, None)
+                return handle
+
+    def prewarm(self, model_id: str = DEFAULT_MODEL, dtype=None, device: Optional[str] = None) -> threading.Thread:
+        # Load in the background so the first acquire finds the weights ready
+        def load():
+            try:
+                self.release(self.acquire(model_id, dtype, device))
+            except Exception as e:
+                print(f'prewarm of {model_id} failed: {e}')
+
+        thread = threading.Thread(target=load, name=f"prewarm {model_id}", daemon=True)
+        thread.start()
+        return thread
+
+    def release(self, handle: ModelHandle):
+        with self._lock:
+            if handle.refs > 0:
+                handle.refs -= 1
+
+    def evict(self, handle_or_key, force: bool = False) -> bool:
+        key = handle_or_key.key if isinstance(handle_or_key, ModelHandle) else handle_or_key
+        with self._lock:
+            handle = self._entries.get(key)
+            if handle is None:
+                return False
+            if handle.refs > 0 and not force:
+                raise RuntimeError(f"Model {key[0]} is still in use ({handle.refs} handles)")
+            del self._entries[key]
+        handle.model = None
+        handle.tokenizer = None
+        handle.prefix_cache = None
+        self._free_memory()
+        return True
+
+    def evict_unused(self) -> int:
+        with self._lock:
+            unused = [key for key, handle in self._entries.items() if handle.refs == 0]
+        return sum(self.evict(key) for key in unused)
+
+    def loaded(self) -> Dict[Tuple[str, str, str], int]:
+        with self._lock:
+            return {key: handle.refs for key, handle in self._entries.items()}
+
+    def _load(self, model_id: str, dtype: str, device: str):
+        import torch
+        from transformers import AutoModelForCausalLM
+
+        configure_threads()
+        # Dynamic quantization starts from fp32 weights
+        load_dtype = "float32" if dtype == "int8" else dtype
+        if is_tiny_model(model_id):
+            model, tokenizer = build_tiny_model(model_id, load_dtype, device)
+        else:
+            print(f'loading {model_id} ({dtype}, device_map: {device})')
+            tokenizer = load_tokenizer(model_id)
+            model = AutoModelForCausalLM.from_pretrained(
+                model_id,
+                torch_dtype=getattr(torch, load_dtype),
+                # Plain CPU loads skip accelerate's dispatch hooks
+                device_map=None if device == "cpu" else device,
+                low_cpu_mem_usage=True,
+            )
+            model.eval()
+        if dtype == "int8":
+            model = quantize_int8(model)
+        return model, tokenizer
+
+    def _free_memory(self):
+        import torch
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        elif torch.backends.mps.is_available():
+            torch.mps.empty_cache()
+
+
+registry = ModelRegistry()
@@ -0,0 +1,54 @@
+import asyncio
+import os
+from typing import Optional
+
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+class ProviderPool:
+    # Async API clients created once and reused, so every request goes through
+    # the same pooled HTTP connections. The SDKs are imported on first use and
+    # handle timeouts and retry with exponential backoff; `limit` caps requests
+    # in flight across both providers.
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, max_retries: int = DEFAULT_MAX_RETRIES,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limit = asyncio.Semaphore(max_concurrency)
+        self._anthropic: Optional["anthropic.AsyncAnthropic"] = None
+        self._openai: Optional["openai.AsyncOpenAI"] = None
+
+    @property
+    def anthropic(self) -> "anthropic.AsyncAnthropic":
+        if self._anthropic is None:
+            import anthropic
+
+            self._anthropic = anthropic.AsyncAnthropic(
+                api_key=os.getenv('ANTHROPIC_API_KEY'),
+                timeout=self.timeout,
+                max_retries=self.max_retries,
+            )
+        return self._anthropic
+
+    @property
+    def openai(self) -> "openai.AsyncOpenAI":
+        if self._openai is None:
+            import openai
+
+            self._openai = openai.AsyncOpenAI(
+                api_key=os.getenv('OPENAI_API_KEY'),
+                timeout=self.timeout,
+                max_retries=self.max_retries,
+            )
+        return self._openai
+
+    async def aclose(self):
+        if self._anthropic is not None:
+            await self._anthropic.close()
+            self._anthropic = None
+        if self._openai is not None:
+            await self._openai.close()
+            self._openai = None
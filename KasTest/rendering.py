@@ -0,0 +1,121 @@
+import asyncio
+import time
+from typing import Iterable, List, Optional, Set
+
+from instrumentation import metrics
+
+DEFAULT_FRAME_BUDGET = 1 / 30
+
+
+class AsyncTokenStreamer:
+    # generate() streamer that hands new token ids to an asyncio queue. The
+    # prompt (the first put) is skipped, special tokens are dropped by id, and
+    # nothing is decoded on the generation thread.
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, skip_ids: Iterable[int] = ()):
+        self.loop = loop
+        self.skip_ids: Set[int] = set(skip_ids)
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        ids = [token for token in value.reshape(-1).tolist() if token not in self.skip_ids]
+        if ids:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, ids)
+
+    def end(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def fail(self, error: BaseException):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, error)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> List[int]:
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+
+class StreamerGroup:
+    # Hands generate()'s output to several streamers, e.g. a caller's own
+    # timing streamer alongside the AsyncTokenStreamer reading the reply
+
+    def __init__(self, *streamers):
+        self.streamers = streamers
+
+    def put(self, value):
+        for streamer in self.streamers:
+            streamer.put(value)
+
+    def end(self):
+        for streamer in self.streamers:
+            streamer.end()
+
+
+class IncrementalDecoder:
+    # Decodes a growing token sequence chunk by chunk. Each step decodes only
+    # a short window of recent tokens (enough for the tokenizer to get word
+    # boundaries right) and holds back text that ends mid-character.
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, ids: List[int]) -> str:
+        self.ids.extend(ids)
+        prefix_text = self.tokenizer.decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.ids[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self) -> str:
+        prefix_text = self.tokenizer.decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
+class StreamRenderer:
+    # Batches streamed chunks into at most one console write per frame, and
+    # keeps the reply as a list of parts joined once at the end.
+
+    def __init__(self, console, style: str = "assistant", frame_budget: float = DEFAULT_FRAME_BUDGET):
+        self.console = console
+        self.style = style
+        self.frame_budget = frame_budget
+        self.parts: List[str] = []
+        self.pending: List[str] = []
+        self.last_flush: Optional[float] = None
+
+    def write(self, text: str):
+        self.parts.append(text)
+        self.pending.append(text)
+        now = time.monotonic()
+        # The first chunk goes out straight away so time-to-first-token shows
+        if self.last_flush is None or now - self.last_flush >= self.frame_budget:
+            self.flush(now)
+
+    def flush(self, now: Optional[float] = None):
+        if self.pending:
+            with metrics.span("render"):
+                self.console.print("".join(self.pending), end="", style=self.style, markup=False)
+            self.pending.clear()
+        self.last_flush = now if now is not None else time.monotonic()
+
+    def close(self, end: str = "\n") -> str:
+        self.flush()
+        self.console.print(end, end="")
+        return "".join(self.parts)
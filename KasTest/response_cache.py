@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+from instrumentation import metrics
+
+# On-disk cache of complete replies for requests whose output is fixed: greedy
+# decoding (temperature 0), or sampling with an explicit seed on a backend
+# that honours it. One JSON file per entry, named by the hash of everything
+# that determines the reply; a hit bumps the file's mtime, and the least
+# recently used files go once the directory is over max_bytes. Writes go
+# through a temp file and os.replace, so several processes (sandpit workers)
+# can share a directory.
+
+DEFAULT_CACHE_DIR = ".response_cache"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def is_deterministic(temperature: Optional[float], seed: Optional[int], seeded: bool = True) -> bool:
+    # seeded: whether the backend reproduces a sampled reply from its seed
+    # (OpenAI's seed is only best effort)
+    return not temperature or (seeded and seed is not None)
+
+
+def cache_key(**parts) -> str:
+    # backend, model, prompt, sampling parameters, seed, ... in any order
+    canonical = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._sizes: Dict[str, int] = {
+            entry.name: entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".json")
+        }
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            metrics.count("cache_misses", cache="response")
+            return None
+        with self._lock:
+            self.hits += 1
+        metrics.count("cache_hits", cache="response")
+        return entry
+
+    def put(self, key: str, entry: Dict):
+        data = json.dumps({**entry, "created": time.time()}, ensure_ascii=False).encode()
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._sizes[os.path.basename(path)] = len(data)
+            if self.nbytes > self.max_bytes:
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._sizes):
+                self._remove(name)
+            self.hits = self.misses = 0
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return (f"response cache {self.directory}: {len(self)} entries, {self.nbytes / 1024:.0f} KiB "
+                f"of {self.max_bytes / 1024 / 1024:.0f} MiB, {self.hits} hits / {self.misses} misses ({rate:.0%})")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _evict(self):
+        # Other processes may have written or touched files too; go by the disk
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self._sizes = {name: size for _, name, size in entries}
+        for _, name, _ in sorted(entries):
+            if self.nbytes <= self.max_bytes:
+                return
+            self._remove(name)
+
+    def _remove(self, name: str):
+        self._sizes.pop(name, None)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+async def cached_stream(cache: ResponseCache, key: str, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    # Replays a cached reply chunk by chunk, or passes the live stream through
+    # and stores it once it has finished
+    entry = cache.get(key)
+    if entry is not None:
+        for chunk in entry["chunks"]:
+            yield chunk
+        return
+    collected: List[str] = []
+    async for chunk in chunks:
+        collected.append(chunk)
+        yield chunk
+    cache.put(key, {"chunks": collected})
@@ -0,0 +1,86 @@
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Durable record of a sandpit run, one JSON object per line:
+#   {"type": "start", ...settings}      written once, when the run starts
+#   {"type": "message", "round": n, "speaker": ..., "content": ...}
+# Round 0 is the opening message. Every record is flushed to the OS as soon as
+# it is written, so a crash of the process loses nothing; fsync (which also
+# survives a crash of the machine) runs every fsync_every records or
+# fsync_interval seconds, and on close.
+
+LOG_VERSION = 1
+
+
+class SandpitLog:
+    def __init__(self, path: str, fsync_every: int = 20, fsync_interval: float = 5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def start(self, settings: Dict):
+        # A new run truncates whatever was there. Binary throughout: lengths
+        # are byte offsets (see read_log), and no newline translation
+        self._file = open(self.path, "wb")
+        self.append({"type": "start", "version": LOG_VERSION, "started": datetime.now().isoformat(timespec="seconds"), **settings})
+        self.sync()
+
+    def reopen(self, length: int):
+        # Continue a run: drop anything after the last complete record
+        self._file = open(self.path, "rb+")
+        self._file.truncate(length)
+        self._file.seek(length)
+
+    def append(self, record: Dict):
+        self._file.write(json.dumps(record).encode() + b"\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def message(self, round_num: int, speaker: str, content: str):
+        self.append({"type": "message", "round": round_num, "speaker": speaker, "content": content})
+
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_log(path: str) -> Tuple[Optional[Dict], List[Dict], int]:
+    # (start record, message records, byte length of the complete records). A
+    # torn last line from a crash mid-write is ignored.
+    header, messages, length = None, [], 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            length += len(line)
+            if record.get("type") == "start":
+                header = record
+            elif record.get("type") == "message":
+                messages.append(record)
+    return header, messages, length
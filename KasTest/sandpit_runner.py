@@ -0,0 +1,333 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import re
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from device_policy import available_cores, current_policy, resolve, set_policy
+
+# Runs a batch of sandpit experiments from a JSON config across a process pool.
+# Each worker loads a model once (through the registry) and reuses it for every
+# sandpit it gets; each sandpit writes its messages to <output>/<name>.jsonl
+# and its printed conversation to <output>/<name>.txt, with a checkpoint log
+# next to them so an interrupted batch can be continued with --resume.
+#
+#   python sandpit_runner.py sandpits.example.json --output runs/today
+#   python sandpit_runner.py sandpits.example.json --output runs/today --resume
+#
+# Config layout (see sandpits.example.json):
+#   defaults - settings every sandpit inherits (model, rounds, mode, ...)
+#   personas - named bots: {"NAME": {"persona": "...", "color": "..."}}
+#   sandpits - list of {"name", "seed" or "seed_file", "bots", ...overrides};
+#              a bot is a persona name or an inline {"name", "persona", "color"},
+#              and may set its own "model" (e.g. "claude-...", "fake:tps=30")
+#              to mix local and API-backed bots in one sandpit
+
+DEFAULTS = {
+    "model": "meta-llama/Llama-3.2-1B-Instruct",
+    "rounds": 10,
+    "mode": "sequential",
+    "batch_size": None,
+    "max_new_tokens": 256,
+    "history_tokens": None,
+    "initial_speaker": "GOD",
+    "instructions": [],
+    "random_seed": None,
+    "response_cache": None,  # directory shared by all workers; needs random_seed or greedy decoding
+    "memory_k": 0,  # > 0: recall that many evicted messages per turn from each bot's memory
+    "embedding_model": None,  # encoder for the memories; "hashing" needs no download
+}
+
+# Below this many threads per worker, more workers stop helping
+MIN_THREADS_PER_WORKER = 2
+BYTES_PER_PARAM = {"float32": 4, "bfloat16": 2, "float16": 2, "int8": 1.3}
+
+
+def load_config(path: str) -> List[Dict]:
+    # Flatten the config into one self-contained spec per sandpit
+    path = Path(path)
+    config = json.loads(path.read_text())
+    defaults = {**DEFAULTS, **config.get("defaults", {})}
+    personas = config.get("personas", {})
+    specs = []
+    for i, entry in enumerate(config["sandpits"]):
+        spec = {**defaults, **entry}
+        spec.setdefault("name", f"sandpit-{i}")
+        if "seed_file" in spec:
+            spec["seed"] = (path.parent / spec.pop("seed_file")).read_text()
+        if not spec.get("seed"):
+            raise ValueError(f"Sandpit {spec['name']} has no seed or seed_file")
+        bots = []
+        for bot in spec["bots"]:
+            if isinstance(bot, str):
+                if bot not in personas:
+                    raise ValueError(f"Sandpit {spec['name']} uses unknown persona {bot}")
+                bot = {"name": bot, **personas[bot]}
+            elif "persona" not in bot:
+                # {"name": "PLONK", "model": ...} reuses the named persona
+                if bot.get("name") not in personas:
+                    raise ValueError(f"Sandpit {spec['name']} has a bot with no persona: {bot}")
+                bot = {**personas[bot["name"]], **bot}
+            bots.append({"color": "white", "instructions": spec["instructions"], **bot})
+        spec["bots"] = bots
+        specs.append(spec)
+    names = [spec["name"] for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError("Sandpit names must be unique, they name the output files")
+    return specs
+
+
+def bot_models(spec: Dict) -> List[str]:
+    # The local models a sandpit's bots load (after --model): a bot's own
+    # "model" wins over the sandpit's; API and fake bots load nothing
+    from backends import remote_model
+
+    models = {bot.get("model") or spec["model"] for bot in spec["bots"]}
+    return sorted(model for model in models if not remote_model(model))
+
+
+def available_memory_gb() -> float:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024 / 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+
+
+def estimate_memory_gb(model: str) -> float:
+    # Weights plus headroom for activations and KV caches, from the "1B" / "8B"
+    # in the model id; unknown sizes get a conservative guess
+    from tiny_model import is_tiny_model
+
+    if is_tiny_model(model):
+        return 0.5
+    match = re.search(r"(\d+(?:\.\d+)?)B\b", model)
+    if not match:
+        return 8.0
+    dtype, _ = resolve(model, device="cpu")
+    return float(match.group(1)) * BYTES_PER_PARAM.get(dtype, 4) * 1.3 + 0.5
+
+
+def plan_workers(specs: List[Dict], workers: Optional[int] = None, memory_gb: Optional[float] = None) -> int:
+    if workers:
+        return max(1, min(workers, len(specs)))
+    cores = available_cores()
+    by_cores = max(cores // MIN_THREADS_PER_WORKER, 1)
+    per_worker = memory_gb or max(sum(estimate_memory_gb(model) for model in bot_models(spec)) for spec in specs)
+    by_memory = max(int(available_memory_gb() // per_worker), 1) if per_worker else len(specs)
+    return max(1, min(len(specs), by_cores, by_memory))
+
+
+_progress = None
+_last_model = None
+
+
+def _init_worker(progress, threads):
+    # Split the cores between workers instead of every worker using all of them
+    global _progress
+    _progress = progress
+    set_policy(threads=threads)
+
+
+def run_sandpit(spec: Dict, output_dir: str, resume: bool = False) -> Dict:
+    global _last_model
+    from instrumentation import metrics
+    from model_registry import registry
+
+    name = spec["name"]
+    models = bot_models(spec)
+    summary = {"name": name, "model": spec["model"], "turns": 0, "tokens": 0, "seconds": 0.0, "error": None}
+    if _last_model is not None and models != _last_model:
+        # One set of models per worker at a time; an in-process inference
+        # server (LLAMA_SERVER=local) holds on to its model until it closes
+        from inference_server import shutdown_local_servers
+
+        shutdown_local_servers()
+        registry.evict_unused()
+    _last_model = models
+
+    from llama_test import Autobot, Sandpit
+    from response_cache import ResponseCache
+
+    output_dir = Path(output_dir)
+    transcript_path = output_dir / f"{name}.jsonl"
+    log_path = output_dir / f"{name}.checkpoint.jsonl"
+    resume = resume and log_path.exists()
+    summary["transcript"] = str(transcript_path)
+    sandpit = Sandpit(history_tokens=spec["history_tokens"], memory_k=spec["memory_k"],
+                      embedding_model=spec["embedding_model"])
+    # Each sandpit gets its own numbers (and trace) next to its transcript
+    metrics.reset()
+    if os.environ.get("LLAMA_PROFILE_TURNS"):
+        metrics.start_profile(int(os.environ["LLAMA_PROFILE_TURNS"]), str(output_dir / f"{name}.trace.json"))
+    start = time.perf_counter()
+    try:
+        if spec["random_seed"] is not None:
+            import torch
+
+            torch.manual_seed(spec["random_seed"])
+        cache = ResponseCache(spec["response_cache"]) if spec["response_cache"] else None
+        for bot in spec["bots"]:
+            autobot = Autobot(bot["name"], bot["persona"], bot["color"], model=bot.get("model") or spec["model"],
+                              instructions=bot["instructions"])
+            autobot.max_new_tokens = spec["max_new_tokens"]
+            autobot.response_cache, autobot.seed = cache, spec["random_seed"]
+            sandpit.add_autobot(autobot)
+        tokenizer = sandpit.tokenizer()
+
+        file_mode = "a" if resume else "w"
+        with open(transcript_path, file_mode) as transcript, open(output_dir / f"{name}.txt", file_mode) as log:
+            def on_message(round_num, speaker, content):
+                tokens = len(tokenizer(content, add_special_tokens=False)["input_ids"]) if round_num else 0
+                transcript.write(json.dumps({
+                    "round": round_num,
+                    "speaker": speaker,
+                    "content": content,
+                    "tokens": tokens,
+                    "time": round(time.perf_counter() - start, 3),
+                }) + "\n")
+                transcript.flush()
+                if round_num:
+                    summary["turns"] += 1
+                    summary["tokens"] += tokens
+                    if _progress is not None:
+                        _progress.put((name, tokens))
+
+            sandpit.on_message = on_message
+            with contextlib.redirect_stdout(log):
+                if resume:
+                    sandpit.resume(log_path, rounds=spec["rounds"])
+                else:
+                    sandpit.start_conversation(
+                        spec["seed"],
+                        rounds=spec["rounds"],
+                        initial_speaker=spec["initial_speaker"],
+                        mode=spec["mode"],
+                        batch_size=spec["batch_size"],
+                        log_path=log_path,
+                    )
+    except Exception as e:
+        # One broken sandpit shouldn't take the batch down with it
+        summary["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        sandpit.close()
+        metrics.stop_profile()
+        summary["seconds"] = time.perf_counter() - start
+        if metrics.enabled:
+            (output_dir / f"{name}.metrics.json").write_text(json.dumps(metrics.snapshot(), indent=2))
+    return summary
+
+
+def run_batch(specs: List[Dict], output_dir: Path, workers: int, threads: int, progress_interval: float = 2.0,
+              resume: bool = False):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # Fork would copy whatever torch state the parent has; start clean
+    context = multiprocessing.get_context("spawn")
+    progress = context.Queue()
+    # Sandpits on the same model go out back to back, so workers rarely switch
+    ordered = sorted(specs, key=bot_models)
+
+    started = datetime.now().isoformat(timespec="seconds")
+    start = time.perf_counter()
+    turns = tokens = 0
+    summaries = []
+    with context.Pool(workers, initializer=_init_worker, initargs=(progress, threads)) as pool:
+        pending = [pool.apply_async(run_sandpit, (spec, str(output_dir), resume)) for spec in ordered]
+        next_report = start + progress_interval
+        while pending:
+            try:
+                _, turn_tokens = progress.get(timeout=0.2)
+                turns += 1
+                tokens += turn_tokens
+            except queue.Empty:
+                pass
+            for result in [r for r in pending if r.ready()]:
+                pending.remove(result)
+                summary = result.get()
+                summaries.append(summary)
+                status = f"error: {summary['error']}" if summary["error"] else f"{summary['turns']} turns"
+                print(f"[{len(summaries)}/{len(specs)}] {summary['name']}: {status}, "
+                      f"{summary['tokens']} tokens in {summary['seconds']:.1f}s", flush=True)
+            now = time.perf_counter()
+            if now >= next_report and pending:
+                elapsed = now - start
+                print(f"  {len(summaries)}/{len(specs)} done, {turns} turns, {tokens} tokens, "
+                      f"{tokens / elapsed:.1f} tok/s overall", flush=True)
+                next_report = now + progress_interval
+
+    elapsed = time.perf_counter() - start
+    tokens = sum(summary["tokens"] for summary in summaries)
+    report = {
+        "started": started,
+        "workers": workers,
+        "threads_per_worker": threads,
+        "seconds": elapsed,
+        "tokens": tokens,
+        "tokens_per_sec": tokens / elapsed if elapsed else 0.0,
+        "sandpits": summaries,
+    }
+    (output_dir / "summary.json").write_text(json.dumps(report, indent=2))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a batch of sandpit experiments in parallel")
+    parser.add_argument("config", help="JSON file with the sandpits to run")
+    parser.add_argument("--output", help="output directory (default: sandpit_runs/<timestamp>)")
+    parser.add_argument("--only", type=lambda s: s.split(","), help="comma-separated sandpit names to run")
+    parser.add_argument("--model", help="override every sandpit's model")
+    parser.add_argument("--rounds", type=int, help="override every sandpit's rounds")
+    parser.add_argument("--workers", type=int, help="worker processes (default: from cores and memory)")
+    parser.add_argument("--memory-per-worker", type=float, help="GB one worker needs (default: estimated from the model)")
+    parser.add_argument("--resume", action="store_true", help="continue the sandpits checkpointed in --output")
+    parser.add_argument("--metrics", action="store_true", help="write <name>.metrics.json timings for every sandpit")
+    parser.add_argument("--profile", type=int, metavar="TURNS", help="torch.profiler trace of each sandpit's first TURNS turns")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan without running anything")
+    args = parser.parse_args()
+
+    specs = load_config(args.config)
+    if args.only:
+        specs = [spec for spec in specs if spec["name"] in args.only]
+    for spec in specs:
+        spec["model"] = args.model or spec["model"]
+        spec["rounds"] = args.rounds or spec["rounds"]
+    if not specs:
+        sys.exit("Nothing to run")
+
+    workers = plan_workers(specs, args.workers, args.memory_per_worker)
+    threads = current_policy().threads or max(available_cores() // workers, 1)
+    output_dir = Path(args.output or Path("sandpit_runs") / datetime.now().strftime("%Y%m%d-%H%M%S"))
+    print(f"{len(specs)} sandpits on {workers} workers x {threads} threads -> {output_dir}")
+    if args.dry_run:
+        for spec in specs:
+            bots = ", ".join(bot["name"] + (f" ({bot['model']})" if bot.get("model") else "") for bot in spec["bots"])
+            print(f"  {spec['name']}: {spec['model']}, {spec['rounds']} rounds ({spec['mode']}), bots: {bots}")
+        return
+
+    if args.resume and not args.output:
+        sys.exit("--resume needs the --output directory of the run to continue")
+    # Spawned workers read these when they import instrumentation
+    if args.metrics or args.profile:
+        os.environ["LLAMA_METRICS"] = "1"
+    if args.profile:
+        os.environ["LLAMA_PROFILE_TURNS"] = str(args.profile)
+    report = run_batch(specs, output_dir, workers, threads, resume=args.resume)
+    failed = [summary["name"] for summary in report["sandpits"] if summary["error"]]
+    print(f"{report['tokens']} tokens in {report['seconds']:.1f}s, {report['tokens_per_sec']:.1f} tok/s overall")
+    if failed:
+        print(f"{len(failed)} sandpit(s) failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import asyncio
+import contextlib
+import itertools
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from instrumentation import metrics
+
+# Owns the local model for background generation. Background jobs (/loop) are
+# iterators of text that one worker thread advances a step (about one token)
+# at a time, highest priority first and round-robin within a priority.
+# Interactive turns hold foreground() while they generate; every background
+# job pauses at its next token boundary until no turn is running, so a reply
+# never shares the model with a loop.
+#
+# Everything is bounded: at most max_jobs jobs are active (submit() refuses
+# more), and a job whose consumer falls max_buffered chunks behind is not
+# stepped again until the consumer catches up.
+
+INTERACTIVE = 0
+BACKGROUND = 10
+
+DEFAULT_MAX_JOBS = 4
+DEFAULT_MAX_BUFFERED = 64
+KEEP_FINISHED = 10
+
+ACTIVE_STATES = ("queued", "running", "preempted", "waiting")
+
+
+class Job:
+    def __init__(self, scheduler: "GenerationScheduler", job_id: int, name: str, start: Callable[["Job"], Iterator[str]],
+                 priority: int, rate: Optional[float], loop: asyncio.AbstractEventLoop):
+        self.scheduler = scheduler
+        self.id = job_id
+        self.name = name
+        self.priority = priority
+        # rate caps chunks per second; None runs as fast as the model goes
+        self.rate = rate
+        self.state = "queued"
+        self.error: Optional[BaseException] = None
+        self.chunks = 0
+        self.created = time.monotonic()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        # Set by start() if it has something worth showing in /jobs (e.g.
+        # speculative decoding AcceptanceStats)
+        self.stats = None
+        # The consumer task printing this job, if any
+        self.task: Optional[asyncio.Task] = None
+        self._start = start
+        self._iterator: Optional[Iterator[str]] = None
+        self._loop = loop
+        self._output: asyncio.Queue = asyncio.Queue()
+        self._buffered = 0
+        self._next_time = 0.0
+        self._last_step = 0.0
+        self._stop_requested = False
+
+    @property
+    def active(self) -> bool:
+        return self.state in ACTIVE_STATES
+
+    def step(self) -> str:
+        # Runs on the scheduler thread; the first step sets the job up
+        if self._iterator is None:
+            self.started = time.monotonic()
+            self._iterator = self._start(self)
+        return next(self._iterator)
+
+    def describe(self) -> str:
+        elapsed = (self.finished or time.monotonic()) - (self.started or self.created)
+        rate = f", {self.chunks / elapsed:.1f}/s" if self.started and elapsed > 0 else ""
+        line = f"[{self.id}] {self.name}: {self.state}, {self.chunks} chunks{rate}, priority {self.priority}"
+        if self.stats is not None:
+            line += f", {self.stats}"
+        if self.error is not None:
+            line += f" ({type(self.error).__name__}: {self.error})"
+        return line
+
+    async def stream(self) -> AsyncIterator[str]:
+        # Everything the job produces; raises if it failed. Reading makes room
+        # in the buffer, which lets the job run again.
+        while True:
+            item = await self._output.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            with self.scheduler._cond:
+                self._buffered -= 1
+                self.scheduler._cond.notify_all()
+            yield item
+
+
+class GenerationScheduler:
+    def __init__(self, max_jobs: int = DEFAULT_MAX_JOBS, max_buffered: int = DEFAULT_MAX_BUFFERED):
+        self.max_jobs = max_jobs
+        self.max_buffered = max_buffered
+        self.jobs: Dict[int, Job] = {}
+        self._ids = itertools.count(1)
+        self._foreground = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def submit(self, name: str, start: Callable[[Job], Iterator[str]], priority: int = BACKGROUND,
+               rate: Optional[float] = None) -> Job:
+        # Call from the event loop that will read job.stream()
+        with self._cond:
+            active = [job for job in self.jobs.values() if job.active]
+            if len(active) >= self.max_jobs:
+                raise RuntimeError(f"{len(active)} jobs already running (max {self.max_jobs}); /stop one first")
+            job = Job(self, next(self._ids), name, start, priority, rate, asyncio.get_running_loop())
+            self.jobs[job.id] = job
+            self._prune()
+            if self._thread is None:
+                self._closed = False
+                self._thread = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return job
+
+    def stop(self, job_id: int) -> bool:
+        # The job ends at its next token boundary
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None or not job.active:
+                return False
+            job._stop_requested = True
+            self._cond.notify_all()
+        return True
+
+    def stop_all(self):
+        for job_id in list(self.jobs):
+            self.stop(job_id)
+
+    def set_rate(self, rate: Optional[float]):
+        with self._cond:
+            for job in self.jobs.values():
+                if job.active:
+                    job.rate = rate
+            self._cond.notify_all()
+
+    def list_jobs(self) -> List[Job]:
+        with self._cond:
+            return sorted(self.jobs.values(), key=lambda job: job.id)
+
+    @contextlib.contextmanager
+    def foreground(self):
+        # Held by an interactive turn for as long as it uses the model
+        with self._cond:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._foreground -= 1
+                self._cond.notify_all()
+
+    def shutdown(self):
+        self.stop_all()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None and not self._closed:
+                    self._cond.wait(self._wait_time())
+                    job = self._next_job()
+                if job is None:
+                    return
+                job.state = "running"
+            try:
+                with metrics.span("background_step", job=job.name):
+                    text = job.step()
+            except StopIteration:
+                self._finish(job, "done")
+                continue
+            except Exception as e:
+                self._finish(job, "failed", e)
+                continue
+            now = time.monotonic()
+            with self._cond:
+                job.chunks += 1
+                job._buffered += 1
+                job._last_step = now
+                if job.rate:
+                    job._next_time = max(job._next_time + 1 / job.rate, now)
+            job._loop.call_soon_threadsafe(job._output.put_nowait, text)
+
+    def _next_job(self) -> Optional[Job]:
+        # Called with the lock held
+        for job in list(self.jobs.values()):
+            if job.active and (job._stop_requested or self._closed):
+                self._finish(job, "stopped")
+        candidates = [job for job in self.jobs.values() if job.active]
+        if not candidates or self._closed:
+            return None
+        if self._foreground:
+            for job in candidates:
+                if job.state == "running":
+                    job.state = "preempted"
+            return None
+        now = time.monotonic()
+        runnable = []
+        for job in candidates:
+            if job._buffered >= self.max_buffered or job._next_time > now:
+                if job.state == "running":
+                    job.state = "waiting"
+                continue
+            runnable.append(job)
+        if not runnable:
+            return None
+        return min(runnable, key=lambda job: (job.priority, job._last_step))
+
+    def _wait_time(self) -> Optional[float]:
+        # Until the next rate-limited job is due; otherwise until notified
+        due = [job._next_time for job in self.jobs.values()
+               if job.active and job._buffered < self.max_buffered and job._next_time]
+        if self._foreground or not due:
+            return None
+        return max(min(due) - time.monotonic(), 0.001)
+
+    def _finish(self, job: Job, state: str, error: Optional[BaseException] = None):
+        with self._cond:
+            if not job.active:
+                return
+            job.state = state
+            job.error = error
+            job.finished = time.monotonic()
+            iterator, job._iterator = job._iterator, None
+            self._cond.notify_all()
+        if iterator is not None and hasattr(iterator, "close"):
+            iterator.close()
+        job._loop.call_soon_threadsafe(job._output.put_nowait, error)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in finished[:-KEEP_FINISHED]:
+            del self.jobs[job_id]
+
+
+scheduler = GenerationScheduler()
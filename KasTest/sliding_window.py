@@ -0,0 +1,217 @@
+from typing import Iterator, List, Optional
+
+import torch
+
+from generation import model_device
+from kv_cache import cache_layers, crop_layers, make_cache
+from speculative import AcceptanceStats, same_vocab, speculative_accept
+
+
+def rotate_half(x: torch.Tensor) -> torch.Tensor:
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+def token_probs(logits: torch.Tensor, temperature: float = 0.7, top_p: Optional[float] = None) -> torch.Tensor:
+    # Sampling distribution after temperature and nucleus filtering; greedy
+    # (temperature <= 0) is a one-hot distribution
+    logits = logits.float()
+    if temperature <= 0:
+        return torch.nn.functional.one_hot(logits.argmax(-1), logits.shape[-1]).float()
+    probs = torch.softmax(logits / temperature, dim=-1)
+    if top_p is not None and top_p < 1.0:
+        sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+        keep = sorted_probs.cumsum(-1) - sorted_probs < top_p
+        probs = torch.zeros_like(probs).scatter(-1, sorted_ids, sorted_probs * keep)
+        probs = probs / probs.sum(-1, keepdim=True)
+    return probs
+
+
+def sample_token(logits: torch.Tensor, temperature: float = 0.7, top_p: Optional[float] = None) -> int:
+    return int(torch.multinomial(token_probs(logits, temperature, top_p), 1))
+
+
+class WindowSession:
+    # One model's KV cache over a window of token ids. Tokens can be appended,
+    # cropped from the end (rejected drafts) or evicted after the first
+    # `sink` tokens (attention sinks). Evicted keys are re-rotated to their new
+    # positions so nothing has to be re-prefilled.
+
+    def __init__(self, handle, sink: int = 4):
+        self.model = handle.model
+        self.sink = sink
+        self.device = model_device(self.model)
+        self.rotary = getattr(getattr(self.model, "model", None), "rotary_emb", None)
+        self.cache = None
+        self.window_ids: List[int] = []
+
+    def __len__(self):
+        return len(self.window_ids)
+
+    def reset(self):
+        self.cache = None
+        self.window_ids = []
+
+    def forward(self, ids: List[int]) -> torch.Tensor:
+        # Returns the logits for every position in ids
+        start = len(self.window_ids)
+        positions = torch.arange(start, start + len(ids), device=self.device)
+        with torch.no_grad():
+            output = self.model(
+                input_ids=torch.tensor([ids], device=self.device),
+                past_key_values=self.cache,
+                position_ids=positions[None],
+                cache_position=positions,
+                use_cache=True,
+            )
+        self.cache = output.past_key_values
+        self.window_ids.extend(ids)
+        return output.logits[0]
+
+    def crop(self, length: int):
+        if length < len(self.window_ids):
+            self.cache = make_cache(crop_layers(cache_layers(self.cache), length))
+            self.window_ids = self.window_ids[:length]
+
+    def evict(self, drop: int):
+        drop = min(drop, len(self.window_ids) - self.sink)
+        if drop <= 0:
+            return
+        kept_ids = self.window_ids[:self.sink] + self.window_ids[self.sink + drop:]
+        if self.rotary is None:
+            # No shared rotary embedding to re-rotate with; re-prefill the window
+            self.reset()
+            self.forward(kept_ids)
+            return
+
+        layers = []
+        for keys, values in cache_layers(self.cache):
+            recent_keys = self._shift_keys(keys[..., self.sink + drop:, :], drop)
+            layers.append((
+                torch.cat((keys[..., :self.sink, :], recent_keys), dim=-2),
+                torch.cat((values[..., :self.sink, :], values[..., self.sink + drop:, :]), dim=-2),
+            ))
+        self.cache = make_cache(layers)
+        self.window_ids = kept_ids
+
+    def _shift_keys(self, keys: torch.Tensor, delta: int) -> torch.Tensor:
+        # Keys are stored already rotated; rotating by -delta moves them delta
+        # positions back, which is where they sit after the eviction
+        position_ids = torch.full((1, 1), -delta, device=keys.device)
+        cos, sin = self.rotary(keys.float(), position_ids)
+        scale = getattr(self.rotary, "attention_scaling", 1.0)
+        cos, sin = (cos / scale)[:, None].float(), (sin / scale)[:, None].float()
+        shifted = keys.float() * cos + rotate_half(keys.float()) * sin
+        return shifted.to(keys.dtype)
+
+
+class SlidingWindowStream:
+    # Endless generation over one open model session. The KV cache holds at
+    # most `window` tokens: the first `sink` tokens are kept for good and the
+    # oldest tokens after them are dropped in chunks, so every token costs the
+    # same no matter how long the stream has run.
+    #
+    # With a draft model, each step drafts `draft_tokens` tokens with it and
+    # verifies them in one forward pass of the main model (speculative
+    # sampling, same output distribution). Both sessions hold the same window.
+
+    def __init__(self, handle, window: int = 512, sink: int = 4, temperature: float = 0.7,
+                 top_p: Optional[float] = 0.9, evict_chunk: Optional[int] = None,
+                 draft_handle=None, draft_tokens: int = 4):
+        if window <= sink + draft_tokens + 2:
+            raise ValueError(f"window ({window}) too small for sink ({sink}) and draft tokens ({draft_tokens})")
+        # Drafts are verified token id for token id; there is no translating
+        # path here as there is for generate()
+        if draft_handle is not None and not same_vocab(handle.tokenizer, draft_handle.tokenizer):
+            raise ValueError(f"draft model {draft_handle.model_id} doesn't share {handle.model_id}'s vocabulary; "
+                             "/loop can only draft with a same-vocabulary model")
+        self.tokenizer = handle.tokenizer
+        self.window = window
+        self.temperature = temperature
+        self.top_p = top_p
+        self.evict_chunk = evict_chunk or max((window - sink) // 8, draft_tokens + 1)
+        self.session = WindowSession(handle, sink)
+        self.draft = WindowSession(draft_handle, sink) if draft_handle is not None else None
+        self.draft_tokens = draft_tokens
+        self.stats = AcceptanceStats()
+        self.logits = None
+        # Tokens already emitted but not yet run through each model
+        self.pending: List[int] = []
+        self.draft_pending: List[int] = []
+
+    def reset(self, prompt: str):
+        ids = self.tokenizer(prompt, return_tensors="pt")["input_ids"][0].tolist()
+        # Long prompts start the stream already at the window size
+        if len(ids) > self.window:
+            sink = self.session.sink
+            ids = ids[:sink] + ids[-(self.window - sink - self.evict_chunk):]
+        self.session.reset()
+        if self.draft is None:
+            self.logits = self.session.forward(ids)[-1]
+            return
+        # Speculative mode keeps the last token pending; it is fed in
+        # together with the next batch of drafts
+        self.draft.reset()
+        if len(ids) > 1:
+            self.session.forward(ids[:-1])
+            self.draft.forward(ids[:-1])
+        self.pending = ids[-1:]
+        self.draft_pending = ids[-1:]
+
+    def step(self) -> List[int]:
+        if self.draft is not None:
+            return self._speculative_step()
+        token = sample_token(self.logits, self.temperature, self.top_p)
+        if len(self.session) + 1 > self.window:
+            self.session.evict(self.evict_chunk)
+        self.logits = self.session.forward([token])[-1]
+        return [token]
+
+    def tokens(self) -> Iterator[int]:
+        while True:
+            yield from self.step()
+
+    def text(self) -> Iterator[str]:
+        # Decode incrementally, holding back tokens that end mid-character
+        pending = []
+        for token in self.tokens():
+            pending.append(token)
+            text = self.tokenizer.decode(pending, skip_special_tokens=True)
+            if text.endswith("�"):
+                continue
+            pending = []
+            if text:
+                yield text
+
+    def _speculative_step(self) -> List[int]:
+        k = self.draft_tokens
+        if len(self.session) + len(self.pending) + k > self.window:
+            self.session.evict(self.evict_chunk)
+            self.draft.evict(self.evict_chunk)
+
+        # Draft k tokens, keeping the draft distribution for each
+        draft_logits = self.draft.forward(self.draft_pending)[-1]
+        drafted, draft_probs = [], []
+        for i in range(k):
+            probs = token_probs(draft_logits, self.temperature, self.top_p)
+            token = int(torch.multinomial(probs, 1))
+            drafted.append(token)
+            draft_probs.append(probs)
+            if i < k - 1:
+                draft_logits = self.draft.forward([token])[-1]
+
+        # Verify all of them (plus the pending token) in one target pass
+        base = len(self.session)
+        target_logits = self.session.forward(self.pending + drafted)[len(self.pending) - 1:]
+        target_probs = token_probs(target_logits, self.temperature, self.top_p)
+        accepted, next_token = speculative_accept(target_probs, torch.stack(draft_probs).to(target_probs.device), drafted)
+        self.stats.add(AcceptanceStats(drafted=k, accepted=accepted, steps=1))
+
+        # Roll both caches back to the accepted tokens; the new token (and a
+        # fully accepted last draft the draft model never saw) stay pending
+        self.session.crop(base + len(self.pending) + accepted)
+        draft_base = len(self.draft) - (k - 1) - len(self.draft_pending)
+        self.draft.crop(draft_base + len(self.draft_pending) + min(accepted, k - 1))
+        self.pending = [next_token]
+        self.draft_pending = drafted[k - 1:] + [next_token] if accepted == k else [next_token]
+        return drafted[:accepted] + [next_token]
@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+
+@dataclass
+class AcceptanceStats:
+    drafted: int = 0
+    accepted: int = 0
+    steps: int = 0
+
+    @property
+    def rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def add(self, other: "AcceptanceStats"):
+        self.drafted += other.drafted
+        self.accepted += other.accepted
+        self.steps += other.steps
+
+    def __str__(self):
+        return f"draft acceptance {self.rate:.0%} ({self.accepted}/{self.drafted} tokens, {self.steps} verify steps)"
+
+
+def same_vocab(tokenizer, draft_tokenizer) -> bool:
+    # Same size and the same ids for every ordinary token. Added/special
+    # tokens are left out: Llama 3.2 renames several of Llama 3's reserved
+    # ones (128008 is <|eom_id|>) without changing what the ids mean.
+    if len(tokenizer) != len(draft_tokenizer):
+        return False
+    return ordinary_vocab(tokenizer) == ordinary_vocab(draft_tokenizer)
+
+
+def ordinary_vocab(tokenizer) -> dict:
+    added = tokenizer.get_added_vocab()
+    return {token: index for token, index in tokenizer.get_vocab().items() if token not in added}
+
+
+def assisted_kwargs(target_handle, draft_handle) -> dict:
+    # generate() arguments for HF assisted decoding. Same-vocab drafts (e.g.
+    # Llama-3.2-1B for Llama-3-8B) verify token ids directly; anything else
+    # goes through the tokenizer-translating "universal" path.
+    kwargs = {"assistant_model": draft_handle.model}
+    if not same_vocab(target_handle.tokenizer, draft_handle.tokenizer):
+        kwargs.update(tokenizer=target_handle.tokenizer, assistant_tokenizer=draft_handle.tokenizer)
+    return kwargs
+
+
+@contextmanager
+def track_assisted(target_model, draft_model, stats: AcceptanceStats):
+    # Counts forward passes while generate() runs. Every target pass verifies
+    # one batch of candidates and keeps the accepted ones plus one token of its
+    # own; every draft pass proposes one candidate. So after the call:
+    #   steps = target passes, drafted ~= draft passes, accepted = new tokens - steps
+    # Call finish(new_tokens) on the yielded function once generation is done.
+    counts = {"target": 0, "draft": 0}
+
+    def counter(name):
+        def hook(module, args, output):
+            counts[name] += 1
+        return hook
+
+    hooks = [
+        target_model.register_forward_hook(counter("target")),
+        draft_model.register_forward_hook(counter("draft")),
+    ]
+
+    def finish(new_tokens: int):
+        steps = counts["target"]
+        stats.add(AcceptanceStats(
+            drafted=counts["draft"],
+            accepted=max(min(new_tokens - steps, counts["draft"]), 0),
+            steps=steps,
+        ))
+
+    try:
+        yield finish
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+
+def speculative_accept(target_probs: "torch.Tensor", draft_probs: "torch.Tensor", drafted: list):
+    # Standard speculative sampling over k drafted tokens. target_probs has
+    # k + 1 rows (the last one is for the bonus token when everything is
+    # accepted), draft_probs has k rows. Returns (number accepted, next token);
+    # the emitted tokens follow the target model's distribution exactly.
+    import torch
+
+    for i, token in enumerate(drafted):
+        p, q = target_probs[i, token], draft_probs[i, token]
+        if torch.rand(()) * q <= p:
+            continue
+        residual = torch.clamp(target_probs[i] - draft_probs[i], min=0)
+        if residual.sum() <= 0:
+            residual = target_probs[i]
+        return i, int(torch.multinomial(residual / residual.sum(), 1))
+    return len(drafted), int(torch.multinomial(target_probs[len(drafted)], 1))
@@ -0,0 +1,100 @@
+from functools import lru_cache
+from typing import List, Sequence
+
+import torch
+from transformers import StoppingCriteria, StopStringCriteria
+
+SENTENCE_ENDINGS = (".", "!", "?")
+CLOSING_CHARS = "\"')]}*” \n"
+
+
+@lru_cache(maxsize=8)
+def sentence_end_ids(tokenizer) -> torch.Tensor:
+    # Every vocab entry whose text finishes a sentence (".", "!\n", '?"', ...)
+    pieces = tokenizer.batch_decode([[i] for i in range(len(tokenizer))])
+    ids = [i for i, piece in enumerate(pieces) if piece.rstrip(CLOSING_CHARS).endswith(SENTENCE_ENDINGS)]
+    return torch.tensor(ids, dtype=torch.long)
+
+
+class SentenceLimitCriteria(StoppingCriteria):
+    # Stops a row once it has produced max_sentences sentence-ending tokens.
+    # Only the newest token is inspected per step, so the check is O(1).
+
+    def __init__(self, tokenizer, max_sentences: int):
+        self.end_ids = sentence_end_ids(tokenizer)
+        self.max_sentences = max_sentences
+        self.counts = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.end_ids.device != input_ids.device:
+            self.end_ids = self.end_ids.to(input_ids.device)
+        if self.counts is None:
+            self.counts = torch.zeros(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+        self.counts += torch.isin(input_ids[:, -1], self.end_ids)
+        return self.counts >= self.max_sentences
+
+
+class RepetitionCriteria(StoppingCriteria):
+    # Stops a row when its last `ngram` generated tokens already appeared
+    # earlier in the same reply.
+
+    def __init__(self, prompt_length: int, ngram: int = 6):
+        self.prompt_length = prompt_length
+        self.ngram = ngram
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated = input_ids[:, self.prompt_length:]
+        if generated.shape[1] < 2 * self.ngram:
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        windows = generated.unfold(1, self.ngram, 1)
+        return (windows[:, :-1] == windows[:, -1:]).all(-1).any(-1)
+
+
+class PerRowCriteria(StoppingCriteria):
+    # Batched generation with different criteria per row (one bot per row)
+
+    def __init__(self, rows: Sequence[StoppingCriteria]):
+        self.rows = list(rows)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.cat([
+            criteria(input_ids[i:i + 1], scores[i:i + 1], **kwargs).reshape(-1).to(input_ids.device)
+            for i, criteria in enumerate(self.rows)
+        ])
+
+
+class AllCriteria(StoppingCriteria):
+    # Row stops if any of the criteria says so
+
+    def __init__(self, criteria: List[StoppingCriteria]):
+        self.criteria = criteria
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for criteria in self.criteria:
+            done |= criteria(input_ids, scores, **kwargs).reshape(-1).to(input_ids.device)
+        return done
+
+
+def speaker_stop_strings(names) -> List[str]:
+    return sorted({f"{name}:" for name in names if name})
+
+
+def build_criteria(tokenizer, prompt_length: int, max_sentences=None, stop_names=(), repetition_ngram=None):
+    criteria = []
+    if max_sentences:
+        criteria.append(SentenceLimitCriteria(tokenizer, max_sentences))
+    if stop_names:
+        criteria.append(StopStringCriteria(tokenizer, speaker_stop_strings(stop_names)))
+    if repetition_ngram:
+        criteria.append(RepetitionCriteria(prompt_length, repetition_ngram))
+    return AllCriteria(criteria) if criteria else None
+
+
+def trim_reply(text: str, name: str, stop_names=()) -> str:
+    # Drop a leading "NAME:" and anything from another speaker's "NAME:" on
+    text = text.strip()
+    if text.startswith(f"{name}:"):
+        text = text[len(name) + 1:].lstrip()
+    cut = min((text.find(s) for s in speaker_stop_strings(stop_names) if s in text), default=-1)
+    return text[:cut].rstrip() if cut >= 0 else text
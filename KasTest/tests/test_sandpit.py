@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("termcolor")
+
+from llama_test import Autobot, Sandpit
+
+FAST = "fake:ttft=0,tps=1000"
+
+
+def fake_sandpit(*names):
+    sandpit = Sandpit()
+    for name in names:
+        sandpit.add_autobot(Autobot(name=name, persona="Says little.", color="cyan", model=FAST))
+    return sandpit
+
+
+def test_fake_bots_run_rounds():
+    sandpit = fake_sandpit("BLEEP", "BLOOP")
+    messages = []
+    sandpit.on_message = lambda round_num, speaker, content: messages.append((round_num, speaker, content))
+
+    sandpit.start_conversation("What is the answer?", rounds=2)
+
+    assert [(r, s) for r, s, _ in messages] == [
+        (0, "GOD"), (1, "BLEEP"), (1, "BLOOP"), (2, "BLEEP"), (2, "BLOOP"),
+    ]
+    assert all(content for _, _, content in messages)
+    assert len(sandpit.round_times) == 2
+    # run_rounds() carries on from the same history
+    sandpit.run_rounds(1, mode="simultaneous")
+    assert [s for _, s, _ in messages[-2:]] == ["BLEEP", "BLOOP"]
+
+
+def test_fake_bots_respond_together_sync():
+    sandpit = fake_sandpit("BLEEP", "BLOOP")
+    sandpit.reset_history("GOD")
+    sandpit.record(0, "GOD", "What is the answer?")
+
+    responses = sandpit.respond_together(sandpit.autobots)
+
+    assert len(responses) == 2
+    assert all(responses)
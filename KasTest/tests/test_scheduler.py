@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+from scheduler import GenerationScheduler
+
+RATE = 50.0
+
+
+def forever(job):
+    while True:
+        yield "x"
+
+
+async def paced_run(pause):
+    # Chunk arrival times of a rate-limited job preempted for pause seconds
+    scheduler = GenerationScheduler()
+    job = scheduler.submit("count", forever, rate=RATE)
+    times = []
+
+    async def read():
+        async for _ in job.stream():
+            times.append(time.monotonic())
+
+    reader = asyncio.ensure_future(read())
+    await asyncio.sleep(0.2)
+    with scheduler.foreground():
+        paused = time.monotonic()
+        await asyncio.sleep(pause)
+    resumed = time.monotonic()
+    await asyncio.sleep(0.5)
+    scheduler.shutdown()
+    await reader
+    return times, paused, resumed
+
+
+def test_rate_holds_after_preemption():
+    times, paused, resumed = asyncio.run(paced_run(pause=0.5))
+
+    # Nothing runs while a foreground turn holds the model (one chunk may
+    # already be on its way)
+    assert len([t for t in times if paused + 0.05 < t < resumed]) == 0
+    # and afterwards the job picks up at its rate instead of catching up
+    after = [t for t in times if resumed <= t < resumed + 0.5]
+    assert RATE * 0.5 * 0.6 <= len(after) <= RATE * 0.5 + 3